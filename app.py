@@ -6,6 +6,35 @@ YouTube 下载器 - 修复版
 
 import os
 import sys
+
+def _setup_async_mode():
+    """🔧 选择并发模型：threading / eventlet / gevent
+    
+    协作式模式必须在导入 threading、socket、subprocess 之前打补丁，
+    这样 Web 服务、Socket.IO 推送和子进程监督共用同一个事件循环。
+    gunicorn 的 eventlet/gevent worker 已提前打过补丁，auto 会自动识别。
+    注意：ASYNC_MODE 需通过进程环境变量设置（.env 在打补丁之后才加载）。
+    """
+    mode = os.environ.get('ASYNC_MODE', 'auto').lower()
+    if mode == 'eventlet':
+        import eventlet
+        if not eventlet.patcher.is_monkey_patched('socket'):
+            eventlet.monkey_patch()
+        return 'eventlet'
+    if mode == 'gevent':
+        from gevent import monkey
+        if not monkey.is_module_patched('socket'):
+            monkey.patch_all()
+        return 'gevent'
+    if mode == 'auto':
+        if 'eventlet' in sys.modules and sys.modules['eventlet'].patcher.is_monkey_patched('socket'):
+            return 'eventlet'
+        if 'gevent.monkey' in sys.modules and sys.modules['gevent.monkey'].is_module_patched('socket'):
+            return 'gevent'
+    return 'threading'
+
+ASYNC_MODE = _setup_async_mode()
+
 import subprocess
 import threading
 import json
@@ -14,12 +43,44 @@ import datetime
 import uuid
 import logging
 import re
+import heapq
+import itertools
+import math
+import collections
+import shutil
+import sqlite3
+import hashlib
+import socket
+import mimetypes
+import selectors
+import signal
+import ctypes
+import tempfile
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from urllib.parse import urlparse, quote
+from flask import Flask, render_template, request, jsonify, send_file, Response
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from dotenv import load_dotenv
 
+try:
+    import yt_dlp  # 进程内下载引擎（可选）
+except ImportError:
+    yt_dlp = None
+
+try:
+    import redis  # Redis 会话存储（可选）
+except ImportError:
+    redis = None
+
+try:
+    import resource  # 子进程 rlimit（仅 POSIX）
+except ImportError:
+    resource = None
+
 # 加载环境变量
 load_dotenv()
 
@@ -36,6 +97,7 @@ class Config:
     DOWNLOAD_DIR = Path(os.getenv('DOWNLOAD_DIR', BASE_DIR / 'downloads'))
     UPLOAD_DIR = Path(os.getenv('UPLOAD_DIR', BASE_DIR / 'uploads'))
     LOG_DIR = Path(os.getenv('LOG_DIR', BASE_DIR / 'logs'))
+    DATA_DIR = Path(os.getenv('DATA_DIR', BASE_DIR / 'data'))
     
     # 文件配置 - 🔧 加强安全限制
     MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 1 * 1024 * 1024))  # 1MB
@@ -43,9 +105,101 @@ class Config:
     MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', 2))  # 降低并发数
     DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', 1800))
     
+    # 调度配置
+    MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', 50))  # 全局排队任务上限
+    SESSION_MAX_ACTIVE = int(os.getenv('SESSION_MAX_ACTIVE', 3))  # 单个会话（批次内）并行下载数
+    
+    # 优先级通道：small（低画质 / 小文件）、heavy（高画质 / 大文件）、bulk（播放列表与频道同步）
+    # 各自的保底并发（通道有排队任务时其他通道不可占用）与并发上限；上限为 0 时 small 可用全部工作线程，heavy / bulk 用一半
+    LANE_SMALL_RESERVED = int(os.getenv('LANE_SMALL_RESERVED', 1))
+    LANE_SMALL_WORKERS = int(os.getenv('LANE_SMALL_WORKERS', 0))
+    LANE_HEAVY_RESERVED = int(os.getenv('LANE_HEAVY_RESERVED', 1))
+    LANE_HEAVY_WORKERS = int(os.getenv('LANE_HEAVY_WORKERS', 0))
+    LANE_BULK_RESERVED = int(os.getenv('LANE_BULK_RESERVED', 1))
+    LANE_BULK_WORKERS = int(os.getenv('LANE_BULK_WORKERS', 0))
+    # 探测结果超过任一阈值即进入 heavy 通道；先按画质暂定通道，后台探测完成后再调整（关闭时只按画质判断）
+    LANE_HEAVY_BYTES = int(os.getenv('LANE_HEAVY_BYTES', 1024 ** 3))
+    LANE_HEAVY_DURATION = int(os.getenv('LANE_HEAVY_DURATION', 3600))
+    LANE_PROBE = os.getenv('LANE_PROBE', 'True').lower() == 'true'
+    
+    # 反爬虫限速：按上游主机的令牌桶
+    HOST_RATE_LIMIT = float(os.getenv('HOST_RATE_LIMIT', 0.5))  # 每秒新请求数
+    HOST_RATE_BURST = int(os.getenv('HOST_RATE_BURST', 2))  # 突发上限
+    
+    # 进度推送频率上限（每个会话每秒最多推送次数）
+    PROGRESS_EMIT_HZ = float(os.getenv('PROGRESS_EMIT_HZ', 4))
+    
+    # Socket.IO 出站缓冲：每个房间按固定间隔合并推送日志与进度增量
+    SOCKETIO_FLUSH_INTERVAL = float(os.getenv('SOCKETIO_FLUSH_INTERVAL', 0.25))  # 秒
+    SOCKETIO_MAX_BATCH = int(os.getenv('SOCKETIO_MAX_BATCH', 100))  # 每次推送最多日志行数，超出丢弃最旧的
+    SOCKETIO_SNAPSHOT_LOGS = int(os.getenv('SOCKETIO_SNAPSHOT_LOGS', 50))  # 重连快照中保留的最近日志行数
+    
+    # 视频信息缓存：内存 LRU + 可选 SQLite 磁盘层
+    INFO_CACHE_SIZE = int(os.getenv('INFO_CACHE_SIZE', 100))
+    INFO_CACHE_TTL = int(os.getenv('INFO_CACHE_TTL', 3600))  # 秒，且不会超过签名URL的过期时间
+    INFO_CACHE_DB = os.getenv('INFO_CACHE_DB', '')  # 为空则不启用磁盘层
+    
+    # 会话 / 任务持久化：sqlite:///路径 或 redis://主机:端口/库
+    SESSION_STORE_URL = os.getenv('SESSION_STORE_URL', f"sqlite:///{DATA_DIR / 'app.db'}")
+    # 多 worker 部署时 Socket.IO 跨进程推送所需的消息队列（如 redis://redis:6379/1）
+    SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE', '')
+    
+    # 崩溃恢复：worker 心跳超时后其未完成任务会被重新排队
+    WORKER_HEARTBEAT_INTERVAL = int(os.getenv('WORKER_HEARTBEAT_INTERVAL', 30))
+    WORKER_HEARTBEAT_TIMEOUT = int(os.getenv('WORKER_HEARTBEAT_TIMEOUT', 120))
+    MAX_RESUME_ATTEMPTS = int(os.getenv('MAX_RESUME_ATTEMPTS', 3))
+    
+    # 文件发送：direct（Flask 直接发送）或 accel（交给 nginx X-Accel-Redirect）
+    FILE_SERVE_MODE = os.getenv('FILE_SERVE_MODE', 'direct').lower()
+    ACCEL_REDIRECT_PREFIX = os.getenv('ACCEL_REDIRECT_PREFIX', '/_protected_downloads/')
+    
+    # 播放列表 / 频道展开
+    PLAYLIST_DEFAULT_ENTRIES = int(os.getenv('PLAYLIST_DEFAULT_ENTRIES', 50))  # 默认每个任务最多条目
+    PLAYLIST_MAX_ENTRIES = int(os.getenv('PLAYLIST_MAX_ENTRIES', 5000))  # 单个任务条目上限
+    PLAYLIST_QUEUE_AHEAD = int(os.getenv('PLAYLIST_QUEUE_AHEAD', 5))  # 每个会话预先排队的条目数
+    PLAYLIST_QUEUE_TIMEOUT = int(os.getenv('PLAYLIST_QUEUE_TIMEOUT', 3600))  # 等待排队空位超过该秒数即停止展开
+    PLAYLIST_EXTRACT_TIMEOUT = int(os.getenv('PLAYLIST_EXTRACT_TIMEOUT', 1800))  # 枚举子进程的运行时长上限（不含排队等待）
+    SYNC_KNOWN_STOP = int(os.getenv('SYNC_KNOWN_STOP', 3))  # 频道同步连续遇到多少个已归档视频后停止枚举
+    
+    # 磁盘配额（0 表示不限制，水位同时作用于磁盘容量和 STORAGE_QUOTA_BYTES）
+    STORAGE_QUOTA_BYTES = int(os.getenv('STORAGE_QUOTA_BYTES', 0))
+    SESSION_QUOTA_BYTES = int(os.getenv('SESSION_QUOTA_BYTES', 10 * 1024 ** 3))
+    STORAGE_HIGH_WATER = float(os.getenv('STORAGE_HIGH_WATER', 0.90))
+    STORAGE_LOW_WATER = float(os.getenv('STORAGE_LOW_WATER', 0.80))
+    STORAGE_MIN_AGE = int(os.getenv('STORAGE_MIN_AGE', 600))  # 新文件至少保留秒数，之后才可被淘汰
+    STORAGE_CHECK_INTERVAL = int(os.getenv('STORAGE_CHECK_INTERVAL', 60))
+    
+    # 子进程监督：无输出超时（秒，0 表示不检测）与 SIGTERM 后等待 SIGKILL 的宽限期
+    DOWNLOAD_STALL_TIMEOUT = int(os.getenv('DOWNLOAD_STALL_TIMEOUT', 300))
+    PROCESS_KILL_GRACE = int(os.getenv('PROCESS_KILL_GRACE', 10))
+    
+    # 下载 / 后处理子进程的资源限制（ffmpeg 继承 yt-dlp 的设置）；高画质档位可单独配置 CPU
+    JOB_NICE = int(os.getenv('JOB_NICE', 10))
+    JOB_HEAVY_NICE = int(os.getenv('JOB_HEAVY_NICE', 15))
+    JOB_CPU_AFFINITY = os.getenv('JOB_CPU_AFFINITY', '')  # 如 "2-7" 或 "2,3"，为空不限制
+    JOB_HEAVY_CPU_AFFINITY = os.getenv('JOB_HEAVY_CPU_AFFINITY', '')
+    JOB_MEMORY_LIMIT = int(os.getenv('JOB_MEMORY_LIMIT', 0))  # 虚拟内存上限（字节），0 不限制
+    JOB_IO_CLASS = os.getenv('JOB_IO_CLASS', '').lower()  # idle / best-effort，为空不调整
+    JOB_MAX_OPEN_FILES = int(os.getenv('JOB_MAX_OPEN_FILES', 0))  # 0 沿用当前进程的限制
+    
+    # 按画质覆盖下载配置（JSON），例如 {"2160p": {"external_downloader": "aria2c"}}
+    DOWNLOAD_PROFILES = os.getenv('DOWNLOAD_PROFILES', '')
+    
+    # 同时进行 FFmpeg 后处理（合并 / 转码）的任务数上限
+    POSTPROCESS_WORKERS = int(os.getenv('POSTPROCESS_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+    
+    # 批量探测：并发数、单次最多 URL 数、整体等待秒数
+    PROBE_WORKERS = int(os.getenv('PROBE_WORKERS', 4))
+    PROBE_MAX_URLS = int(os.getenv('PROBE_MAX_URLS', 20))
+    PROBE_TIMEOUT = int(os.getenv('PROBE_TIMEOUT', 60))
+    
+    # 下载引擎: inprocess（进程内调用 yt_dlp）或 subprocess（每个视频启动 python -m yt_dlp）
+    # 协作式模式下默认 subprocess：进程内解析是 CPU 密集的，会阻塞整个事件循环
+    DOWNLOAD_ENGINE = (os.getenv('DOWNLOAD_ENGINE') or ('inprocess' if ASYNC_MODE == 'threading' else 'subprocess')).lower()
+    
     def __init__(self):
         # 创建必要目录
-        for directory in [self.DOWNLOAD_DIR, self.UPLOAD_DIR, self.LOG_DIR]:
+        for directory in [self.DOWNLOAD_DIR, self.UPLOAD_DIR, self.LOG_DIR, self.DATA_DIR]:
             directory.mkdir(parents=True, exist_ok=True)
 
 config = Config()
@@ -86,13 +240,158 @@ QUALITY_OPTIONS = {
         'name': '流畅 (360p)',
         'format': 'bv*[height<=360]+ba/b[height<=360]',
         'description': '360p流畅播放'
+    },
+    # 🔧 按体积优先：同一高度下在 AV1 / VP9 / H.264 中选择文件最小的组合
+    'compact_1080p': {
+        'name': '省流 (1080p)',
+        'format': 'bv*[height<=1080]+ba/b[height<=1080]',
+        'format_sort': 'res:1080,+size,+br',
+        'fallback_format': 'best[height<=1080]/best',
+        'description': '1080p中体积最小的编码'
+    },
+    'compact_720p': {
+        'name': '省流 (720p)',
+        'format': 'bv*[height<=720]+ba/b[height<=720]',
+        'format_sort': 'res:720,+size,+br',
+        'fallback_format': 'best[height<=720]/best',
+        'description': '720p中体积最小的编码'
+    },
+    # 🔧 仅音频：只传输音频流
+    'audio': {
+        'name': '仅音频 (原始编码)',
+        'format': 'ba/b',
+        'fallback_format': 'ba/b',
+        'audio_only': True,
+        'description': '不转码，保留原始音频'
+    },
+    'audio_opus': {
+        'name': '仅音频 (Opus)',
+        'format': 'ba[acodec^=opus]/ba',
+        'fallback_format': 'ba/b',
+        'audio_only': True,
+        'extract_audio': 'opus',
+        'description': 'Opus 音频（源为 Opus 时直接封装）'
+    },
+    'audio_m4a': {
+        'name': '仅音频 (M4A)',
+        'format': 'ba[ext=m4a]/ba[acodec^=mp4a]/ba',
+        'fallback_format': 'ba/b',
+        'audio_only': True,
+        'extract_audio': 'm4a',
+        'description': 'AAC 音频（源为 AAC 时直接封装）'
+    },
+    'audio_mp3': {
+        'name': '仅音频 (MP3)',
+        'format': 'ba',
+        'fallback_format': 'ba/b',
+        'audio_only': True,
+        'extract_audio': 'mp3',
+        'description': 'MP3 音频（需要转码）'
     }
 }
 
+# 高画质档位：更长的超时、单独的 CPU 限制
+HEAVY_QUALITIES = ('2160p', '1440p', 'best')
+
+# 🔧 按画质的传输配置：并发分片数、HTTP 分块大小、缓冲区、外部多连接下载器
+DEFAULT_DOWNLOAD_PROFILES = {
+    'best': {'concurrent_fragments': 8, 'http_chunk_size': '10M', 'buffer_size': '1M'},
+    '2160p': {'concurrent_fragments': 8, 'http_chunk_size': '10M', 'buffer_size': '1M'},
+    '1440p': {'concurrent_fragments': 6, 'http_chunk_size': '10M', 'buffer_size': '1M'},
+    '1080p': {'concurrent_fragments': 4, 'http_chunk_size': '10M', 'buffer_size': '512K'},
+    '720p': {'concurrent_fragments': 2, 'http_chunk_size': '10M', 'buffer_size': '256K'},
+    '480p': {'concurrent_fragments': 1, 'http_chunk_size': None, 'buffer_size': None},
+    '360p': {'concurrent_fragments': 1, 'http_chunk_size': None, 'buffer_size': None},
+    'compact_1080p': {'concurrent_fragments': 4, 'http_chunk_size': '10M', 'buffer_size': '512K'},
+    'compact_720p': {'concurrent_fragments': 2, 'http_chunk_size': '10M', 'buffer_size': '256K'},
+    'audio': {'concurrent_fragments': 2, 'http_chunk_size': '10M', 'buffer_size': None},
+    'audio_opus': {'concurrent_fragments': 2, 'http_chunk_size': '10M', 'buffer_size': None},
+    'audio_m4a': {'concurrent_fragments': 2, 'http_chunk_size': '10M', 'buffer_size': None},
+    'audio_mp3': {'concurrent_fragments': 2, 'http_chunk_size': '10M', 'buffer_size': None},
+}
+PROFILE_FIELDS = ('concurrent_fragments', 'http_chunk_size', 'buffer_size',
+                  'external_downloader', 'external_downloader_args')
+# 只影响传输方式、不影响输出文件的参数（共享存储的键忽略这些参数）
+TRANSFER_OPTIONS = ("-N", "--http-chunk-size", "--buffer-size", "--downloader", "--downloader-args")
+
+def _valid_profile_value(field, value):
+    if value is None:
+        return True
+    if field == 'concurrent_fragments':
+        return isinstance(value, int) and 1 <= value <= 32
+    if field in ('http_chunk_size', 'buffer_size'):
+        return isinstance(value, str) and re.match(r'^\d+(\.\d+)?[KMG]?$', value, re.IGNORECASE) is not None
+    return isinstance(value, str) and bool(value.strip())
+
+def load_download_profiles(raw):
+    """合并默认配置与 DOWNLOAD_PROFILES 中的覆盖项，无效项记录警告后忽略"""
+    profiles = {quality: dict.fromkeys(PROFILE_FIELDS) | profile
+                for quality, profile in DEFAULT_DOWNLOAD_PROFILES.items()}
+    if not raw:
+        return profiles
+    try:
+        overrides = json.loads(raw)
+    except ValueError:
+        logging.getLogger(__name__).warning("DOWNLOAD_PROFILES 不是有效的 JSON，使用默认配置")
+        return profiles
+    for quality, override in (overrides or {}).items():
+        if quality not in profiles or not isinstance(override, dict):
+            logging.getLogger(__name__).warning(f"忽略未知画质的下载配置: {quality}")
+            continue
+        for field, value in override.items():
+            if field in PROFILE_FIELDS and _valid_profile_value(field, value):
+                profiles[quality][field] = value
+            else:
+                logging.getLogger(__name__).warning(f"忽略无效的下载配置 {quality}.{field}={value!r}")
+    return profiles
+
+download_profiles = load_download_profiles(config.DOWNLOAD_PROFILES)
+
+# 外部下载器的查找结果缓存一段时间：每个任务和每次状态轮询都会用到，无需每次遍历 PATH
+DOWNLOADER_CHECK_TTL = 300
+_downloader_paths = {}
+
+def downloader_path(name):
+    now = time.monotonic()
+    cached = _downloader_paths.get(name)
+    if cached is None or cached[0] < now:
+        cached = (now + DOWNLOADER_CHECK_TTL, shutil.which(name))
+        _downloader_paths[name] = cached
+    return cached[1]
+
+def download_profile_options(quality):
+    """返回 (yt-dlp 参数列表, 实际生效的配置)；外部下载器不存在时回退到内置下载器"""
+    profile = dict(download_profiles.get(quality, download_profiles['1080p']))
+    options = []
+    if profile['concurrent_fragments'] and profile['concurrent_fragments'] > 1:
+        options.extend(["-N", str(profile['concurrent_fragments'])])
+    if profile['http_chunk_size']:
+        options.extend(["--http-chunk-size", profile['http_chunk_size']])
+    if profile['buffer_size']:
+        options.extend(["--buffer-size", profile['buffer_size']])
+    downloader = profile['external_downloader']
+    if downloader and downloader_path(downloader):
+        options.extend(["--downloader", downloader])
+        if profile['external_downloader_args']:
+            options.extend(["--downloader-args", f"{downloader}:{profile['external_downloader_args']}"])
+    else:
+        profile['external_downloader'] = None
+    return options, profile
+
+def download_profiles_status():
+    """状态接口展示的配置，包括外部下载器是否可用"""
+    return {
+        quality: dict(profile, external_downloader_available=(
+            bool(profile['external_downloader']) and downloader_path(profile['external_downloader']) is not None
+        ))
+        for quality, profile in download_profiles.items()
+    }
+
 # 创建 Flask 应用
 app = Flask(__name__)
 app.config.from_object(config)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE,
+                    message_queue=config.SOCKETIO_MESSAGE_QUEUE or None)
 
 # 配置日志
 logging.basicConfig(
@@ -147,17 +446,1192 @@ def validate_url(url):
     ]
     return any(re.match(pattern, url) for pattern in youtube_patterns)
 
+def extract_video_id(url):
+    """从单个视频链接中提取视频ID，播放列表/频道链接返回 None"""
+    video_patterns = [
+        r'https?://(?:www\.)?youtube\.com/watch\?(?:.*&)?v=([\w-]{11})',
+        r'https?://(?:www\.)?youtube\.com/shorts/([\w-]{11})',
+        r'https?://youtu\.be/([\w-]{11})',
+    ]
+    for pattern in video_patterns:
+        match = re.match(pattern, url or '')
+        if match:
+            return match.group(1)
+    return None
+
+def is_collection_url(url):
+    """播放列表、频道或 @handle 链接"""
+    collection_patterns = [
+        r'https?://(?:www\.)?youtube\.com/playlist\?list=[\w-]+',
+        r'https?://(?:www\.)?youtube\.com/channel/[\w-]+',
+        r'https?://(?:www\.)?youtube\.com/@[\w-]+',
+    ]
+    return any(re.match(pattern, url or '') for pattern in collection_patterns)
+
+def parse_playlist_options(data):
+    """🔧 校验播放列表参数：条目上限、序号范围、日期范围（YYYYMMDD）
+    
+    返回 (是否有效, 选项字典或错误消息)
+    """
+    data = data or {}
+    try:
+        max_entries = int(data.get('max_entries') or config.PLAYLIST_DEFAULT_ENTRIES)
+        start = int(data.get('start') or 1)
+        end = int(data['end']) if data.get('end') else None
+    except (TypeError, ValueError):
+        return False, "播放列表参数格式错误"
+    
+    if max_entries < 1 or start < 1 or (end is not None and end < start):
+        return False, "播放列表范围无效"
+    
+    options = {
+        "max_entries": min(max_entries, config.PLAYLIST_MAX_ENTRIES),
+        "start": start,
+        "end": end
+    }
+    for key in ('date_after', 'date_before'):
+        value = str(data.get(key) or '').replace('-', '')
+        if value and not re.match(r'^\d{8}$', value):
+            return False, "日期格式应为 YYYYMMDD"
+        options[key] = value or None
+    return True, options
+
+# 🔧 Prometheus 文本格式指标（无额外依赖）
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class MetricCounter:
+    def __init__(self, name, documentation, labels=()):
+        self.name, self.documentation, self.labels = name, documentation, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+class MetricGauge:
+    """可手动增减，也可以在抓取时通过 callback 读取当前值"""
+    def __init__(self, name, documentation, callback=None):
+        self.name, self.documentation = name, documentation
+        self.callback = callback
+        self._value = 0
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+    
+    def dec(self, amount=1):
+        self.inc(-amount)
+    
+    def render(self):
+        value = self.callback() if self.callback else self._value
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {value}"]
+
+class MetricHistogram:
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.name, self.documentation, self.labels = name, documentation, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # labels -> [各桶计数..., 总和, 总数]
+        self._lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            series = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {round(series[-2], 6)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                app.logger.error(f"Failed to render metric {metric.name}: {str(e)}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+PHASE_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(0, 14, 2))  # 1MB ~ 4GB
+
+metric_download_duration = metrics.register(MetricHistogram(
+    'ytdl_download_duration_seconds', '单个下载任务从开始执行到结束的耗时', DURATION_BUCKETS, ('quality', 'result')))
+metric_download_bytes = metrics.register(MetricHistogram(
+    'ytdl_download_bytes', '单个下载任务产出的文件字节数', BYTES_BUCKETS, ('quality',)))
+metric_phase_duration = metrics.register(MetricHistogram(
+    'ytdl_phase_duration_seconds', '下载各阶段耗时：extraction / transfer / postprocess', PHASE_BUCKETS, ('phase',)))
+metric_download_errors = metrics.register(MetricCounter(
+    'ytdl_download_errors_total', '按错误类型统计的下载失败次数', ('error_type',)))
+metric_socketio_emits = metrics.register(MetricCounter(
+    'ytdl_socketio_emits_total', 'Socket.IO 推送次数', ('event',)))
+metric_socketio_merged = metrics.register(MetricCounter(
+    'ytdl_socketio_merged_total', '被合并进同一批次推送的事件数', ('kind',)))
+metric_socketio_dropped = metrics.register(MetricCounter(
+    'ytdl_socketio_dropped_total', '因超出批次上限被丢弃的事件数', ('kind',)))
+metric_cleanup_duration = metrics.register(MetricHistogram(
+    'ytdl_cleanup_duration_seconds', '会话清理任务耗时', PHASE_BUCKETS))
+metric_active_subprocesses = metrics.register(MetricGauge(
+    'ytdl_active_subprocesses', '正在运行的 yt-dlp 子进程数'))
+metric_job_cpu = metrics.register(MetricHistogram(
+    'ytdl_job_cpu_seconds', '单个下载任务（含 ffmpeg）消耗的 CPU 时间', PHASE_BUCKETS, ('quality',)))
+metric_job_rss = metrics.register(MetricHistogram(
+    'ytdl_job_peak_rss_bytes', '单个下载任务子进程的峰值常驻内存', BYTES_BUCKETS, ('quality',)))
+
+def emit_event(event, data, room=None):
+    """带计数的 Socket.IO 推送"""
+    metric_socketio_emits.inc(event=event)
+    socketio.emit(event, data, room=room)
+
+class RoomOutbox:
+    """单个房间的待推送内容：日志行、合并后的进度、其他事件"""
+    
+    def __init__(self, snapshot_logs):
+        self.logs = []
+        self.events = []
+        self.progress = None  # 待推送的最新进度（多次更新只保留最后一次）
+        self.sent_progress = {}  # 客户端已知的进度状态，用于计算增量
+        self.recent_logs = collections.deque(maxlen=snapshot_logs)
+        self.seq = 0
+    
+    def pending(self):
+        return bool(self.logs or self.events or self.progress is not None)
+
+class SocketOutbox:
+    """🔧 Socket.IO 出站缓冲
+    
+    下载线程只把日志/进度写入所在房间的缓冲区，由单个后台任务按
+    SOCKETIO_FLUSH_INTERVAL 合并成一条 batch 事件推送：日志按批发送，
+    进度只发送相对上次推送变化的字段。重连的客户端收到一条 snapshot，
+    而不是逐条重放历史事件。
+    """
+    
+    def __init__(self, flush_interval, max_batch, snapshot_logs):
+        self.flush_interval = max(0.01, flush_interval)
+        self.max_batch = max(1, max_batch)
+        self.snapshot_logs = max(0, snapshot_logs)
+        self._rooms = {}
+        self._lock = threading.Lock()
+        self._started = False
+    
+    def _room(self, room):
+        outbox = self._rooms.get(room)
+        if outbox is None:
+            outbox = self._rooms[room] = RoomOutbox(self.snapshot_logs)
+        return outbox
+    
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._flush_loop)
+    
+    def log(self, room, message):
+        self._ensure_started()
+        with self._lock:
+            outbox = self._room(room)
+            outbox.recent_logs.append(message)
+            outbox.logs.append(message)
+            if len(outbox.logs) > self.max_batch:
+                overflow = len(outbox.logs) - self.max_batch
+                del outbox.logs[:overflow]
+                metric_socketio_dropped.inc(overflow, kind='log')
+    
+    def progress(self, room, progress):
+        self._ensure_started()
+        with self._lock:
+            outbox = self._room(room)
+            if outbox.progress is not None:
+                metric_socketio_merged.inc(kind='progress')
+            outbox.progress = dict(progress)
+    
+    def event(self, room, event, data):
+        """其他低频事件随下一批次一起送达，保持与日志的相对顺序"""
+        self._ensure_started()
+        with self._lock:
+            self._room(room).events.append({'event': event, 'data': data})
+    
+    def snapshot(self, room):
+        """重连时的完整状态：截至 seq 已推送的最近日志 + 当前进度
+        
+        尚未推送的日志会随 seq + 1 的批次送达，不放入快照，避免客户端重复显示。
+        """
+        with self._lock:
+            outbox = self._rooms.get(room)
+            if outbox is None:
+                return {'logs': [], 'progress': None, 'seq': 0}
+            progress = dict(outbox.sent_progress)
+            if outbox.progress is not None:
+                progress.update(outbox.progress)
+            logs = list(outbox.recent_logs)
+            logs = logs[:max(0, len(logs) - len(outbox.logs))]
+            return {'logs': logs, 'progress': progress or None, 'seq': outbox.seq}
+    
+    def drop_room(self, room):
+        with self._lock:
+            self._rooms.pop(room, None)
+    
+    def _collect(self):
+        batches = []
+        with self._lock:
+            for room, outbox in self._rooms.items():
+                if not outbox.pending():
+                    continue
+                payload = {}
+                if outbox.logs:
+                    payload['logs'] = outbox.logs
+                    if len(outbox.logs) > 1:
+                        metric_socketio_merged.inc(len(outbox.logs) - 1, kind='log')
+                    outbox.logs = []
+                if outbox.progress is not None:
+                    delta = {key: value for key, value in outbox.progress.items()
+                             if outbox.sent_progress.get(key) != value}
+                    removed = [key for key in outbox.sent_progress if key not in outbox.progress]
+                    outbox.sent_progress = outbox.progress
+                    outbox.progress = None
+                    if delta or removed:
+                        payload['progress'] = delta
+                        if removed:
+                            payload['removed'] = removed
+                if outbox.events:
+                    payload['events'] = outbox.events
+                    outbox.events = []
+                if payload:
+                    outbox.seq += 1
+                    payload['seq'] = outbox.seq
+                    batches.append((room, payload))
+        return batches
+    
+    def flush(self):
+        for room, payload in self._collect():
+            try:
+                emit_event('batch', payload, room=room)
+            except Exception as e:
+                app.logger.error(f"Socket batch emit failed for {room}: {str(e)}")
+    
+    def _flush_loop(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            self.flush()
+
+socket_outbox = SocketOutbox(config.SOCKETIO_FLUSH_INTERVAL, config.SOCKETIO_MAX_BATCH,
+                             config.SOCKETIO_SNAPSHOT_LOGS)
+
+OUTPUT_CONTAINERS = ('mp4', 'webm', 'mkv')
+
+def parse_output_options(data):
+    """🔧 校验输出参数：container 为首选封装格式，transcode 为 true 时才允许转码
+    
+    返回 (是否有效, 选项字典或错误消息)
+    """
+    data = data or {}
+    container = data.get('container') or None
+    if container is not None and container not in OUTPUT_CONTAINERS:
+        return False, f"不支持的封装格式: {container}"
+    transcode = bool(data.get('transcode'))
+    if transcode and not container:
+        return False, "转码需要指定目标封装格式"
+    return True, {"container": container, "transcode": transcode}
+
+# 🔧 会话 / 任务持久化仓库
+class SessionRepository:
+    """会话与任务记录的存储接口，记录均为可 JSON 序列化的字典
+    
+    会话记录: session_id, created_at, last_activity, download_count
+    任务记录: job_id, session_id, state, updated_at 以及其他任意字段
+    """
+    def get_session(self, session_id):
+        raise NotImplementedError
+    
+    def save_session(self, record):
+        raise NotImplementedError
+    
+    def delete_session(self, session_id):
+        raise NotImplementedError
+    
+    def expired_sessions(self, cutoff):
+        """返回 last_activity 早于 cutoff（时间戳）的会话ID"""
+        raise NotImplementedError
+    
+    def get_job(self, job_id):
+        raise NotImplementedError
+    
+    def save_job(self, record):
+        raise NotImplementedError
+    
+    def list_jobs(self, session_id=None, states=None, limit=100):
+        """按更新时间倒序返回任务记录"""
+        raise NotImplementedError
+    
+    def delete_jobs(self, session_id):
+        raise NotImplementedError
+    
+    def claim_job(self, job_id, expected_owner, new_owner):
+        """原子地将任务归属从 expected_owner 转给 new_owner，成功返回 True"""
+        raise NotImplementedError
+    
+    def catalog_version(self, session_id):
+        """会话文件目录的版本号，尚未建立目录时返回 None"""
+        raise NotImplementedError
+    
+    def list_files(self, session_id):
+        raise NotImplementedError
+    
+    def get_file(self, session_id, file_id):
+        raise NotImplementedError
+    
+    def save_files(self, session_id, records):
+        """写入文件记录（可为空列表以初始化目录）并递增版本号"""
+        raise NotImplementedError
+    
+    def delete_files(self, session_id, file_ids=None):
+        """删除指定文件记录并递增版本号；file_ids 为 None 时删除整个目录"""
+        raise NotImplementedError
+    
+    def touch_file(self, session_id, file_id, timestamp):
+        """更新文件的最近访问时间（不改变目录版本号）"""
+        raise NotImplementedError
+    
+    def storage_usage(self, session_id=None):
+        """已登记文件的总字节数；session_id 为 None 时统计全部会话"""
+        raise NotImplementedError
+    
+    def lru_files(self, limit, session_id=None):
+        """按最近访问时间升序返回 [(session_id, 文件记录)]"""
+        raise NotImplementedError
+    
+    def get_subscription(self, subscription_id):
+        raise NotImplementedError
+    
+    def save_subscription(self, record):
+        """订阅记录: subscription_id, session_id, url, created_at, last_sync_at, last_diff"""
+        raise NotImplementedError
+    
+    def list_subscriptions(self, session_id):
+        raise NotImplementedError
+    
+    def delete_subscriptions(self, session_id):
+        """删除会话的全部订阅及其下载存档"""
+        raise NotImplementedError
+    
+    def archived_ids(self, subscription_id, video_ids):
+        """返回 video_ids 中已在订阅存档里的视频ID集合"""
+        raise NotImplementedError
+    
+    def add_to_archive(self, subscription_id, video_id, timestamp):
+        raise NotImplementedError
+    
+    def archive_size(self, subscription_id):
+        raise NotImplementedError
+    
+    def save_worker_heartbeat(self, worker_id, timestamp):
+        raise NotImplementedError
+    
+    def worker_heartbeats(self):
+        """返回 {worker_id: 最近心跳时间戳}"""
+        raise NotImplementedError
+
+class SQLiteSessionRepository(SessionRepository):
+    """默认实现：单机多 worker 共享一个 SQLite 文件"""
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                last_activity REAL NOT NULL,
+                download_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_activity ON sessions (last_activity);
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs (session_id, updated_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state);
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                heartbeat_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                session_id TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (session_id, file_id)
+            );
+            CREATE TABLE IF NOT EXISTS catalog_versions (
+                session_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                subscription_id TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_subscriptions_session ON subscriptions (session_id);
+            CREATE TABLE IF NOT EXISTS archive (
+                subscription_id TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                archived_at REAL NOT NULL,
+                PRIMARY KEY (subscription_id, video_id)
+            );
+        """)
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'owner' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(files)")}
+        if 'size' not in columns:
+            conn.execute("ALTER TABLE files ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE files ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+            conn.execute("UPDATE files SET size = json_extract(data, '$.size'), "
+                         "accessed_at = json_extract(data, '$.modified')")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_files_lru ON files (accessed_at)")
+        conn.commit()
+    
+    def _conn(self):
+        """每个线程一个连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+    
+    def get_session(self, session_id):
+        row = self._conn().execute(
+            "SELECT * FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return dict(row) if row else None
+    
+    def save_session(self, record):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, created_at, last_activity, download_count) "
+            "VALUES (:session_id, :created_at, :last_activity, :download_count)",
+            record
+        )
+        conn.commit()
+    
+    def delete_session(self, session_id):
+        conn = self._conn()
+        conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        conn.commit()
+    
+    def expired_sessions(self, cutoff):
+        rows = self._conn().execute(
+            "SELECT session_id FROM sessions WHERE last_activity < ?", (cutoff,)
+        ).fetchall()
+        return [row['session_id'] for row in rows]
+    
+    def get_job(self, job_id):
+        row = self._conn().execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+    
+    def save_job(self, record):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, session_id, state, updated_at, data, owner) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (record['job_id'], record['session_id'], record['state'], record['updated_at'],
+             json.dumps(record, ensure_ascii=False), record.get('owner'))
+        )
+        conn.commit()
+    
+    def list_jobs(self, session_id=None, states=None, limit=100):
+        query = "SELECT data FROM jobs WHERE 1=1"
+        params = []
+        if session_id:
+            query += " AND session_id = ?"
+            params.append(session_id)
+        if states:
+            query += f" AND state IN ({','.join('?' * len(states))})"
+            params.extend(states)
+        query += " ORDER BY updated_at DESC LIMIT ?"
+        params.append(limit)
+        return [json.loads(row['data']) for row in self._conn().execute(query, params)]
+    
+    def delete_jobs(self, session_id):
+        conn = self._conn()
+        conn.execute("DELETE FROM jobs WHERE session_id = ?", (session_id,))
+        conn.commit()
+    
+    def claim_job(self, job_id, expected_owner, new_owner):
+        conn = self._conn()
+        cursor = conn.execute(
+            "UPDATE jobs SET owner = ? WHERE job_id = ? AND owner IS ?",
+            (new_owner, job_id, expected_owner)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+    
+    def get_subscription(self, subscription_id):
+        row = self._conn().execute(
+            "SELECT data FROM subscriptions WHERE subscription_id = ?", (subscription_id,)
+        ).fetchone()
+        return json.loads(row['data']) if row else None
+    
+    def save_subscription(self, record):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO subscriptions (subscription_id, session_id, data) VALUES (?, ?, ?)",
+            (record['subscription_id'], record['session_id'], json.dumps(record, ensure_ascii=False))
+        )
+        conn.commit()
+    
+    def list_subscriptions(self, session_id):
+        rows = self._conn().execute("SELECT data FROM subscriptions WHERE session_id = ?", (session_id,))
+        return [json.loads(row['data']) for row in rows]
+    
+    def delete_subscriptions(self, session_id):
+        conn = self._conn()
+        conn.execute(
+            "DELETE FROM archive WHERE subscription_id IN "
+            "(SELECT subscription_id FROM subscriptions WHERE session_id = ?)",
+            (session_id,)
+        )
+        conn.execute("DELETE FROM subscriptions WHERE session_id = ?", (session_id,))
+        conn.commit()
+    
+    def archived_ids(self, subscription_id, video_ids):
+        video_ids = list(video_ids)
+        if not video_ids:
+            return set()
+        rows = self._conn().execute(
+            f"SELECT video_id FROM archive WHERE subscription_id = ? "
+            f"AND video_id IN ({','.join('?' * len(video_ids))})",
+            [subscription_id] + video_ids
+        )
+        return {row['video_id'] for row in rows}
+    
+    def add_to_archive(self, subscription_id, video_id, timestamp):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR IGNORE INTO archive (subscription_id, video_id, archived_at) VALUES (?, ?, ?)",
+            (subscription_id, video_id, timestamp)
+        )
+        conn.commit()
+    
+    def archive_size(self, subscription_id):
+        row = self._conn().execute(
+            "SELECT COUNT(*) AS n FROM archive WHERE subscription_id = ?", (subscription_id,)
+        ).fetchone()
+        return row['n']
+    
+    def save_worker_heartbeat(self, worker_id, timestamp):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO workers (worker_id, heartbeat_at) VALUES (?, ?)",
+            (worker_id, timestamp)
+        )
+        conn.commit()
+    
+    def worker_heartbeats(self):
+        rows = self._conn().execute("SELECT worker_id, heartbeat_at FROM workers").fetchall()
+        return {row['worker_id']: row['heartbeat_at'] for row in rows}
+    
+    def catalog_version(self, session_id):
+        row = self._conn().execute(
+            "SELECT version FROM catalog_versions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row['version'] if row else None
+    
+    def list_files(self, session_id):
+        rows = self._conn().execute("SELECT data FROM files WHERE session_id = ?", (session_id,))
+        return [json.loads(row['data']) for row in rows]
+    
+    def get_file(self, session_id, file_id):
+        row = self._conn().execute(
+            "SELECT data FROM files WHERE session_id = ? AND file_id = ?", (session_id, file_id)
+        ).fetchone()
+        return json.loads(row['data']) if row else None
+    
+    def _bump_version(self, conn, session_id):
+        conn.execute(
+            "INSERT INTO catalog_versions (session_id, version) VALUES (?, 1) "
+            "ON CONFLICT(session_id) DO UPDATE SET version = version + 1",
+            (session_id,)
+        )
+    
+    def save_files(self, session_id, records):
+        conn = self._conn()
+        conn.executemany(
+            "INSERT OR REPLACE INTO files (session_id, file_id, data, size, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            [(session_id, record['file_id'], json.dumps(record, ensure_ascii=False),
+              record.get('size', 0), record.get('modified', time.time())) for record in records]
+        )
+        self._bump_version(conn, session_id)
+        conn.commit()
+    
+    def delete_files(self, session_id, file_ids=None):
+        conn = self._conn()
+        if file_ids is None:
+            conn.execute("DELETE FROM files WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM catalog_versions WHERE session_id = ?", (session_id,))
+        else:
+            conn.executemany(
+                "DELETE FROM files WHERE session_id = ? AND file_id = ?",
+                [(session_id, file_id) for file_id in file_ids]
+            )
+            self._bump_version(conn, session_id)
+        conn.commit()
+    
+    def touch_file(self, session_id, file_id, timestamp):
+        conn = self._conn()
+        conn.execute(
+            "UPDATE files SET accessed_at = ? WHERE session_id = ? AND file_id = ?",
+            (timestamp, session_id, file_id)
+        )
+        conn.commit()
+    
+    def storage_usage(self, session_id=None):
+        if session_id:
+            row = self._conn().execute(
+                "SELECT COALESCE(SUM(size), 0) AS total FROM files WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        else:
+            row = self._conn().execute("SELECT COALESCE(SUM(size), 0) AS total FROM files").fetchone()
+        return row['total']
+    
+    def lru_files(self, limit, session_id=None):
+        query = "SELECT session_id, data FROM files"
+        params = []
+        if session_id:
+            query += " WHERE session_id = ?"
+            params.append(session_id)
+        query += " ORDER BY accessed_at LIMIT ?"
+        params.append(limit)
+        return [(row['session_id'], json.loads(row['data'])) for row in self._conn().execute(query, params)]
+
+class RedisSessionRepository(SessionRepository):
+    """Redis 实现，适用于多主机部署
+    
+    只使用 GET/SET/DEL、有序集合和集合命令，任何兼容 Redis 协议的客户端
+    （包括测试用的本地替身）都可以通过 client 参数传入。
+    """
+    def __init__(self, client, prefix='ytdl:'):
+        self.client = client
+        self.prefix = prefix
+    
+    def _key(self, *parts):
+        return self.prefix + ':'.join(parts)
+    
+    @staticmethod
+    def _load(value):
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return json.loads(value)
+    
+    @staticmethod
+    def _text(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+    
+    def get_session(self, session_id):
+        return self._load(self.client.get(self._key('session', session_id)))
+    
+    def save_session(self, record):
+        self.client.set(self._key('session', record['session_id']), json.dumps(record))
+        self.client.zadd(self._key('sessions'), {record['session_id']: record['last_activity']})
+    
+    def delete_session(self, session_id):
+        self.client.delete(self._key('session', session_id))
+        self.client.zrem(self._key('sessions'), session_id)
+    
+    def expired_sessions(self, cutoff):
+        members = self.client.zrangebyscore(self._key('sessions'), '-inf', f"({cutoff}")
+        return [self._text(member) for member in members]
+    
+    def get_job(self, job_id):
+        return self._load(self.client.get(self._key('job', job_id)))
+    
+    def save_job(self, record):
+        job_id, session_id = record['job_id'], record['session_id']
+        previous = self.get_job(job_id)
+        if previous and previous['state'] != record['state']:
+            self.client.srem(self._key('jobs', 'state', previous['state']), job_id)
+        self.client.set(self._key('job', job_id), json.dumps(record, ensure_ascii=False))
+        self.client.zadd(self._key('jobs', 'session', session_id), {job_id: record['updated_at']})
+        self.client.sadd(self._key('jobs', 'state', record['state']), job_id)
+    
+    def list_jobs(self, session_id=None, states=None, limit=100):
+        if session_id:
+            job_ids = [self._text(j) for j in self.client.zrange(self._key('jobs', 'session', session_id), 0, -1)]
+        else:
+            job_ids = set()
+            for state in states or ():
+                job_ids.update(self._text(j) for j in self.client.smembers(self._key('jobs', 'state', state)))
+        jobs = [job for job in (self.get_job(job_id) for job_id in job_ids) if job]
+        if states:
+            jobs = [job for job in jobs if job['state'] in states]
+        jobs.sort(key=lambda job: job['updated_at'], reverse=True)
+        return jobs[:limit]
+    
+    def delete_jobs(self, session_id):
+        session_key = self._key('jobs', 'session', session_id)
+        for job_id in self.client.zrange(session_key, 0, -1):
+            job_id = self._text(job_id)
+            job = self.get_job(job_id)
+            if job:
+                self.client.srem(self._key('jobs', 'state', job['state']), job_id)
+            self.client.delete(self._key('job', job_id))
+        self.client.delete(session_key)
+    
+    def claim_job(self, job_id, expected_owner, new_owner):
+        claim_key = self._key('claim', job_id, str(expected_owner))
+        return bool(self.client.set(claim_key, new_owner, nx=True, ex=86400))
+    
+    def get_subscription(self, subscription_id):
+        return self._load(self.client.get(self._key('subscription', subscription_id)))
+    
+    def save_subscription(self, record):
+        self.client.set(self._key('subscription', record['subscription_id']),
+                        json.dumps(record, ensure_ascii=False))
+        self.client.sadd(self._key('subscriptions', record['session_id']), record['subscription_id'])
+    
+    def list_subscriptions(self, session_id):
+        subscription_ids = self.client.smembers(self._key('subscriptions', session_id))
+        records = (self.get_subscription(self._text(sub_id)) for sub_id in subscription_ids)
+        return [record for record in records if record]
+    
+    def delete_subscriptions(self, session_id):
+        index_key = self._key('subscriptions', session_id)
+        for subscription_id in self.client.smembers(index_key):
+            subscription_id = self._text(subscription_id)
+            self.client.delete(self._key('subscription', subscription_id),
+                               self._key('archive', subscription_id))
+        self.client.delete(index_key)
+    
+    def archived_ids(self, subscription_id, video_ids):
+        video_ids = list(video_ids)
+        if not video_ids:
+            return set()
+        flags = self.client.smismember(self._key('archive', subscription_id), video_ids)
+        return {video_id for video_id, flag in zip(video_ids, flags) if flag}
+    
+    def add_to_archive(self, subscription_id, video_id, timestamp):
+        self.client.sadd(self._key('archive', subscription_id), video_id)
+    
+    def archive_size(self, subscription_id):
+        return self.client.scard(self._key('archive', subscription_id))
+    
+    def save_worker_heartbeat(self, worker_id, timestamp):
+        self.client.hset(self._key('workers'), worker_id, timestamp)
+    
+    def worker_heartbeats(self):
+        return {
+            self._text(worker_id): float(timestamp)
+            for worker_id, timestamp in self.client.hgetall(self._key('workers')).items()
+        }
+    
+    def catalog_version(self, session_id):
+        version = self.client.get(self._key('catalog_version', session_id))
+        return int(version) if version is not None else None
+    
+    def list_files(self, session_id):
+        return [self._load(value) for value in self.client.hvals(self._key('files', session_id))]
+    
+    def get_file(self, session_id, file_id):
+        return self._load(self.client.hget(self._key('files', session_id), file_id))
+    
+    def _adjust_usage(self, session_id, delta):
+        if delta:
+            self.client.hincrby(self._key('usage'), session_id, delta)
+            self.client.incrby(self._key('usage_total'), delta)
+    
+    def save_files(self, session_id, records):
+        files_key = self._key('files', session_id)
+        for record in records:
+            previous = self._load(self.client.hget(files_key, record['file_id']))
+            self.client.hset(files_key, record['file_id'], json.dumps(record, ensure_ascii=False))
+            self._adjust_usage(session_id, record.get('size', 0) - (previous or {}).get('size', 0))
+            accessed_at = record.get('modified', time.time())
+            self.client.zadd(self._key('files_lru'), {f"{session_id}/{record['file_id']}": accessed_at})
+            self.client.zadd(self._key('files_lru', session_id), {record['file_id']: accessed_at})
+        self.client.incr(self._key('catalog_version', session_id))
+    
+    def delete_files(self, session_id, file_ids=None):
+        files_key = self._key('files', session_id)
+        if file_ids is None:
+            file_ids = [self._text(file_id) for file_id in self.client.hkeys(files_key)]
+            drop_catalog = True
+        else:
+            drop_catalog = False
+        if file_ids:
+            previous = [self._load(value) for value in self.client.hmget(files_key, file_ids)]
+            self._adjust_usage(session_id, -sum(record.get('size', 0) for record in previous if record))
+            self.client.zrem(self._key('files_lru'), *[f"{session_id}/{file_id}" for file_id in file_ids])
+            self.client.zrem(self._key('files_lru', session_id), *file_ids)
+            self.client.hdel(files_key, *file_ids)
+        if drop_catalog:
+            self.client.delete(files_key, self._key('catalog_version', session_id),
+                               self._key('files_lru', session_id))
+            self.client.hdel(self._key('usage'), session_id)
+        else:
+            self.client.incr(self._key('catalog_version', session_id))
+    
+    def touch_file(self, session_id, file_id, timestamp):
+        self.client.zadd(self._key('files_lru'), {f"{session_id}/{file_id}": timestamp}, xx=True)
+        self.client.zadd(self._key('files_lru', session_id), {file_id: timestamp}, xx=True)
+    
+    def storage_usage(self, session_id=None):
+        if session_id:
+            value = self.client.hget(self._key('usage'), session_id)
+        else:
+            value = self.client.get(self._key('usage_total'))
+        return int(value or 0)
+    
+    def lru_files(self, limit, session_id=None):
+        if session_id:
+            members = self.client.zrange(self._key('files_lru', session_id), 0, limit - 1)
+            entries = [(session_id, self._text(member)) for member in members]
+        else:
+            members = self.client.zrange(self._key('files_lru'), 0, limit - 1)
+            entries = [tuple(self._text(member).split('/', 1)) for member in members]
+        records = ((owner, self.get_file(owner, file_id)) for owner, file_id in entries)
+        return [(owner, record) for owner, record in records if record]
+
+def create_session_repository(store_url):
+    """根据 SESSION_STORE_URL 创建存储实现"""
+    if store_url.startswith(('redis://', 'rediss://', 'unix://')):
+        if redis is None:
+            raise RuntimeError("SESSION_STORE_URL 指向 Redis，但未安装 redis 包")
+        return RedisSessionRepository(redis.Redis.from_url(store_url))
+    if store_url.startswith('sqlite:///'):
+        return SQLiteSessionRepository(store_url[len('sqlite:///'):])
+    raise ValueError(f"不支持的 SESSION_STORE_URL: {store_url}")
+
+session_repo = create_session_repository(config.SESSION_STORE_URL)
+
+# 当前进程的唯一标识，用于任务归属和心跳
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+# 🔧 会话文件目录索引
+class FileCatalog:
+    """维护每个会话已完成文件的索引，避免每次请求都遍历目录和 stat
+    
+    文件在任务完成时登记，在清理时注销；列表请求只读取索引。
+    """
+    def __init__(self, repo):
+        self.repo = repo
+    
+    @staticmethod
+    def file_id_for(session_id, name):
+        """稳定的文件ID，同一会话同名文件始终相同"""
+        return hashlib.sha1(f"{session_id}/{name}".encode('utf-8')).hexdigest()[:16]
+    
+    def _record(self, session_id, file_path, stored=None):
+        stat = file_path.stat()
+        record = {
+            "file_id": self.file_id_for(session_id, file_path.name),
+            "name": file_path.name,
+            "size": stat.st_size,
+            "modified": stat.st_mtime
+        }
+        if stored:
+            record["stored"] = stored  # 对应的共享存储文件（键/文件名），淘汰时一并回收
+        return record
+    
+    def register(self, session_id, file_paths, stored=None):
+        """任务完成时登记新文件；stored 为硬链接来源的共享存储文件列表"""
+        stored = {path.name: f"{path.parent.name}/{path.name}" for path in stored or []}
+        records = [self._record(session_id, path, stored.get(path.name)) for path in file_paths if path.is_file()]
+        if records:
+            self.ensure(session_id, file_paths[0].parent)
+            self.repo.save_files(session_id, records)
+    
+    def ensure(self, session_id, download_dir):
+        """目录尚未建立时（升级前的会话）扫描一次目录初始化"""
+        version = self.repo.catalog_version(session_id)
+        if version is not None:
+            return version
+        records = []
+        if download_dir.exists():
+            records = [
+                self._record(session_id, path) for path in download_dir.iterdir()
+                if path.is_file() and path.stat().st_size > 0
+            ]
+        self.repo.save_files(session_id, records)
+        return self.repo.catalog_version(session_id)
+    
+    def listing(self, session_id, download_dir):
+        """返回 (版本号, 文件记录列表)"""
+        version = self.ensure(session_id, download_dir)
+        return version, self.repo.list_files(session_id)
+    
+    def resolve(self, session_id, file_id):
+        return self.repo.get_file(session_id, file_id)
+    
+    def remove(self, session_id, names):
+        self.repo.delete_files(session_id, [self.file_id_for(session_id, name) for name in names])
+    
+    def drop(self, session_id):
+        self.repo.delete_files(session_id)
+
+file_catalog = FileCatalog(session_repo)
+
+# 🔧 磁盘配额与 LRU 淘汰
+QUALITY_SIZE_ESTIMATES = {
+    'best': 2 * 1024 ** 3,
+    '2160p': 2 * 1024 ** 3,
+    '1440p': 1024 ** 3,
+    '1080p': 500 * 1024 ** 2,
+    '720p': 250 * 1024 ** 2,
+    '480p': 120 * 1024 ** 2,
+    '360p': 80 * 1024 ** 2,
+    'compact_1080p': 300 * 1024 ** 2,
+    'compact_720p': 150 * 1024 ** 2,
+    'audio': 30 * 1024 ** 2,
+    'audio_opus': 30 * 1024 ** 2,
+    'audio_m4a': 30 * 1024 ** 2,
+    'audio_mp3': 40 * 1024 ** 2,
+}
+
+metric_evicted_files = metrics.register(MetricCounter(
+    'ytdl_storage_evicted_files_total', '因配额被淘汰的文件数', ('reason',)))
+metric_evicted_bytes = metrics.register(MetricCounter(
+    'ytdl_storage_evicted_bytes_total', '因配额被淘汰的字节数', ('reason',)))
+metric_admission_rejected = metrics.register(MetricCounter(
+    'ytdl_storage_admission_rejected_total', '因存储空间不足被拒绝的任务数', ('reason',)))
+
+class StorageManager:
+    """按会话和全局统计已下载字节数，准入前检查剩余空间，超过高水位时淘汰最久未访问的文件
+    
+    字节数和访问时间都来自文件目录索引（session_repo 的 files 表），不需要遍历目录树。
+    已准入但尚未完成的任务按预计大小预留空间，避免并发准入的任务合计超出限额。
+    """
+    def __init__(self, root, repo, catalog):
+        self.root = root
+        self.repo = repo
+        self.catalog = catalog
+        self._reserved = {}  # job_id -> (session_id, 预留字节数)
+        self._disk_stats = (0, None)  # (过期时间, 全局统计)，状态接口轮询频繁，短暂缓存
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def estimate_bytes(quality, info_key=None):
+        """优先使用已缓存视频信息中的格式大小，否则按画质的经验值"""
+        info = info_cache.get(info_key) if info_key else None
+        if info is not None:
+            estimate = estimate_quality(info, quality)
+            if estimate and estimate["bytes"]:
+                return estimate["bytes"]
+        return QUALITY_SIZE_ESTIMATES.get(quality, QUALITY_SIZE_ESTIMATES['1080p'])
+    
+    def _limits(self):
+        """返回 [(当前已用, 上限)]：磁盘容量，以及配置的全局配额"""
+        disk = shutil.disk_usage(self.root)
+        limits = [(disk.used, disk.total)]
+        if config.STORAGE_QUOTA_BYTES:
+            limits.append((self.repo.storage_usage(), config.STORAGE_QUOTA_BYTES))
+        return limits
+    
+    def _reserved_bytes(self, session_id=None):
+        return sum(size for owner, size in list(self._reserved.values()) if session_id in (None, owner))
+    
+    def _shortfall(self, needed, water):
+        reserved = self._reserved_bytes()
+        return max(int(used + reserved + needed - total * water) for used, total in self._limits())
+    
+    def admit(self, session_id, quality, info_key=None, job_id=None):
+        """🔧 任务开始前预留空间，返回 (是否允许, 原因)；指定 job_id 时保留预留直到 release"""
+        needed = self.estimate_bytes(quality, info_key)
+        with self._lock:
+            if config.SESSION_QUOTA_BYTES:
+                needed = min(needed, config.SESSION_QUOTA_BYTES)  # 估算值不应让任务永远无法准入
+                pending = self._reserved_bytes(session_id) + needed
+                over = self.repo.storage_usage(session_id) + pending - config.SESSION_QUOTA_BYTES
+                if over > 0:
+                    self.evict(over, session_id=session_id, reason="session_quota")
+                if self.repo.storage_usage(session_id) + pending > config.SESSION_QUOTA_BYTES:
+                    metric_admission_rejected.inc(reason="session_quota")
+                    return False, "会话存储空间已满，请先下载并清理已有文件"
+            
+            shortfall = self._shortfall(needed, config.STORAGE_HIGH_WATER)
+            if shortfall > 0:
+                # 一次淘汰到低水位，避免每个任务都触发淘汰
+                self.evict(self._shortfall(needed, config.STORAGE_LOW_WATER), reason="high_water")
+                if self._shortfall(needed, config.STORAGE_HIGH_WATER) > 0:
+                    metric_admission_rejected.inc(reason="disk")
+                    return False, "服务器存储空间不足，请稍后重试"
+            if job_id:
+                self._reserved[job_id] = (session_id, needed)
+        return True, ""
+    
+    def release(self, job_id):
+        """任务结束（成品已登记到文件目录或失败）后释放预留"""
+        with self._lock:
+            self._reserved.pop(job_id, None)
+    
+    def enforce(self):
+        """周期性检查：超过高水位时淘汰到低水位"""
+        with self._lock:
+            if self._shortfall(0, config.STORAGE_HIGH_WATER) > 0:
+                self.evict(self._shortfall(0, config.STORAGE_LOW_WATER), reason="high_water")
+    
+    def evict(self, bytes_needed, session_id=None, reason="high_water"):
+        """按最近访问时间从旧到新删除文件，直到释放 bytes_needed 字节，返回释放的字节数
+        
+        会话配额按目录索引计算；磁盘空间不足时只删除真正能回收空间的文件：
+        硬链接数为 2 的文件（会话 + 共享存储）按目录中记录的存储位置一并删除存储副本，
+        被其他会话共享或不知道存储位置的文件删除后不释放空间，跳过。
+        """
+        freed = 0
+        protect_after = time.time() - config.STORAGE_MIN_AGE
+        batch = 50
+        while freed < bytes_needed:
+            candidates = self.repo.lru_files(batch, session_id)
+            if not candidates:
+                break
+            progressed = False
+            for owner, record in candidates:
+                if record.get('modified', 0) > protect_after:
+                    continue  # 刚完成的文件留给用户下载
+                file_path = config.DOWNLOAD_DIR / f"session_{owner}" / record['name']
+                try:
+                    links = file_path.stat().st_nlink
+                    if reason != "session_quota" and (links > 2 or (links == 2 and not record.get('stored'))):
+                        continue  # 其他会话仍在引用，删除后不释放空间
+                    file_path.unlink()
+                    if reason != "session_quota" and links == 2:
+                        shared_store.discard(record['stored'])
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    app.logger.error(f"Failed to evict {file_path}: {str(e)}")
+                    continue
+                self.repo.delete_files(owner, [record['file_id']])
+                freed += record.get('size', 0)
+                progressed = True
+                metric_evicted_files.inc(reason=reason)
+                metric_evicted_bytes.inc(record.get('size', 0), reason=reason)
+                if freed >= bytes_needed:
+                    break
+            if not progressed:
+                if len(candidates) < batch:
+                    break
+                batch *= 2  # 本批都不可淘汰，扩大范围继续查找更新的文件
+        if freed:
+            app.logger.info(f"💾 存储淘汰 ({reason}): 释放 {freed / 1024 ** 2:.1f} MB")
+        return freed
+    
+    def touch(self, session_id, file_id):
+        try:
+            self.repo.touch_file(session_id, file_id, time.time())
+        except Exception as e:
+            app.logger.error(f"Failed to touch file {file_id}: {str(e)}")
+    
+    STATS_TTL = 5
+    
+    def stats(self, session_id=None):
+        expires_at, global_stats = self._disk_stats
+        if global_stats is None or expires_at < time.monotonic():
+            disk = shutil.disk_usage(self.root)
+            global_stats = {
+                "disk_total": disk.total,
+                "disk_free": disk.free,
+                "catalog_bytes": self.repo.storage_usage()
+            }
+            self._disk_stats = (time.monotonic() + self.STATS_TTL, global_stats)
+        result = dict(
+            global_stats,
+            reserved_bytes=self._reserved_bytes(),
+            quota_bytes=config.STORAGE_QUOTA_BYTES,
+            high_water=config.STORAGE_HIGH_WATER,
+            low_water=config.STORAGE_LOW_WATER
+        )
+        if session_id:
+            result["session_bytes"] = self.repo.storage_usage(session_id)
+            result["session_quota_bytes"] = config.SESSION_QUOTA_BYTES
+        return result
+
+storage_manager = StorageManager(config.DOWNLOAD_DIR, session_repo, file_catalog)
+metrics.register(MetricGauge('ytdl_storage_bytes', '文件目录中登记的总字节数',
+                             lambda: session_repo.storage_usage()))
+metrics.register(MetricGauge('ytdl_disk_free_bytes', '下载目录所在磁盘的剩余字节数',
+                             lambda: shutil.disk_usage(config.DOWNLOAD_DIR).free))
+
 # 用户会话类
 class UserSession:
-    def __init__(self, session_id):
+    def __init__(self, session_id, record=None):
         self.session_id = session_id
-        self.created_at = datetime.datetime.now()
-        self.last_activity = datetime.datetime.now()
+        record = record or {}
+        now = time.time()
+        self.created_at = datetime.datetime.fromtimestamp(record.get('created_at', now))
+        self.last_activity = datetime.datetime.fromtimestamp(record.get('last_activity', now))
+        self.download_count = record.get('download_count', 0)
         self.download_manager = None
         
     def update_activity(self):
-        """更新最后活动时间"""
-        self.last_activity = datetime.datetime.now()
+        """更新最后活动时间（持久化写入最多每分钟一次）"""
+        now = datetime.datetime.now()
+        should_persist = (now - self.last_activity).total_seconds() > 60
+        self.last_activity = now
+        if should_persist:
+            self.save()
+    
+    def to_record(self):
+        download_count = self.download_count
+        if self.download_manager:
+            download_count = self.download_manager.download_count
+        return {
+            "session_id": self.session_id,
+            "created_at": self.created_at.timestamp(),
+            "last_activity": self.last_activity.timestamp(),
+            "download_count": download_count
+        }
+    
+    def save(self):
+        try:
+            session_repo.save_session(self.to_record())
+        except Exception as e:
+            app.logger.error(f"Failed to persist session {self.session_id[:8]}: {str(e)}")
         
     def get_cookies_path(self):
         return config.UPLOAD_DIR / f"cookies_{self.session_id}.txt"
@@ -167,21 +1641,36 @@ class UserSession:
         download_dir.mkdir(exist_ok=True)
         return download_dir
 
-# 全局会话存储
+# 全局会话存储（本进程缓存，持久化记录在 session_repo 中）
 user_sessions = {}
 
+def load_session(session_id):
+    """🔧 按ID加载会话：先查本进程缓存，再查持久化存储（其他 worker 或重启前创建的会话）"""
+    if not session_id or not validate_session_id(session_id):
+        return None
+    session = user_sessions.get(session_id)
+    if session:
+        return session
+    record = session_repo.get_session(session_id)
+    if not record:
+        return None
+    session = user_sessions.setdefault(session_id, UserSession(session_id, record))
+    return session
+
 def get_or_create_session():
     """获取或创建用户会话"""
     session_id = request.headers.get('X-Session-ID')
     
     # 验证现有会话ID
-    if session_id and validate_session_id(session_id) and session_id in user_sessions:
-        user_sessions[session_id].update_activity()
-        return user_sessions[session_id], session_id
+    session = load_session(session_id)
+    if session:
+        session.update_activity()
+        return session, session_id
     
     # 创建新会话
     session_id = str(uuid.uuid4())
     user_sessions[session_id] = UserSession(session_id)
+    user_sessions[session_id].save()
     return user_sessions[session_id], session_id
 
 # Cookies 管理器
@@ -290,54 +1779,1731 @@ class CookiesManager:
         
         return False, f"✅ Cookies 状态良好（{age or 0} 天前上传）"
 
-# 下载管理器
-class DownloadManager:
-    def __init__(self, session_id):
-        self.session_id = session_id
-        self.room = f"session_{session_id}"
-        self.is_downloading = False
-        self.current_progress = {"current": 0, "total": 0, "status": "idle"}
-        self.cookies_manager = CookiesManager(session_id)
-        self.download_count = 0  # 下载计数
-        self.start_time = None
+def cookies_identity(cookies_file):
+    """cookies 文件内容的摘要，用于隔离不同账号下的提取结果；没有 cookies 时返回 None"""
+    if not cookies_file:
+        return None
+    try:
+        return hashlib.sha1(Path(cookies_file).read_bytes()).hexdigest()[:16]
+    except OSError:
+        return None
+
+# 🔧 FFmpeg 能力探测（启动时探测一次，之后读取缓存）
+class FFmpegCapabilities:
+    """缓存 FFmpeg 路径、版本及可用的编码器 / 封装格式"""
+    SEARCH_PATHS = [
+        'ffmpeg',  # 系统PATH中的ffmpeg
+        '/usr/bin/ffmpeg',  # 标准安装路径
+        '/usr/local/bin/ffmpeg',  # 自定义安装路径
+    ]
+    REFRESH_INTERVAL = 60  # 显式刷新的最小间隔（秒），每次刷新要启动多个 ffmpeg 子进程
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.path = None
+        self.version = None
+        self.encoders = frozenset()
+        self.muxers = frozenset()
+        self.probed_at = None
+    
+    @property
+    def available(self):
+        return self.path is not None
+    
+    def ensure_probed(self):
+        if self.probed_at is None:
+            self.refresh()
+    
+    def refresh_retry_after(self):
+        """距离允许下一次显式刷新还需等待的秒数，0 表示可以刷新"""
+        if self.probed_at is None:
+            return 0
+        return max(0, math.ceil(self.probed_at + self.REFRESH_INTERVAL - time.time()))
+    
+    def refresh(self):
+        """重新探测 FFmpeg（启动时或显式刷新时调用）"""
+        with self._lock:
+            path, version = None, None
+            for candidate in self.SEARCH_PATHS:
+                try:
+                    result = subprocess.run([candidate, '-version'],
+                                            capture_output=True, text=True, timeout=5)
+                    if result.returncode == 0:
+                        path = candidate
+                        first_line = result.stdout.splitlines()[0] if result.stdout else ''
+                        match = re.search(r'ffmpeg version (\S+)', first_line)
+                        version = match.group(1) if match else first_line[:60]
+                        break
+                except Exception:
+                    continue
+            
+            encoders, muxers = frozenset(), frozenset()
+            if path:
+                encoders = self._list_names(path, '-encoders')
+                muxers = self._list_names(path, '-muxers')
+            
+            self.path, self.version = path, version
+            self.encoders, self.muxers = encoders, muxers
+            self.probed_at = time.time()
+        
+        app.logger.info(f"FFmpeg probe: {path or 'not found'} {version or ''}")
+        return self.to_dict()
+    
+    @staticmethod
+    def _list_names(path, flag):
+        """解析 ffmpeg -encoders / -muxers 输出中的名称列"""
+        try:
+            result = subprocess.run([path, '-hide_banner', flag],
+                                    capture_output=True, text=True, timeout=5)
+        except Exception:
+            return frozenset()
+        
+        names = set()
+        in_table = False
+        for line in result.stdout.splitlines():
+            stripped = line.strip()
+            if stripped.startswith('--'):
+                in_table = True
+                continue
+            parts = stripped.split()
+            if in_table and len(parts) >= 2:
+                names.update(parts[1].split(','))
+        return frozenset(names)
+    
+    def has_encoder(self, name):
+        return name in self.encoders
+    
+    def has_muxer(self, name):
+        return name in self.muxers
+    
+    def to_dict(self):
+        return {
+            "available": self.available,
+            "path": self.path,
+            "version": self.version,
+            "encoders": len(self.encoders),
+            "muxers": sorted(m for m in ('mp4', 'webm', 'matroska', 'mp3', 'ipod', 'ogg') if m in self.muxers),
+            "probed_at": self.probed_at
+        }
+
+ffmpeg_caps = FFmpegCapabilities()
+
+# 🔧 视频信息缓存
+class InfoCache:
+    """按视频ID缓存 yt-dlp 的信息字典（含格式列表），带 cookies 提取的条目键中附加 cookies 摘要
+    
+    内存层为 LRU，可选 SQLite 磁盘层；过期时间取 TTL 与签名URL过期时间中较早者。
+    """
+    EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+    EXPIRE_MARGIN = 300  # 在签名URL过期前 5 分钟失效
+    
+    def __init__(self, max_entries, ttl, db_path=None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = collections.OrderedDict()  # video_id -> (expires_at, info_json)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS info_cache ("
+                    "video_id TEXT PRIMARY KEY, expires_at REAL NOT NULL, info TEXT NOT NULL)"
+                )
+    
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+    
+    def _expires_at(self, info):
+        """计算缓存过期时间，签名URL过期前失效"""
+        expires_at = time.time() + self.ttl
+        for fmt in info.get('formats') or []:
+            match = self.EXPIRE_PATTERN.search(fmt.get('url') or '')
+            if match:
+                expires_at = min(expires_at, int(match.group(1)) - self.EXPIRE_MARGIN)
+        return expires_at
+    
+    def get(self, video_id):
+        """返回信息字典的独立副本，未命中返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(video_id)
+                self.hits += 1
+                return json.loads(entry[1])
+            if entry:
+                del self._entries[video_id]
+        
+        if self.db_path:
+            try:
+                with self._connect() as conn:
+                    row = conn.execute(
+                        "SELECT expires_at, info FROM info_cache WHERE video_id = ? AND expires_at > ?",
+                        (video_id, now)
+                    ).fetchone()
+            except sqlite3.Error as e:
+                app.logger.error(f"Info cache read error: {str(e)}")
+                row = None
+            if row:
+                with self._lock:
+                    self._store_locked(video_id, row[0], row[1])
+                    self.disk_hits += 1
+                return json.loads(row[1])
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def put(self, video_id, info):
+        expires_at = self._expires_at(info)
+        if not video_id or expires_at <= time.time():
+            return
+        info_json = json.dumps(info, ensure_ascii=False)
+        with self._lock:
+            self._store_locked(video_id, expires_at, info_json)
+        
+        if self.db_path:
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO info_cache (video_id, expires_at, info) VALUES (?, ?, ?)",
+                        (video_id, expires_at, info_json)
+                    )
+                    conn.execute("DELETE FROM info_cache WHERE expires_at <= ?", (time.time(),))
+            except sqlite3.Error as e:
+                app.logger.error(f"Info cache write error: {str(e)}")
+    
+    def _store_locked(self, video_id, expires_at, info_json):
+        self._entries[video_id] = (expires_at, info_json)
+        self._entries.move_to_end(video_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_enabled": bool(self.db_path)
+            }
+
+info_cache = InfoCache(config.INFO_CACHE_SIZE, config.INFO_CACHE_TTL, config.INFO_CACHE_DB or None)
+
+def info_cache_key(video_id, cookies_file=None):
+    """信息缓存的键：带 cookies 提取的结果（私有 / 会员 / 年龄限制视频）只对同一份 cookies 可见"""
+    identity = cookies_identity(cookies_file)
+    return f"{video_id}@{identity}" if video_id and identity else video_id
+
+# 信息缓存中无需保留的大字段
+INFO_CACHE_DROP_KEYS = ('automatic_captions', 'subtitles', 'thumbnails', 'heatmap', 'description')
+
+def fetch_video_info(url, cookies_file=None):
+    """🔧 获取视频信息（优先读取缓存），失败返回 None"""
+    video_id = extract_video_id(url)
+    if not video_id:
+        return None
+    cache_key = info_cache_key(video_id, cookies_file)
+    info = info_cache.get(cache_key)
+    if info is not None:
+        return info
+    
+    host_rate_limiter.acquire(upstream_host(url))  # 探测、格式查询与下载共用同一上游限速
+    try:
+        if config.DOWNLOAD_ENGINE == 'inprocess' and yt_dlp is not None:
+            ydl_opts = {'quiet': True, 'no_warnings': True, 'noplaylist': True,
+                        'logger': YtdlpLogCollector()}
+            if cookies_file:
+                ydl_opts['cookiefile'] = str(cookies_file)
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False, process=False))
+        else:
+            cmd = [sys.executable, "-m", "yt_dlp", "-J", "--no-playlist", "--no-warnings"]
+            if cookies_file:
+                cmd.extend(["--cookies", str(cookies_file)])
+            result = subprocess.run(cmd + [url], capture_output=True, text=True, timeout=120)
+            if result.returncode != 0:
+                return None
+            info = json.loads(result.stdout)
+    except Exception as e:
+        app.logger.warning(f"Info extraction failed for {video_id}: {str(e)[:80]}")
+        return None
+    
+    cache_video_info(cache_key, info)
+    return info
+
+def cache_video_info(cache_key, info):
+    """裁剪大字段后写入信息缓存"""
+    if not info:
+        return
+    info = {k: v for k, v in info.items() if k not in INFO_CACHE_DROP_KEYS}
+    info_cache.put(cache_key, info)
+
+def summarize_formats(info):
+    """生成格式列表摘要供前端展示"""
+    formats = []
+    for fmt in info.get('formats') or []:
+        if fmt.get('format_note') == 'storyboard' or fmt.get('ext') == 'mhtml':
+            continue
+        formats.append({
+            "format_id": fmt.get('format_id'),
+            "ext": fmt.get('ext'),
+            "height": fmt.get('height'),
+            "fps": fmt.get('fps'),
+            "vcodec": fmt.get('vcodec'),
+            "acodec": fmt.get('acodec'),
+            "tbr": fmt.get('tbr'),
+            "filesize": fmt.get('filesize') or fmt.get('filesize_approx')
+        })
+    return {
+        "id": info.get('id'),
+        "title": info.get('title'),
+        "duration": info.get('duration'),
+        "formats": formats
+    }
+
+# 🔧 按画质估算实际会选中的格式和文件大小
+def _format_bytes(fmt, duration):
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return int(size or 0)
+
+def _quality_height(quality):
+    match = re.search(r'(\d+)p$', quality)
+    return int(match.group(1)) if match else None
+
+def estimate_quality(info, quality):
+    """近似 yt-dlp 的格式选择：不超过目标高度的最佳视频 + 最佳音频
+    
+    返回 {height, vcodec, acodec, bytes}，没有可用格式时返回 None。
+    """
+    duration = info.get('duration')
+    formats = [fmt for fmt in info.get('formats') or []
+               if fmt.get('format_note') != 'storyboard' and fmt.get('ext') != 'mhtml']
+    options = QUALITY_OPTIONS.get(quality, {})
+    audio = [fmt for fmt in formats if fmt.get('acodec') not in (None, 'none') and fmt.get('vcodec') in (None, 'none')]
+    best_audio = max(audio, key=lambda fmt: (fmt.get('abr') or fmt.get('tbr') or 0), default=None)
+    
+    if options.get('audio_only'):
+        # 与格式选择一致：优先与目标编码相同的音频流（如 m4a -> mp4a）
+        prefix = {'m4a': 'mp4a', 'opus': 'opus'}.get(options.get('extract_audio'))
+        preferred = [fmt for fmt in audio if prefix and str(fmt.get('acodec')).startswith(prefix)]
+        if preferred:
+            best_audio = max(preferred, key=lambda fmt: (fmt.get('abr') or fmt.get('tbr') or 0))
+        if best_audio is None:
+            return None
+        return {"height": None, "vcodec": None, "acodec": best_audio.get('acodec'),
+                "bytes": _format_bytes(best_audio, duration)}
+    
+    max_height = _quality_height(quality)
+    video = [fmt for fmt in formats if fmt.get('vcodec') not in (None, 'none') and fmt.get('height')
+             and (max_height is None or fmt['height'] <= max_height)]
+    if not video:
+        return None
+    top_height = max(fmt['height'] for fmt in video)
+    candidates = [fmt for fmt in video if fmt['height'] == top_height]
+    if options.get('format_sort'):
+        # 省流档：同一高度选择体积最小的编码
+        chosen = min(candidates, key=lambda fmt: _format_bytes(fmt, duration) or float('inf'))
+    else:
+        chosen = max(candidates, key=lambda fmt: (fmt.get('tbr') or 0))
+    
+    size = _format_bytes(chosen, duration)
+    acodec = chosen.get('acodec') if chosen.get('acodec') not in (None, 'none') else None
+    if acodec is None and best_audio is not None:
+        acodec = best_audio.get('acodec')
+        size += _format_bytes(best_audio, duration)
+    return {"height": top_height, "vcodec": chosen.get('vcodec'), "acodec": acodec, "bytes": size}
+
+def probe_summary(info):
+    """探测结果：可用高度、编码、时长以及各画质的预计大小"""
+    formats = info.get('formats') or []
+    heights = sorted({fmt['height'] for fmt in formats
+                      if fmt.get('height') and fmt.get('vcodec') not in (None, 'none')}, reverse=True)
+    estimates = {quality: estimate_quality(info, quality) for quality in QUALITY_OPTIONS}
+    # 推荐：能达到其标称高度的最高视频档位
+    recommended = next(
+        (quality for quality in ('2160p', '1440p', '1080p', '720p', '480p', '360p')
+         if estimates.get(quality) and estimates[quality]["height"] == _quality_height(quality)),
+        'best'
+    )
+    return {
+        "id": info.get('id'),
+        "title": info.get('title'),
+        "duration": info.get('duration'),
+        "heights": heights,
+        "vcodecs": sorted({fmt['vcodec'].split('.')[0] for fmt in formats if fmt.get('vcodec') not in (None, 'none')}),
+        "acodecs": sorted({fmt['acodec'].split('.')[0] for fmt in formats if fmt.get('acodec') not in (None, 'none')}),
+        "estimates": estimates,
+        "recommended_quality": recommended
+    }
+
+# 🔧 批量探测：有界线程池，同一视频的并发请求合并为一次提取
+probe_executor = ThreadPoolExecutor(max_workers=max(1, config.PROBE_WORKERS), thread_name_prefix='probe')
+_probe_inflight = {}
+_probe_lock = threading.Lock()
+
+def probe_video(url, cookies_file=None):
+    """返回探测 Future；同一缓存键（视频 + cookies）的并发探测共用一次提取"""
+    cache_key = info_cache_key(extract_video_id(url), cookies_file)
+    with _probe_lock:
+        future = _probe_inflight.get(cache_key)
+        if future is None:
+            future = probe_executor.submit(fetch_video_info, url, cookies_file)
+            _probe_inflight[cache_key] = future
+            future.add_done_callback(lambda _: _probe_inflight.pop(cache_key, None))
+    return future
+
+# 🔧 播放列表 / 频道的惰性枚举
+def _entry_date(entry):
+    if entry.get('upload_date'):
+        return entry['upload_date']
+    if entry.get('timestamp'):
+        return datetime.datetime.utcfromtimestamp(entry['timestamp']).strftime('%Y%m%d')
+    return None
+
+def _flat_entries(url, cookies_file=None):
+    """扁平提取一层条目（不解析单个视频），按 yt-dlp 的分页逐条产出"""
+    host_rate_limiter.acquire(upstream_host(url))
+    if config.DOWNLOAD_ENGINE == 'inprocess' and yt_dlp is not None:
+        ydl_opts = {
+            'quiet': True, 'no_warnings': True, 'logger': YtdlpLogCollector(),
+            'extract_flat': 'in_playlist', 'lazy_playlist': True
+        }
+        if cookies_file:
+            ydl_opts['cookiefile'] = str(cookies_file)
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            result = ydl.extract_info(url, download=False, process=False)
+            # entries 为惰性生成器 / 分页列表，消费方停止迭代后不再拉取后续页
+            yield from (result or {}).get('entries') or []
+        return
+    
+    cmd = [sys.executable, "-m", "yt_dlp", "--flat-playlist", "--lazy-playlist", "-j", "--no-warnings"]
+    if cookies_file:
+        cmd.extend(["--cookies", str(cookies_file)])
+    
+    # 🔧 子进程由 run_supervised 在后台线程中监督（超时 / 无输出 / TERM -> KILL），
+    # 条目经有界队列交给消费方；消费方暂停时 on_line 阻塞，这段时间不计入超时
+    items = queue.Queue(maxsize=config.PLAYLIST_QUEUE_AHEAD)
+    stopped = threading.Event()
+    process_ref = {}
+    finished = object()
+    
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def on_line(line):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        put(entry)  # 消费方停止后直接丢弃，子进程随即被终止
+        return None
+    
+    def on_start(process):
+        process_ref["process"] = process
+        if stopped.is_set():
+            _signal_process_group(process, signal.SIGTERM)
+    
+    def supervise():
+        try:
+            result = run_supervised(cmd + [url], config.PLAYLIST_EXTRACT_TIMEOUT, config.DOWNLOAD_STALL_TIMEOUT,
+                                    on_line, on_start=on_start)
+        except Exception as e:
+            result = (None, str(e), "error")
+        put((finished, result))
+    
+    threading.Thread(target=supervise, name="collection-extract", daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if isinstance(item, tuple) and item[0] is finished:
+                break
+            yield item
+    finally:
+        stopped.set()
+        process = process_ref.get("process")
+        if process is not None and process.returncode is None:
+            _signal_process_group(process, signal.SIGTERM)
+    
+    returncode, stderr_output, reason = item[1]
+    if reason or returncode:
+        detail = (stderr_output.strip().splitlines() or [''])[-1]
+        if reason in ("timeout", "stall"):
+            detail = f"{reason} ({detail})" if detail else reason
+        raise RuntimeError(detail or f"yt-dlp 退出码 {returncode}")
+
+def _is_tab_entry(entry):
+    """频道首页 / @handle 的 Videos、Shorts、Live 等标签页以嵌套播放列表的形式出现"""
+    return entry.get('_type') == 'playlist' or (entry.get('_type') == 'url' and entry.get('ie_key') == 'YoutubeTab')
+
+def newest_first(url):
+    """频道标签页按发布时间倒序，播放列表（list=）保持其自身顺序"""
+    return not re.search(r'[?&]list=', url or '')
+
+def _iter_raw_entries(url, cookies_file=None, skip_tabs=None):
+    """逐条产出 (标签页, 条目)；嵌套的标签页展开一层，加入 skip_tabs 的标签页立即停止枚举"""
+    skip_tabs = set() if skip_tabs is None else skip_tabs
+    entries = _flat_entries(url, cookies_file)
+    try:
+        for entry in entries:
+            if not entry:
+                continue
+            if not _is_tab_entry(entry):
+                yield url, entry
+                if url in skip_tabs:
+                    return
+                continue
+            
+            tab = entry.get('webpage_url') or entry.get('url') or entry.get('id') or url
+            if tab in skip_tabs:
+                continue
+            if entry.get('_type') == 'playlist':
+                nested = (child for child in entry.get('entries') or [])
+            else:
+                nested = _flat_entries(entry['url'], cookies_file)
+            try:
+                for child in nested:
+                    if child and not _is_tab_entry(child):
+                        yield tab, child
+                        if tab in skip_tabs:
+                            break
+            finally:
+                nested.close()  # 跳过标签页时结束其枚举子进程
+    finally:
+        entries.close()
+
+def iter_collection_entries(url, options, cookies_file=None, skip_tabs=None):
+    """逐条产出播放列表 / 频道中的视频 {id, url, title, tab}，内存占用与列表长度无关
+    
+    频道首页会依次枚举各标签页；消费方把条目的 tab 加入 skip_tabs 即可跳过该标签页的剩余部分。
+    """
+    start, max_entries = options['start'], options['max_entries']
+    end = options['end'] or start + max_entries - 1
+    end = min(end, start + max_entries - 1)
+    date_after, date_before = options.get('date_after'), options.get('date_before')
+    skip_tabs = set() if skip_tabs is None else skip_tabs
+    position = 0
+    
+    entries = _iter_raw_entries(url, cookies_file, skip_tabs)
+    try:
+        for tab, entry in entries:
+            video_id = entry.get('id')
+            if entry.get('ie_key') not in (None, 'Youtube') or not video_id or len(video_id) != 11:
+                continue
+            position += 1
+            if position < start:
+                continue
+            
+            upload_date = _entry_date(entry)
+            if upload_date and date_after and upload_date < date_after:
+                if newest_first(tab):
+                    skip_tabs.add(tab)  # 本标签页之后的条目只会更早，其他标签页继续
+            elif not (upload_date and date_before and upload_date > date_before):
+                yield {
+                    "id": video_id,
+                    "url": f"https://www.youtube.com/watch?v={video_id}",
+                    "title": entry.get('title'),
+                    "duration": entry.get('duration'),
+                    "tab": tab
+                }
+            if position >= end:
+                break  # 不再拉取后续分页
+    finally:
+        entries.close()
+
+# 🔧 子进程模式的机器可读进度行（--progress-template）
+PROGRESS_LINE_PREFIX = "[progress-json]"
+PROGRESS_TEMPLATE_FIELDS = (
+    "%(progress.{status,downloaded_bytes,total_bytes,total_bytes_estimate,"
+    "speed,eta,fragment_index,fragment_count})j"
+)
+
+# yt-dlp 后处理阶段（FFmpeg 合并 / 转码）可能长时间没有输出，此时不做无输出检测，并占用后处理槽位
+# 写入元数据（[Metadata]）只是一次很快的流复制，不占用槽位
+POSTPROCESSOR_LINE = re.compile(
+    r'^\[(Merger|ExtractAudio|VideoConvertor|VideoRemuxer|FFmpeg(?!Metadata)\w*|Fixup\w*|EmbedThumbnail)\]'
+)
+
+# 🔧 子进程监督：非阻塞读取 stdout / stderr，墙钟与无输出超时，TERM -> KILL
+def _signal_process_group(process, sig):
+    try:
+        if os.name == 'posix':
+            os.killpg(process.pid, sig)  # 连同 yt-dlp 启动的 ffmpeg 一起结束
+        else:
+            process.send_signal(sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def parse_cpu_list(value):
+    """解析 "0-3,6" 形式的 CPU 列表，为空返回 None"""
+    cpus = set()
+    for part in (value or '').replace(' ', '').split(','):
+        if not part:
+            continue
+        low, _, high = part.partition('-')
+        cpus.update(range(int(low), int(high or low) + 1))
+    return cpus or None
+
+class JobResourceLimits:
+    """🔧 下载子进程的资源限制
+    
+    在父进程中对刚启动的 yt-dlp 生效（setpriority / sched_setaffinity / prlimit），
+    之后由它启动的 ffmpeg 会继承；I/O 优先级通过 ionice 前缀设置。
+    """
+    
+    IO_CLASSES = {'best-effort': ('2', '7'), 'idle': ('3', None)}
+    
+    def __init__(self, nice=0, cpus=None, memory_bytes=0, io_class='', max_open_files=0):
+        self.nice = nice
+        self.cpus = cpus
+        self.memory_bytes = memory_bytes
+        self.io_class = io_class if io_class in self.IO_CLASSES and shutil.which('ionice') else ''
+        self.max_open_files = max_open_files
+    
+    @classmethod
+    def for_quality(cls, quality, heavy=None):
+        heavy = quality in HEAVY_QUALITIES if heavy is None else heavy
+        try:
+            cpus = parse_cpu_list(config.JOB_HEAVY_CPU_AFFINITY if heavy and config.JOB_HEAVY_CPU_AFFINITY
+                                  else config.JOB_CPU_AFFINITY)
+        except ValueError:
+            cpus = None
+        return cls(nice=config.JOB_HEAVY_NICE if heavy else config.JOB_NICE, cpus=cpus,
+                   memory_bytes=config.JOB_MEMORY_LIMIT, io_class=config.JOB_IO_CLASS,
+                   max_open_files=config.JOB_MAX_OPEN_FILES)
+    
+    def wrap_command(self, cmd):
+        if not self.io_class:
+            return cmd
+        io_class, level = self.IO_CLASSES[self.io_class]
+        return ["ionice", "-c", io_class] + (["-n", level] if level else []) + cmd
+    
+    def apply(self, pid):
+        """逐项设置，单项失败（如权限不足）只记录日志"""
+        steps = []
+        if self.nice and hasattr(os, 'setpriority'):
+            steps.append(("nice", lambda: os.setpriority(os.PRIO_PROCESS, pid, self.nice)))
+        if self.cpus and hasattr(os, 'sched_setaffinity'):
+            steps.append(("affinity", lambda: os.sched_setaffinity(pid, self.cpus)))
+        if resource is not None and hasattr(resource, 'prlimit'):
+            if self.memory_bytes:
+                steps.append(("memory", lambda: resource.prlimit(
+                    pid, resource.RLIMIT_AS, (self.memory_bytes, self.memory_bytes))))
+            if self.max_open_files:
+                steps.append(("nofile", lambda: resource.prlimit(
+                    pid, resource.RLIMIT_NOFILE, (self.max_open_files, self.max_open_files))))
+        for name, step in steps:
+            try:
+                step()
+            except (OSError, ValueError) as e:
+                app.logger.warning(f"Failed to apply {name} limit to pid {pid}: {str(e)}")
+    
+    def to_dict(self):
+        return {
+            "nice": self.nice,
+            "cpus": sorted(self.cpus) if self.cpus else None,
+            "memory_bytes": self.memory_bytes or None,
+            "io_class": self.io_class or None,
+            "max_open_files": self.max_open_files or None
+        }
+
+def _child_pids(pid):
+    """通过 /proc/<pid>/task/*/children 递归列出后代进程"""
+    found, pending = [], [pid]
+    while pending:
+        try:
+            tasks = list(Path(f"/proc/{pending.pop()}/task").iterdir())
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                children = [int(c) for c in (task / 'children').read_text().split()]
+            except (OSError, ValueError):
+                continue
+            found.extend(children)
+            pending.extend(children)
+    return found
+
+class JobResourceUsage:
+    """🔧 单个任务的资源记账
+    
+    运行中定期采样 /proc/<pid>/io 的 write_bytes（含 ffmpeg 等后代），
+    结束时用 os.wait4 回收进程，取得 CPU 时间和峰值 RSS（包含已被回收的后代）。
+    """
+    
+    def __init__(self):
+        self.cpu_seconds = None
+        self.peak_rss_bytes = None
+        self._written = {}
+    
+    def sample(self, pid):
+        for target in [pid] + _child_pids(pid):
+            try:
+                for line in Path(f"/proc/{target}/io").read_text().splitlines():
+                    if line.startswith('write_bytes:'):
+                        self._written[target] = max(self._written.get(target, 0), int(line.split()[1]))
+            except (OSError, ValueError):
+                continue
+    
+    def record_rusage(self, rusage):
+        self.cpu_seconds = round(rusage.ru_utime + rusage.ru_stime, 2)
+        # Linux 上 ru_maxrss 单位为 KB
+        self.peak_rss_bytes = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    
+    @property
+    def bytes_written(self):
+        return sum(self._written.values()) if self._written else None
+    
+    def to_dict(self):
+        return {"cpu_seconds": self.cpu_seconds, "peak_rss_bytes": self.peak_rss_bytes,
+                "bytes_written": self.bytes_written}
+
+def wait_process(process, timeout=None, usage=None):
+    """回收子进程；提供 usage 时改用 os.wait4 记录资源用量"""
+    if usage is None or not hasattr(os, 'wait4'):
+        return process.wait(timeout)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.01
+    while process.returncode is None:
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            # 已被其他机制回收（如 gevent 的子进程监视器），只能拿到返回码
+            return process.wait(timeout)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            usage.record_rusage(rusage)
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+    return process.returncode
+
+def stop_process(process, grace=None, usage=None):
+    """先 SIGTERM，宽限期后 SIGKILL，并始终回收子进程"""
+    grace = config.PROCESS_KILL_GRACE if grace is None else grace
+    if process.returncode is None:
+        _signal_process_group(process, signal.SIGTERM)
+        try:
+            wait_process(process, grace, usage)
+        except subprocess.TimeoutExpired:
+            _signal_process_group(process, signal.SIGKILL if os.name == 'posix' else signal.SIGTERM)
+            wait_process(process, None, usage)
+
+def run_supervised(cmd, timeout, stall_timeout, on_line, max_stderr_lines=200, on_start=None,
+                   limits=None, usage=None, gate=None):
+    """运行子进程并用 selectors 同时读取两个管道
+    
+    on_line(line) 处理每行 stdout，返回 True 表示进入后处理阶段（暂停无输出检测），
+    返回 False 表示恢复检测，返回 None 不改变状态。
+    on_start(process) 在子进程启动后调用，可选。
+    limits / usage 分别为 JobResourceLimits / JobResourceUsage，可选。
+    gate 为 FFmpegGate，可选：其中的 ffmpeg 启动请求在同一循环里交给 gate.on_request 处理。
+    返回 (返回码, stderr 文本, 终止原因)；被终止时返回码为 None，原因为 timeout / stall。
+    """
+    if limits is not None:
+        cmd = limits.wrap_command(cmd)
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=(os.name == 'posix')
+    )
+    metric_active_subprocesses.inc()
+    if limits is not None:
+        limits.apply(process.pid)
+    if on_start:
+        on_start(process)
+    selector = selectors.DefaultSelector()
+    buffers = {process.stdout: b'', process.stderr: b''}
+    open_pipes = set(buffers)
+    stderr_tail = collections.deque(maxlen=max_stderr_lines)
+    for pipe in buffers:
+        os.set_blocking(pipe.fileno(), False)
+        selector.register(pipe, selectors.EVENT_READ)
+    if gate is not None:
+        selector.register(gate, selectors.EVENT_READ)
+    
+    start = last_activity = last_sample = time.monotonic()
+    postprocessing = False
+    reason = None
+    
+    def call(callback, *args):
+        """回调内等待（如后处理槽位）期间子进程不会推进，不计入超时"""
+        nonlocal start, last_activity
+        callback_start = time.monotonic()
+        result = callback(*args)
+        blocked = time.monotonic() - callback_start
+        if blocked > 1.0:
+            start += blocked
+            last_activity += blocked
+        return result
+    
+    try:
+        while open_pipes:
+            now = time.monotonic()
+            if usage is not None and now - last_sample >= 1.0:
+                usage.sample(process.pid)
+                last_sample = now
+            if now - start > timeout:
+                reason = "timeout"
+                break
+            if stall_timeout and not postprocessing and now - last_activity > stall_timeout:
+                reason = "stall"
+                break
+            
+            # 🔧 ffmpeg 启动请求排在管道之后处理：yt-dlp 先打印后处理器行再启动 ffmpeg
+            events = sorted(selector.select(timeout=1.0), key=lambda event: event[0].fileobj is gate)
+            for key, _ in events:
+                pipe = key.fileobj
+                if pipe is gate:
+                    for pid in gate.read_requests():
+                        call(gate.on_request, pid)
+                    continue
+                try:
+                    chunk = os.read(pipe.fileno(), 65536)
+                except BlockingIOError:
+                    continue
+                if chunk:
+                    last_activity = time.monotonic()
+                    *lines, buffers[pipe] = (buffers[pipe] + chunk).split(b'\n')
+                    if len(buffers[pipe]) > 1024 * 1024:  # 超长无换行输出按行处理，避免缓冲无限增长
+                        lines.append(buffers[pipe])
+                        buffers[pipe] = b''
+                else:
+                    selector.unregister(pipe)
+                    open_pipes.discard(pipe)
+                    lines, buffers[pipe] = [buffers[pipe]], b''
+                
+                for raw in lines:
+                    line = raw.decode('utf-8', errors='replace').strip()
+                    if not line:
+                        continue
+                    if pipe is process.stderr:
+                        stderr_tail.append(line)
+                        continue
+                    state = call(on_line, line)
+                    if state is not None:
+                        postprocessing = state
+                        last_activity = time.monotonic()
+        
+        if reason is None:
+            # 管道均已关闭，进程正在退出
+            if usage is not None:
+                usage.sample(process.pid)
+            try:
+                wait_process(process, max(1.0, timeout - (time.monotonic() - start)), usage)
+            except subprocess.TimeoutExpired:
+                reason = "timeout"
+    finally:
+        selector.close()
+        stop_process(process, usage=usage)
+        process.stdout.close()
+        process.stderr.close()
+        metric_active_subprocesses.dec()
+    
+    return (None if reason else process.returncode), '\n'.join(stderr_tail), reason
+
+# 🔧 FFmpeg 后处理：独立的有界槽位，并记录每个任务的封装 / 转码决定
+postprocess_slots = threading.BoundedSemaphore(max(1, config.POSTPROCESS_WORKERS))
+metric_postprocess_wait = metrics.register(MetricHistogram(
+    'ytdl_postprocess_wait_seconds', '等待后处理槽位的时间', PHASE_BUCKETS))
+metric_postprocess_mode = metrics.register(MetricCounter(
+    'ytdl_postprocess_total', '按处理方式统计的后处理次数', ('mode',)))
+
+POSTPROCESS_MODES = {
+    'Merger': 'remux',
+    'FFmpegMerger': 'remux',
+    'VideoRemuxer': 'remux',
+    'FFmpegVideoRemuxer': 'remux',
+    'ExtractAudio': 'extract_audio',
+    'FFmpegExtractAudio': 'extract_audio',
+    'VideoConvertor': 'transcode',
+    'FFmpegVideoConvertor': 'transcode',
+}
+MODE_RANK = {'none': 0, 'remux': 1, 'extract_audio': 2, 'transcode': 3}
+
+class PostprocessTracker:
+    """单次下载的后处理记录；首次进入 FFmpeg 阶段时占用一个后处理槽位，直到下载结束"""
+    def __init__(self):
+        self.decision = {
+            "mode": "none", "container": None, "format_id": None,
+            "vcodec": None, "acodec": None, "postprocessors": [],
+            "wait_seconds": 0.0, "duration_seconds": 0.0
+        }
+        self._holding = False
+        self._started = None
+    
+    def set_formats(self, format_id=None, vcodec=None, acodec=None, container=None):
+        for key, value in (("format_id", format_id), ("vcodec", vcodec),
+                           ("acodec", acodec), ("container", container)):
+            if value:
+                self.decision[key] = value
+    
+    def enter(self, postprocessor, on_block=None, on_resume=None):
+        """进入后处理器；槽位已满时先调用 on_block，获得槽位后调用 on_resume"""
+        self.record(postprocessor)
+        self.acquire(on_block, on_resume)
+    
+    def record(self, postprocessor):
+        if postprocessor not in self.decision["postprocessors"]:
+            self.decision["postprocessors"].append(postprocessor)
+        mode = POSTPROCESS_MODES.get(postprocessor)
+        if mode and MODE_RANK[mode] > MODE_RANK[self.decision["mode"]]:
+            self.decision["mode"] = mode
+    
+    def acquire(self, on_block=None, on_resume=None):
+        if self._holding:
+            return
+        if not postprocess_slots.acquire(blocking=False):
+            wait_start = time.monotonic()
+            if on_block:
+                on_block()
+            postprocess_slots.acquire()
+            self.decision["wait_seconds"] = round(time.monotonic() - wait_start, 2)
+            if on_resume:
+                on_resume()
+        metric_postprocess_wait.observe(self.decision["wait_seconds"])
+        self._holding = True
+        self._started = time.monotonic()
+    
+    def release(self):
+        if self._holding:
+            self.decision["duration_seconds"] = round(time.monotonic() - self._started, 2)
+            postprocess_slots.release()
+            self._holding = False
+        metric_postprocess_mode.inc(mode=self.decision["mode"])
+
+class FFmpegGate:
+    """🔧 子进程引擎的 FFmpeg 闸门：在 ffmpeg 启动之前获得后处理槽位
+    
+    yt-dlp 经 --ffmpeg-location 调用临时目录中的包装脚本。包装脚本在执行真正的 ffmpeg 之前
+    把自身 PID 写入 FIFO 并等待 SIGUSR1；run_supervised 读到请求后调用 on_request(pid)，
+    由调用方决定是否占用槽位，再用 grant(pid) 放行。只查询版本 / 能力（没有 -i）的调用直接放行。
+    """
+    WRAPPER = '''#!{python}
+import os, signal, sys
+args = sys.argv[1:]
+if "-i" in args:
+    signal.pthread_sigmask(signal.SIG_BLOCK, {{signal.SIGUSR1}})
+    try:
+        fd = os.open({fifo!r}, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        fd = None  # 监督循环已结束，直接运行
+    if fd is not None:
+        os.write(fd, b"%d\\n" % os.getpid())
+        os.close(fd)
+        signal.sigwait({{signal.SIGUSR1}})
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {{signal.SIGUSR1}})
+os.execv({ffmpeg!r}, [{ffmpeg!r}] + args)
+'''
+    
+    def __init__(self, ffmpeg_path, on_request=None):
+        self.directory = Path(tempfile.mkdtemp(prefix='ytdl-ffmpeg-'))
+        fifo = self.directory / 'requests'
+        os.mkfifo(fifo)
+        # 自己也持有写端，没有包装脚本连接时 FIFO 不会一直处于 EOF 可读状态
+        self._read_fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        self._write_fd = os.open(fifo, os.O_WRONLY)
+        self._buffer = b''
+        self.on_request = on_request or self.grant
+        
+        wrapper = self.directory / 'ffmpeg'
+        wrapper.write_text(self.WRAPPER.format(python=sys.executable, fifo=str(fifo), ffmpeg=ffmpeg_path),
+                           encoding='utf-8')
+        wrapper.chmod(0o755)
+        ffprobe = Path(ffmpeg_path).with_name('ffprobe')
+        if ffprobe.exists():
+            (self.directory / 'ffprobe').symlink_to(ffprobe)
+    
+    @classmethod
+    def install(cls, cmd):
+        """把命令中的 --ffmpeg-location 换成包装脚本目录；不适用时返回 None"""
+        if os.name != 'posix' or "--ffmpeg-location" not in cmd:
+            return None
+        index = cmd.index("--ffmpeg-location") + 1
+        ffmpeg_path = shutil.which(cmd[index]) if index < len(cmd) else None
+        if not ffmpeg_path:
+            return None
+        try:
+            gate = cls(os.path.abspath(ffmpeg_path))
+        except OSError as e:
+            app.logger.warning(f"FFmpeg gate unavailable: {e}")
+            return None
+        cmd[index] = str(gate.directory)
+        return gate
+    
+    def fileno(self):
+        return self._read_fd
+    
+    def read_requests(self):
+        try:
+            self._buffer += os.read(self._read_fd, 4096)
+        except BlockingIOError:
+            return []
+        *lines, self._buffer = self._buffer.split(b'\n')
+        return [int(line) for line in lines if line.strip().isdigit()]
+    
+    def grant(self, pid):
+        try:
+            os.kill(pid, signal.SIGUSR1)
+        except ProcessLookupError:
+            pass
+    
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def describe_formats(info_key, format_id):
+    """根据缓存的格式列表查找所选格式的编码"""
+    info = info_cache.get(info_key) if info_key else None
+    by_id = {fmt.get('format_id'): fmt for fmt in (info or {}).get('formats') or []}
+    vcodec = acodec = None
+    for part in (format_id or '').split('+'):
+        fmt = by_id.get(part) or {}
+        if fmt.get('vcodec') not in (None, 'none'):
+            vcodec = vcodec or fmt['vcodec']
+        if fmt.get('acodec') not in (None, 'none'):
+            acodec = acodec or fmt['acodec']
+    return vcodec, acodec
+
+# 🔧 进程内 yt-dlp 引擎辅助类
+class DownloadTimeoutError(Exception):
+    """进程内下载超时，由 progress hook 或看门狗抛出以中断下载"""
+
+class YtdlpLogCollector:
+    """收集 yt-dlp 输出，模拟子进程模式下的 stdout / stderr 文本"""
+    def __init__(self, max_lines=200, on_activity=None):
+        self._stdout = collections.deque(maxlen=max_lines)
+        self._stderr = collections.deque(maxlen=max_lines)
+        self._on_activity = on_activity
+    
+    def _activity(self):
+        if self._on_activity:
+            self._on_activity()
+    
+    def debug(self, msg):
+        self._activity()
+        self._stdout.append(msg)
+    
+    def info(self, msg):
+        self._activity()
+        self._stdout.append(msg)
+    
+    def warning(self, msg):
+        self._activity()
+        self._stderr.append(f"WARNING: {msg}")
+    
+    def error(self, msg):
+        self._activity()
+        self._stderr.append(msg)
+    
+    def stdout_text(self):
+        return '\n'.join(self._stdout)
+    
+    def stderr_text(self):
+        return '\n'.join(self._stderr).strip()
+
+def _current_task():
+    """当前执行单元：线程模式为线程 ID，协作式模式为当前协程"""
+    if ASYNC_MODE == 'threading':
+        return threading.get_ident()
+    import greenlet
+    return greenlet.getcurrent()
+
+def _interrupt_task(target):
+    """向执行单元注入 DownloadTimeoutError，返回可取消的句柄（线程模式为 None）"""
+    if ASYNC_MODE == 'threading':
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(target), ctypes.py_object(DownloadTimeoutError))
+        return None
+    if ASYNC_MODE == 'gevent':
+        import gevent
+        return gevent.get_hub().loop.run_callback(target.throw, DownloadTimeoutError())
+    from eventlet import hubs
+    return hubs.get_hub().schedule_call_global(0, target.throw, DownloadTimeoutError())
+
+def _kill_children_using(path):
+    """结束本进程中命令行包含 path 的子进程（进程内引擎为本任务启动的 FFmpeg）"""
+    proc = Path('/proc')
+    if not proc.is_dir():
+        return
+    for entry in proc.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            ppid = int((entry / 'stat').read_text().rsplit(')', 1)[1].split()[1])
+            if ppid != os.getpid():
+                continue
+            if path in (entry / 'cmdline').read_bytes().decode('utf-8', errors='replace'):
+                os.kill(int(entry.name), signal.SIGKILL)
+        except (OSError, IndexError, ValueError):
+            continue
+
+class InprocessWatchdog:
+    """进程内引擎的看门狗：与 run_supervised 相同的总超时和无活动超时
+    
+    活动来自 yt-dlp 的日志、进度和后处理回调，后处理期间只检查总超时。
+    触发后先结束本任务目录下的子进程（FFmpeg），再向下载线程 / 协程注入 DownloadTimeoutError；
+    提取、分片重试等不经过 progress hook 的阶段同样可以被中断。
+    """
+    def __init__(self, timeout, stall_timeout, job_dir):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.job_dir = str(job_dir)
+        self.reason = None  # timeout / stall
+        self.interrupted = False
+        self.postprocessing = False
+        self._start = self._last_activity = time.monotonic()
+        self._target = None
+        self._pending = None
+        self._done = False
+        self._lock = threading.Lock()
+    
+    def touch(self):
+        self._last_activity = time.monotonic()
+    
+    def extend(self, seconds):
+        """回调内的等待（如后处理槽位）不计入超时"""
+        self._start += seconds
+        self._last_activity += seconds
+    
+    def start(self):
+        self._target = _current_task()
+        threading.Thread(target=self._watch, name='inprocess-watchdog', daemon=True).start()
+    
+    def stop(self):
+        """下载调用返回后停止，并撤销尚未送达的中断"""
+        while True:
+            try:
+                with self._lock:
+                    self._done = True
+                    if ASYNC_MODE == 'threading':
+                        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self._target), None)
+                    elif self._pending is not None:
+                        getattr(self._pending, 'stop', getattr(self._pending, 'cancel', lambda: None))()
+                return
+            except DownloadTimeoutError:
+                continue  # 停止前刚好送达的中断
+    
+    def _watch(self):
+        next_interrupt = 0.0
+        while True:
+            time.sleep(1.0)
+            now = time.monotonic()
+            if self.reason is None:
+                if now - self._start > self.timeout:
+                    self.reason = "timeout"
+                elif self.stall_timeout and not self.postprocessing and now - self._last_activity > self.stall_timeout:
+                    self.reason = "stall"
+            with self._lock:
+                if self._done:
+                    return
+                if self.reason is None or now < next_interrupt:
+                    continue
+                _kill_children_using(self.job_dir)
+                self._pending = _interrupt_task(self._target)
+                self.interrupted = True
+            # yt-dlp 可能吞掉单次异常，宽限期后仍未返回则再次中断
+            next_interrupt = now + config.PROCESS_KILL_GRACE
+
+# 🔧 按上游主机限速
+class HostRateLimiter:
+    """令牌桶限速器，所有会话共享，按上游主机分桶"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._buckets = {}  # host -> [tokens, last_refill]
+        self._lock = threading.Lock()
+    
+    def acquire(self, host):
+        """获取一个令牌，必要时等待"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+def upstream_host(url):
+    """归一化上游主机名，youtu.be 与 youtube.com 共用一个桶"""
+    host = (urlparse(url).hostname or '').lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    if host == 'youtu.be':
+        host = 'youtube.com'
+    return host
+
+def finished_files(directory):
+    """列出目录中已完成的文件（忽略未完成的分片和隐藏文件）"""
+    return [
+        f for f in directory.iterdir()
+        if f.is_file() and not f.name.startswith('.') and not f.name.endswith(('.part', '.ytdl'))
+    ]
+
+# 🔧 内容寻址的共享下载存储
+class SharedStore:
+    """按 (视频ID, 格式选项) 去重存储下载结果，会话目录通过硬链接引用
+    
+    同一键的并发请求只下载一次：首个请求成为 leader，其余挂靠等待结果。
+    """
+    def __init__(self, root):
+        self.root = root
+        self._inflight = {}  # key -> 等待结果的回调列表
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key_for(video_id, options):
+        """由视频ID和影响输出的下载选项生成键（忽略传输配置）
+        
+        cookies 以文件内容摘要参与计算：用某个账号下载的私有 / 会员视频不会共享给其他会话。
+        """
+        relevant = []
+        skip_next = False
+        for i, option in enumerate(options):
+            if skip_next:
+                skip_next = False
+                continue
+            if option == "--cookies":
+                relevant.append(f"--cookies={cookies_identity(options[i + 1]) if i + 1 < len(options) else ''}")
+                skip_next = True
+                continue
+            if option in TRANSFER_OPTIONS:
+                skip_next = True
+                continue
+            relevant.append(option)
+        digest = hashlib.sha1(f"{video_id}|{json.dumps(relevant)}".encode('utf-8')).hexdigest()
+        return f"{video_id}_{digest[:16]}"
+    
+    def lookup(self, key):
+        item_dir = self.root / key
+        if not item_dir.is_dir():
+            return None
+        return finished_files(item_dir) or None
+    
+    def begin(self, key, on_ready):
+        """返回 ("hit", 文件列表) / ("follower", None) / ("leader", None)"""
+        with self._lock:
+            files = self.lookup(key)
+            if files:
+                return "hit", files
+            if key in self._inflight:
+                self._inflight[key].append(on_ready)
+                return "follower", None
+            self._inflight[key] = []
+            return "leader", None
+    
+    def complete(self, key, staging_dir):
+        """leader 完成后调用：将成品移入存储并通知挂靠者；失败时 staging_dir 为 None"""
+        files = []
+        if staging_dir is not None:
+            item_dir = self.root / key
+            item_dir.mkdir(parents=True, exist_ok=True)
+            for file_path in finished_files(staging_dir):
+                target = item_dir / file_path.name
+                os.replace(file_path, target)
+                files.append(target)
+        
+        with self._lock:
+            followers = self._inflight.pop(key, [])
+        for callback in followers:
+            try:
+                callback(files or None)
+            except Exception as e:
+                app.logger.error(f"Shared store callback error: {str(e)}")
+        return files
+    
+    @staticmethod
+    def link_into(files, download_dir):
+        """在会话目录中创建硬链接，跨文件系统时退回复制"""
+        targets = []
+        for file_path in files:
+            target = download_dir / file_path.name
+            targets.append(target)
+            if target.exists():
+                continue
+            try:
+                os.link(file_path, target)
+            except OSError:
+                shutil.copy2(file_path, target)
+        return targets
+    
+    def discard(self, stored):
+        """会话文件被淘汰后删除对应的存储副本（已无其他会话引用时），返回是否删除"""
+        file_path = self.root / stored
+        with self._lock:
+            if file_path.parent.name in self._inflight:
+                return False
+        try:
+            if file_path.stat().st_nlink > 1:
+                return False
+            file_path.unlink()
+        except FileNotFoundError:
+            return False
+        try:
+            file_path.parent.rmdir()
+        except OSError:
+            pass  # 目录中还有其他文件
+        return True
+    
+    def prune(self, max_age):
+        """删除已无会话引用（硬链接数为 1）且超过 max_age 秒的存储文件，由定期清理调用
+        
+        只在检查下载中的键时持有锁，遍历和删除不阻塞 begin / complete；并发删除的文件直接跳过。
+        """
+        if not self.root.exists():
+            return
+        now = time.time()
+        for item_dir in self.root.iterdir():
+            with self._lock:
+                if item_dir.name in self._inflight:
+                    continue
+            try:
+                for file_path in item_dir.iterdir():
+                    try:
+                        stat = file_path.stat()
+                        if stat.st_nlink <= 1 and now - stat.st_mtime > max_age:
+                            file_path.unlink()
+                    except FileNotFoundError:
+                        continue
+                if not any(item_dir.iterdir()):
+                    item_dir.rmdir()
+            except OSError:
+                continue  # 已被删除、不是目录，或期间又有文件写入
+
+shared_store = SharedStore(config.DOWNLOAD_DIR / '.store')
+
+# 🔧 下载任务
+class DownloadJob:
+    """调度器中的单个视频下载任务"""
+    def __init__(self, manager, url, quality, index=0, priority=0, job_id=None, resume_attempts=0,
+                 subscription_id=None, output=None, lane=None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.manager = manager
+        self.session_id = manager.session_id
+        self.url = url
+        self.quality = quality
+        self.index = index
+        self.priority = priority  # 数值越小越优先
+        self.seq = 0
+        self.state = "queued"
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.resume_attempts = resume_attempts  # 崩溃后已恢复的次数
+        self.subscription_id = subscription_id  # 频道同步任务所属订阅，成功后写入下载存档
+        self.output = output or {}  # 输出封装偏好 {container, transcode}
+        self.postprocess = None  # 实际的后处理决定（封装 / 转码、编码、等待时间）
+        self.resources = None  # 资源用量与生效的限制（CPU 秒数、峰值 RSS、写入字节）
+        self.lane = lane  # 调度通道 small / heavy / bulk，入队前由探测结果决定
+        self.estimated_bytes = None
+        self.duration = None
+    
+    @property
+    def staging_dir(self):
+        """任务的临时下载目录，路径固定以便重启后续传 .part / 分片文件"""
+        return config.DOWNLOAD_DIR / '.staging' / self.job_id
+    
+    def to_record(self):
+        """持久化用的任务记录"""
+        return {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "url": self.url,
+            "quality": self.quality,
+            "index": self.index,
+            "state": self.state,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "staging_dir": str(self.staging_dir),
+            "resume_attempts": self.resume_attempts,
+            "subscription_id": self.subscription_id,
+            "output": self.output,
+            "postprocess": self.postprocess,
+            "resources": self.resources,
+            "lane": self.lane,
+            "estimated_bytes": self.estimated_bytes,
+            "duration": self.duration,
+            "owner": WORKER_ID,
+            "updated_at": time.time()
+        }
+
+# 🔧 优先级通道：短任务不被大文件和播放列表拖慢，大任务仍有保底并发
+LANES = ('small', 'heavy', 'bulk')  # 保底满足后也按此顺序分配
+
+def lane_budgets(max_workers):
+    """各通道的 (保底并发, 并发上限)；上限为 0 时 small 可用全部工作线程，heavy / bulk 用一半
+    
+    保底并发不超过通道上限，合计小于工作线程数（按 LANES 顺序截断），至少留一个线程供各通道共用。
+    """
+    configured = {
+        'small': (config.LANE_SMALL_RESERVED, config.LANE_SMALL_WORKERS, max_workers),
+        'heavy': (config.LANE_HEAVY_RESERVED, config.LANE_HEAVY_WORKERS, max(1, max_workers // 2)),
+        'bulk': (config.LANE_BULK_RESERVED, config.LANE_BULK_WORKERS, max(1, max_workers // 2)),
+    }
+    budgets = {}
+    unreserved = max_workers - 1
+    for lane in LANES:
+        reserved, limit, default = configured[lane]
+        limit = max(1, min(max_workers, limit or default))
+        reserved = min(max(0, reserved), limit, unreserved)
+        unreserved -= reserved
+        budgets[lane] = (reserved, limit)
+    return budgets
+
+def job_lane(quality, estimated_bytes=None, duration=None, bulk=False):
+    """按探测得到的大小 / 时长分配通道；没有探测结果时按画质判断"""
+    if bulk:
+        return 'bulk'
+    if estimated_bytes is None and duration is None:
+        return 'heavy' if quality in HEAVY_QUALITIES else 'small'
+    if (estimated_bytes or 0) >= config.LANE_HEAVY_BYTES or (duration or 0) >= config.LANE_HEAVY_DURATION:
+        return 'heavy'
+    return 'small'
+
+metric_lane_admitted = metrics.register(MetricCounter(
+    'ytdl_lane_admitted_total', '按通道统计的入队任务数', ('lane',)))
+metric_lane_wait = metrics.register(MetricHistogram(
+    'ytdl_lane_wait_seconds', '任务从入队到开始执行的等待时间', DURATION_BUCKETS, ('lane',)))
+
+# 🔧 全局下载调度器
+class DownloadScheduler:
+    """进程级调度器：固定数量的工作线程 + 按通道的优先级队列 + 会话公平分配"""
+    def __init__(self, max_workers, max_queue, session_max_active, lanes=None):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(1, max_queue)
+        self.session_max_active = max(1, session_max_active)
+        self.lanes = lanes or lane_budgets(self.max_workers)  # lane -> (保底并发, 并发上限)
+        self._queues = {lane: {} for lane in LANES}  # lane -> session_id -> [(priority, seq, job)] 小顶堆
+        self._active = {}        # session_id -> 运行中的任务数
+        self._lane_active = {}   # lane -> 运行中的任务数
+        self._last_served = {}   # session_id -> 上次分配到工作线程的时间
+        self._queued_count = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._avg_duration = 60.0  # 任务平均耗时（秒），用于估算重试时间
+
+    def start(self):
+        """启动工作线程（幂等）"""
+        with self._cond:
+            if self._workers:
+                return
+            for i in range(self.max_workers):
+                worker = threading.Thread(
+                    target=self._worker_loop,
+                    name=f"download-worker-{i}",
+                    daemon=True
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, jobs, force=False):
+        """提交一批任务，全部接受或全部拒绝；返回 (是否接受, 建议重试秒数)
+        
+        force=True 时忽略队列上限（用于恢复崩溃前已接受的任务，以及已做背压的播放列表展开）。
+        """
+        self.start()
+        with self._cond:
+            if not force and self._queued_count + len(jobs) > self.max_queue:
+                return False, self._estimate_wait_locked()
+            for job in jobs:
+                job.seq = next(self._seq)
+                job.lane = job.lane if job.lane in self._queues else job_lane(job.quality)
+                heapq.heappush(self._queues[job.lane].setdefault(job.session_id, []),
+                               (job.priority, job.seq, job))
+                self._queued_count += 1
+                metric_lane_admitted.inc(lane=job.lane)
+            self._cond.notify_all()
+        self._publish_positions()
+        return True, 0
+
+    def reclassify(self, job, lane):
+        """将仍在排队的任务移到另一个通道，返回是否移动（已开始的任务保持原通道）"""
+        with self._cond:
+            if lane == job.lane or lane not in self._queues:
+                return False
+            heap = self._queues[job.lane].get(job.session_id)
+            entry = (job.priority, job.seq, job)
+            if not heap or entry not in heap:
+                return False
+            heap.remove(entry)
+            if heap:
+                heapq.heapify(heap)
+            else:
+                del self._queues[job.lane][job.session_id]
+            job.lane = lane
+            heapq.heappush(self._queues[lane].setdefault(job.session_id, []), entry)
+            self._cond.notify_all()
+        self._publish_positions()
+        return True
+
+    def wait_for_capacity(self, session_id, limit, timeout=None, cancelled=None):
+        """阻塞直到该会话排队任务少于 limit 且全局队列未满（流式提交的背压）
+        
+        超过 timeout 秒或 cancelled() 为真时放弃等待，返回 False。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while (sum(len(queues.get(session_id, ())) for queues in self._queues.values()) >= limit
+                   or self._queued_count >= self.max_queue):
+                if cancelled and cancelled():
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(1.0 if remaining is None else min(remaining, 1.0))
+            return True
+    
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.max_workers,
+                "queued": self._queued_count,
+                "active": sum(self._active.values()),
+                "max_queue": self.max_queue,
+                "lanes": {
+                    lane: {
+                        "queued": sum(len(heap) for heap in self._queues[lane].values()),
+                        "active": self._lane_active.get(lane, 0),
+                        "reserved": reserved,
+                        "limit": limit
+                    }
+                    for lane, (reserved, limit) in self.lanes.items()
+                }
+            }
+
+    def _estimate_wait_locked(self):
+        rounds = math.ceil((self._queued_count + 1) / self.max_workers)
+        return max(5, int(rounds * self._avg_duration))
+
+    def _select_session(self, queues, active, last_served, respect_limit=True):
+        """公平分配：先比较优先级，再选运行任务最少、最久未被服务的会话"""
+        best_key, best_sid = None, None
+        for sid, heap in queues.items():
+            if not heap:
+                continue
+            running = active.get(sid, 0)
+            if respect_limit and running >= self.session_max_active:
+                continue
+            priority, seq, _ = heap[0]
+            key = (priority, running, last_served.get(sid, 0), seq)
+            if best_key is None or key < best_key:
+                best_key, best_sid = key, sid
+        return best_sid
+
+    def _select(self, queues, active, lane_active, last_served, respect_limit=True):
+        """先满足各通道的保底并发，再按 LANES 顺序分配；通道内按会话公平，返回 (lane, session_id)
+        
+        有排队任务的通道，其保底线程不借给其他通道：任一通道启动任务后，剩余空闲线程仍须足够
+        这些通道补足各自的保底并发；没有排队任务的通道的保底线程可被借用。
+        """
+        free = self.max_workers - sum(lane_active.values())
+        unmet = {lane: max(0, reserved - lane_active.get(lane, 0)) if any(queues[lane].values()) else 0
+                 for lane, (reserved, _) in self.lanes.items()}
+        best = None
+        for rank, lane in enumerate(LANES):
+            reserved, limit = self.lanes[lane]
+            running = lane_active.get(lane, 0)
+            if respect_limit and running >= limit:
+                continue
+            if respect_limit and free - 1 < sum(unmet.values()) - unmet[lane]:
+                continue  # 会占用其他通道的保底线程
+            sid = self._select_session(queues[lane], active, last_served, respect_limit)
+            if sid is not None and (best is None or (running >= reserved, rank) < best[0]):
+                best = ((running >= reserved, rank), lane, sid)
+        return (best[1], best[2]) if best else (None, None)
+
+    def _positions_locked(self):
+        """模拟分配顺序，计算每个会话最靠前任务的排队位置"""
+        queues = {lane: {sid: sorted(heap) for sid, heap in lane_queues.items()}
+                  for lane, lane_queues in self._queues.items()}
+        active = dict(self._active)
+        lane_active = dict(self._lane_active)
+        last_served = dict(self._last_served)
+        positions = {}
+        position = 0
+        while True:
+            lane, sid = self._select(queues, active, lane_active, last_served, respect_limit=False)
+            if sid is None:
+                break
+            _, _, job = queues[lane][sid].pop(0)
+            position += 1
+            positions.setdefault(sid, (job.manager, position))
+            active[sid] = active.get(sid, 0) + 1
+            lane_active[lane] = lane_active.get(lane, 0) + 1
+            last_served[sid] = time.monotonic() + position
+        return positions
+
+    def _publish_positions(self):
+        with self._cond:
+            positions = self._positions_locked()
+        for manager, position in positions.values():
+            manager.update_queue_position(position)
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                lane, sid = self._select(self._queues, self._active, self._lane_active, self._last_served)
+                if sid is not None:
+                    break
+                self._cond.wait()
+            _, _, job = heapq.heappop(self._queues[lane][sid])
+            if not self._queues[lane][sid]:
+                del self._queues[lane][sid]
+            self._queued_count -= 1
+            self._active[sid] = self._active.get(sid, 0) + 1
+            self._lane_active[lane] = self._lane_active.get(lane, 0) + 1
+            self._last_served[sid] = time.monotonic()
+            self._cond.notify_all()
+            return job
+
+    def _worker_loop(self):
+        while True:
+            job = self._next_job()
+            self._publish_positions()
+            job.state = "running"
+            job.started_at = time.time()
+            metric_lane_wait.observe(job.started_at - job.submitted_at, lane=job.lane)
+            try:
+                job.manager.run_job(job)
+            except Exception as e:
+                app.logger.error(f"Job {job.job_id[:8]} crashed: {str(e)}")
+            finally:
+                duration = time.time() - job.started_at
+                with self._cond:
+                    self._active[job.session_id] -= 1
+                    if self._active[job.session_id] <= 0:
+                        del self._active[job.session_id]
+                    self._lane_active[job.lane] -= 1
+                    self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+                    self._cond.notify_all()
+
+# 下载管理器
+class DownloadManager:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.room = f"session_{session_id}"
+        self.is_downloading = False
+        self.current_progress = {"current": 0, "total": 0, "status": "idle"}
+        self.cookies_manager = CookiesManager(session_id)
+        session = user_sessions.get(session_id)
+        self.download_count = session.download_count if session else 0  # 下载计数
+        self.start_time = None
         self.ffmpeg_path = None
+        self.batch = None  # 当前批次的计数信息
+        self.item_progress = {}  # job_id -> 进行中任务的字节级进度
+        self._batch_lock = threading.Lock()
+        self._last_progress_emit = 0.0
     
     def log_message(self, message):
         safe_message = sanitize_log_message(message)
         app.logger.info(f"[{self.session_id[:8]}] {safe_message}")
-        socketio.emit('log_message', {'message': safe_message}, room=self.room)
+        socket_outbox.log(self.room, safe_message)
     
-    def update_progress(self, current, total, status="downloading"):
+    def update_progress(self, current, total, status="downloading", **extra):
         self.current_progress = {
             "current": current,
             "total": total,
             "status": status,
             "percentage": int((current / total) * 100) if total > 0 else 0
         }
-        socketio.emit('progress_update', self.current_progress, room=self.room)
+        if status == "downloading" and self.item_progress:
+            self.current_progress.update(self._aggregate_item_progress(current, total))
+        self.current_progress.update(extra)
+        self._last_progress_emit = time.monotonic()
+        socket_outbox.progress(self.room, self.current_progress)
     
-    def check_ffmpeg(self):
-        """改进的 FFmpeg 检查方法"""
-        ffmpeg_paths = [
-            'ffmpeg',  # 系统PATH中的ffmpeg
-            '/usr/bin/ffmpeg',  # 标准安装路径
-            '/usr/local/bin/ffmpeg',  # 自定义安装路径
-        ]
+    def _aggregate_item_progress(self, current, total):
+        """🔧 汇总进行中任务的字节级进度"""
+        items = sorted(self.item_progress.values(), key=lambda item: item["index"])
+        fraction = sum(item["percentage"] for item in items) / 100.0
+        return {
+            "percentage": min(100, int((current + fraction) / total * 100)) if total > 0 else 0,
+            "bytes_downloaded": sum(item["downloaded_bytes"] for item in items),
+            "bytes_total": sum(item["total_bytes"] for item in items),
+            "speed": sum(item["speed"] for item in items),
+            "eta": max((item["eta"] for item in items), default=0),
+            "items": items
+        }
+    
+    def _on_progress(self, job, status):
+        """🔧 记录 yt-dlp 的结构化进度，并按 PROGRESS_EMIT_HZ 合并推送"""
+        state = status.get('status')
+        if state not in ('downloading', 'finished'):
+            return
+        
+        downloaded = status.get('downloaded_bytes') or 0
+        total = status.get('total_bytes') or status.get('total_bytes_estimate') or 0
+        if state == 'finished':
+            total = total or downloaded
+            downloaded = total
+        
+        fragment_index = status.get('fragment_index')
+        fragment_count = status.get('fragment_count')
+        if total:
+            percentage = min(100.0, downloaded * 100.0 / total)
+        elif fragment_index and fragment_count:
+            percentage = min(100.0, fragment_index * 100.0 / fragment_count)
+        else:
+            percentage = 0.0
         
-        for ffmpeg_path in ffmpeg_paths:
-            try:
-                result = subprocess.run([ffmpeg_path, '-version'], 
-                                      capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    self.ffmpeg_path = ffmpeg_path
-                    return True
-            except:
-                continue
+        item = {
+            "index": job.index,
+            "percentage": round(percentage, 1),
+            "downloaded_bytes": int(downloaded),
+            "total_bytes": int(total),
+            "speed": int(status.get('speed') or 0),
+            "eta": int(status.get('eta') or 0),
+            "fragment_index": fragment_index,
+            "fragment_count": fragment_count
+        }
         
-        self.ffmpeg_path = None
-        return False
+        with self._batch_lock:
+            self.item_progress[job.job_id] = item
+            done, total_items = self.batch["done"], self.batch["total"]
+            if time.monotonic() - self._last_progress_emit < 1.0 / config.PROGRESS_EMIT_HZ:
+                return
+            self._last_progress_emit = time.monotonic()
+        self.update_progress(done, total_items, "downloading")
+    
+    def update_queue_position(self, position):
+        """🔧 通过 progress_update 告知排队位置"""
+        batch = self.batch
+        if not batch or batch["started"] > 0:
+            return
+        self.update_progress(0, batch["total"], "queued", queue_position=position)
+    
+    def check_ffmpeg(self):
+        """🔧 读取进程级 FFmpeg 探测缓存，不再每次启动子进程"""
+        ffmpeg_caps.ensure_probed()
+        self.ffmpeg_path = ffmpeg_caps.path
+        return ffmpeg_caps.available
     
-    def get_download_options(self, quality='1080p'):
+    def get_download_options(self, quality='1080p', verbose=True, output=None):
         """🔧 支持画质选择的下载选项配置"""
         has_ffmpeg = self.check_ffmpeg()
         
@@ -361,16 +3527,27 @@ class DownloadManager:
             if has_ffmpeg:
                 format_selector = quality_config['format']
                 base_opts.extend(["--ffmpeg-location", getattr(self, 'ffmpeg_path', 'ffmpeg')])
+                if quality_config.get('extract_audio'):
+                    # 源编码与目标一致时 yt-dlp 只重新封装，不转码
+                    base_opts.extend(["-x", "--audio-format", quality_config['extract_audio'],
+                                      "--audio-quality", "0"])
             else:
                 # 没有FFmpeg时使用简化格式
-                if quality == 'best':
+                if 'fallback_format' in quality_config:
+                    format_selector = quality_config['fallback_format']
+                elif quality == 'best':
                     format_selector = 'best'
                 else:
                     height = quality.replace('p', '')
                     format_selector = f'best[height<={height}]/best'
+                if quality_config.get('extract_audio') and verbose:
+                    self.log_message("⚠️ 未检测到 FFmpeg，音频保持原始编码")
             
             base_opts.extend(["-f", format_selector])
-            self.log_message(f"🎬 使用画质: {quality_config['name']} ({'FFmpeg' if has_ffmpeg else '兼容'}模式)")
+            if quality_config.get('format_sort'):
+                base_opts.extend(["-S", quality_config['format_sort']])
+            if verbose:
+                self.log_message(f"🎬 使用画质: {quality_config['name']} ({'FFmpeg' if has_ffmpeg else '兼容'}模式)")
         else:
             # 默认使用1080p
             if has_ffmpeg:
@@ -378,13 +3555,36 @@ class DownloadManager:
                 base_opts.extend(["--ffmpeg-location", getattr(self, 'ffmpeg_path', 'ffmpeg')])
             else:
                 base_opts.extend(["-f", "best[height<=1080]/best"])
-            self.log_message("🎬 使用默认画质: 1080p")
+            if verbose:
+                self.log_message("🎬 使用默认画质: 1080p")
+        
+        # 🔧 合并时优先选择可直接复制流的封装格式，mkv 兜底，避免转码
+        output = output or {}
+        if has_ffmpeg and not QUALITY_OPTIONS.get(quality, {}).get('audio_only'):
+            container = output.get('container')
+            if container and output.get('transcode'):
+                base_opts.extend(["--recode-video", container])
+            elif container:
+                base_opts.extend(["--merge-output-format", f"{container}/mkv" if container != 'mkv' else 'mkv'])
+            else:
+                base_opts.extend(["--merge-output-format", "mp4/webm/mkv"])
+        
+        # 🔧 按画质的传输配置（并发分片 / 分块 / 外部下载器）
+        profile_opts, profile = download_profile_options(quality)
+        base_opts.extend(profile_opts)
+        if verbose:
+            downloader = profile['external_downloader'] or '内置下载器'
+            self.log_message(f"⚡ 传输配置: {profile['concurrent_fragments'] or 1} 并发分片, {downloader}")
+            requested = download_profiles.get(quality, {}).get('external_downloader')
+            if requested and not profile['external_downloader']:
+                self.log_message(f"⚠️ 未找到 {requested}，使用内置下载器")
         
         # 添加 cookies
         if self.cookies_manager.check_cookies_exist():
             base_opts.extend(["--cookies", str(self.cookies_manager.cookies_file)])
             age = self.cookies_manager.get_cookies_age_days()
-            self.log_message(f"🍪 使用 cookies 文件（{age}天前上传）")
+            if verbose:
+                self.log_message(f"🍪 使用 cookies 文件（{age}天前上传）")
         
         return base_opts
     
@@ -401,7 +3601,7 @@ class DownloadManager:
         
         return True, valid_urls
     
-    def download_video(self, url, download_dir, quality='1080p'):
+    def download_video(self, url, download_dir, quality='1080p', job=None):
         """🔧 支持画质选择的视频下载方法"""
         self.log_message(f"🎬 开始下载: {url[:50]}...")
         
@@ -412,63 +3612,74 @@ class DownloadManager:
         except:
             pass
         
-        cmd = [sys.executable, "-m", "yt_dlp"] + self.get_download_options(quality)
-        cmd.extend(["-P", str(download_dir), url])
+        options = self.get_download_options(quality, output=job.output if job else None)
+        
+        # 🔧 根据画质调整超时时间
+        if quality in HEAVY_QUALITIES:
+            timeout = 1200  # 20分钟，用于高画质
+        else:
+            timeout = 600   # 10分钟，用于标准画质
+        
+        # 🔧 阶段计时：开始 -> 首个进度 = 提取，首个进度 -> 最后一个 finished = 传输，其后 = 后处理
+        phase_marks = {"start": time.monotonic()}
+        
+        def on_progress(status):
+            now = time.monotonic()
+            phase_marks.setdefault("transfer", now)
+            if status.get('status') == 'finished':
+                phase_marks["finished"] = now
+            if job is not None:
+                self._on_progress(job, status)
         
+        tracker = PostprocessTracker()
+        # 🔧 子进程引擎按画质施加资源限制；进程内引擎只能记录本线程的 CPU 时间
+        inprocess = self.use_inprocess_engine()
+        limits = None if inprocess else JobResourceLimits.for_quality(
+            quality, heavy=(job.lane == 'heavy') if job is not None and job.lane else None)
+        usage = JobResourceUsage()
+        thread_cpu = time.thread_time()
         try:
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                universal_newlines=True
-            )
+            try:
+                if inprocess:
+                    returncode, stdout_text, stderr_output = self._run_inprocess(
+                        options, url, download_dir, timeout, on_progress, tracker)
+                else:
+                    returncode, stdout_text, stderr_output = self._run_subprocess(
+                        options, url, download_dir, timeout, on_progress, tracker, limits, usage)
+            finally:
+                tracker.release()
+                if inprocess:
+                    usage.cpu_seconds = round(time.thread_time() - thread_cpu, 2)
+                resources = self._record_resources(usage, limits, quality, download_dir, files_before)
+                if job is not None:
+                    job.postprocess = tracker.decision
+                    job.resources = resources
             
-            # 🔧 根据画质调整超时时间
-            if quality in ['2160p', '1440p', 'best']:
-                timeout = 1200  # 20分钟，用于高画质
-            else:
-                timeout = 600   # 10分钟，用于标准画质
-                
-            start_time = time.time()
-            stdout_lines = []
+            self._record_phases(phase_marks, time.monotonic())
+            if resources["cpu_seconds"] is not None:
+                rss = resources["peak_rss_bytes"]
+                self.log_message(f"📊 资源: CPU {resources['cpu_seconds']}s"
+                                 + (f" · 峰值内存 {rss / 1024 / 1024:.0f}MB" if rss else "")
+                                 + f" · 写入 {(resources['bytes_written'] or 0) / 1024 / 1024:.1f}MB")
+            if tracker.decision["mode"] != "none":
+                decision = tracker.decision
+                self.log_message(f"🎞️ 后处理: {decision['mode']} -> {decision['container'] or '-'}"
+                                 f"（{decision['vcodec'] or '-'} / {decision['acodec'] or '-'}）")
             
-            while True:
-                output = process.stdout.readline()
-                if output == '' and process.poll() is not None:
-                    break
-                    
-                # 检查超时
-                if time.time() - start_time > timeout:
-                    process.terminate()
-                    self.log_message("⏰ 下载超时，已终止")
-                    return False
-                    
-                if output:
-                    stdout_lines.append(output.strip())
-                    clean_output = output.strip()
-                    # 显示重要的进度信息
-                    if any(keyword in clean_output.lower() for keyword in 
-                           ['downloading', '%', 'mb/s', 'kb/s']):
-                        # 显示下载进度
-                        if '%' in clean_output and any(x in clean_output for x in ['ETA', 'at']):
-                            progress_match = re.search(r'(\d+\.?\d*)%', clean_output)
-                            if progress_match:
-                                self.log_message(f"📥 进度: {progress_match.group(1)}%")
-            
-            # 获取错误输出
-            stderr_output = process.stderr.read().strip()
-            stdout_text = '\n'.join(stdout_lines)
+            if returncode is None:
+                metric_download_errors.inc(error_type="timeout")
+                self.log_message("⏰ 下载超时，已终止")
+                return False
             
             # 🔧 智能成功判断逻辑
             success = False
             error_type = "unknown"
             
-            # 方法1: 检查是否有新文件生成（最可靠的方法）
+            # 方法1: 检查是否有新的成品文件生成（最可靠的方法，不计 .part 等未完成文件）
             files_after = set()
             new_files = set()
             try:
-                files_after = {f.name for f in download_dir.iterdir() if f.is_file()}
+                files_after = {f.name for f in finished_files(download_dir)}
                 new_files = files_after - files_before
                 if new_files:
                     success = True
@@ -479,14 +3690,13 @@ class DownloadManager:
             except:
                 pass
             
-            # 方法2: 检查stdout中的成功标志
+            # 方法2: 进程正常退出时检查stdout中的成功标志（"100%" 可能只是某个分轨完成，不作为依据）
             success_indicators = [
                 'download completed',
                 'has already been downloaded', 
-                '100%',
                 'already been recorded'
             ]
-            if any(indicator in stdout_text.lower() for indicator in success_indicators):
+            if returncode == 0 and any(indicator in stdout_text.lower() for indicator in success_indicators):
                 success = True
             
             # 方法3: 分析具体错误类型
@@ -506,6 +3716,8 @@ class DownloadManager:
                     error_type = "download_failed"
             
             # 🔧 最终成功判断和消息显示
+            if not success or error_type == "ffmpeg_postprocess":
+                metric_download_errors.inc(error_type=error_type)
             if success:
                 if error_type == "ffmpeg_postprocess":
                     self.log_message("⚠️ 下载完成，但FFmpeg后处理失败（文件已保存）")
@@ -532,51 +3744,631 @@ class DownloadManager:
                         error_short = stderr_output[:80].replace('\n', ' ').strip()
                         self.log_message(f"❌ 下载失败: {error_short}...")
                     else:
-                        self.log_message(f"❌ 下载失败: 进程返回码 {process.returncode}")
+                        self.log_message(f"❌ 下载失败: 进程返回码 {returncode}")
                 return False
                 
         except Exception as e:
+            metric_download_errors.inc(error_type="exception")
             self.log_message(f"❌ 下载异常: {str(e)[:80]}...")
             return False
     
-    def batch_download(self, urls, quality='1080p'):
-        """🔧 支持画质选择的批量下载"""
-        if self.is_downloading:
-            self.log_message("⚠️ 正在下载中，请等待完成...")
+    @staticmethod
+    def _record_phases(marks, end):
+        transfer_start = marks.get("transfer")
+        if transfer_start is None:
+            # 没有任何进度回调（提取失败或文件已存在），整段计为提取
+            metric_phase_duration.observe(end - marks["start"], phase="extraction")
+            return
+        transfer_end = marks.get("finished", end)
+        metric_phase_duration.observe(transfer_start - marks["start"], phase="extraction")
+        metric_phase_duration.observe(transfer_end - transfer_start, phase="transfer")
+        if "finished" in marks:
+            metric_phase_duration.observe(end - transfer_end, phase="postprocess")
+    
+    def info_key(self, video_id):
+        """本会话的信息缓存键，上传了 cookies 时与其他会话隔离"""
+        cookies_file = self.cookies_manager.cookies_file if self.cookies_manager.check_cookies_exist() else None
+        return info_cache_key(video_id, cookies_file)
+    
+    def use_inprocess_engine(self):
+        """是否使用进程内 yt-dlp 引擎"""
+        return config.DOWNLOAD_ENGINE == 'inprocess' and yt_dlp is not None
+    
+    def _record_resources(self, usage, limits, quality, download_dir, files_before):
+        """汇总任务的资源用量并记录指标，无法采样写入字节时以新文件大小代替"""
+        resources = usage.to_dict()
+        if resources["bytes_written"] is None:
+            try:
+                resources["bytes_written"] = sum(f.stat().st_size for f in download_dir.iterdir()
+                                                 if f.is_file() and f.name not in files_before)
+            except OSError:
+                pass
+        resources["limits"] = limits.to_dict() if limits else None
+        if usage.cpu_seconds is not None:
+            metric_job_cpu.observe(usage.cpu_seconds, quality=quality)
+        if usage.peak_rss_bytes is not None:
+            metric_job_rss.observe(usage.peak_rss_bytes, quality=quality)
+        return resources
+    
+    def _run_subprocess(self, options, url, download_dir, timeout, on_progress, tracker, limits=None, usage=None):
+        """子进程模式：python -m yt_dlp，返回 (返回码, stdout, stderr)，超时返回码为 None
+        
+        进度通过 --progress-template 以 JSON 行输出，不再用正则解析可读文本。
+        """
+        cmd = [sys.executable, "-m", "yt_dlp"] + options
+        cmd.extend(["--newline", "--progress-template", f"download:{PROGRESS_LINE_PREFIX}{PROGRESS_TEMPLATE_FIELDS}"])
+        cmd.extend(["-P", str(download_dir)])
+        
+        # 🔧 命中信息缓存时用 --load-info-json 跳过提取，未命中时顺带写出信息供缓存
+        video_id = extract_video_id(url)
+        info_key = self.info_key(video_id)
+        meta_dir = download_dir / '.meta'
+        cached_info = info_cache.get(info_key) if video_id else None
+        if cached_info is not None:
+            meta_dir.mkdir(exist_ok=True)
+            info_file = meta_dir / f"{video_id}.cached.json"
+            info_file.write_text(json.dumps(cached_info), encoding='utf-8')
+            cmd.extend(["--load-info-json", str(info_file)])
+        elif video_id:
+            cmd.extend(["--write-info-json", "-o", "infojson:.meta/%(id)s", url])
+        else:
+            cmd.append(url)
+        
+        stdout_lines = collections.deque(maxlen=500)
+        process_ref = {}
+        
+        def on_line(line):
+            if line.startswith(PROGRESS_LINE_PREFIX):
+                try:
+                    on_progress(json.loads(line[len(PROGRESS_LINE_PREFIX):]))
+                except ValueError:
+                    pass
+                return False
+            stdout_lines.append(line)
+            formats = re.match(r'^\[info\] [\w-]+: Downloading \d+ format\(s\): (\S+)', line)
+            if formats:
+                vcodec, acodec = describe_formats(info_key, formats.group(1))
+                tracker.set_formats(format_id=formats.group(1), vcodec=vcodec, acodec=acodec)
+            postprocessor = POSTPROCESSOR_LINE.match(line)
+            if postprocessor:
+                target = re.search(r'"([^"]+)"$|Destination: (.+)$', line)
+                if target and postprocessor.group(1) in ('Merger', 'VideoConvertor', 'VideoRemuxer', 'ExtractAudio'):
+                    tracker.set_formats(container=Path(target.group(1) or target.group(2)).suffix.lstrip('.'))
+                if gate is not None:
+                    # 槽位由闸门在 ffmpeg 启动前获取
+                    tracker.record(postprocessor.group(1))
+                    return True
+                # 没有闸门时只能在 ffmpeg 启动后暂停整个进程组，获得槽位后继续
+                process = process_ref.get("process")
+                tracker.enter(
+                    postprocessor.group(1),
+                    on_block=lambda: process and _signal_process_group(process, signal.SIGSTOP),
+                    on_resume=lambda: process and _signal_process_group(process, signal.SIGCONT)
+                )
+                return True
+            return None
+        
+        def on_ffmpeg_request(pid):
+            # 已进入合并 / 转码等阶段才占用槽位；只写元数据的调用直接放行
+            if tracker.decision["postprocessors"]:
+                tracker.acquire()
+            gate.grant(pid)
+        
+        gate = FFmpegGate.install(cmd)
+        if gate is not None:
+            gate.on_request = on_ffmpeg_request
+        try:
+            returncode, stderr_output, reason = run_supervised(
+                cmd, timeout, config.DOWNLOAD_STALL_TIMEOUT, on_line,
+                on_start=lambda process: process_ref.update(process=process),
+                limits=limits, usage=usage, gate=gate
+            )
+        finally:
+            if gate is not None:
+                gate.close()
+        if reason == "stall":
+            self.log_message(f"⏰ {config.DOWNLOAD_STALL_TIMEOUT} 秒无任何输出，已终止下载进程")
+        if returncode is None:
+            return None, '\n'.join(stdout_lines), stderr_output
+        
+        if cached_info is None and video_id:
+            info_file = meta_dir / f"{video_id}.info.json"
+            try:
+                cache_video_info(info_key, json.loads(info_file.read_text(encoding='utf-8')))
+            except (OSError, ValueError):
+                pass
+        return returncode, '\n'.join(stdout_lines), stderr_output
+    
+    def _run_inprocess(self, options, url, download_dir, timeout, on_progress, tracker):
+        """🔧 进程内模式：直接驱动 yt_dlp.YoutubeDL，省去解释器启动和提取器初始化
+        
+        复用与子进程模式相同的命令行参数，保证两种模式行为一致。
+        """
+        parsed = yt_dlp.parse_options(options + ["-P", str(download_dir)])
+        ydl_opts = dict(parsed.ydl_opts)
+        # 🔧 看门狗：提取、分片重试和后处理期间不会调用 progress hook，超时由看门狗中断
+        watchdog = InprocessWatchdog(timeout, config.DOWNLOAD_STALL_TIMEOUT, download_dir)
+        collector = YtdlpLogCollector(on_activity=watchdog.touch)
+        ydl_opts['logger'] = collector
+        ydl_opts['noprogress'] = True  # 进度改由 progress_hooks 上报
+        
+        def progress_hook(status):
+            if watchdog.reason:
+                raise DownloadTimeoutError()
+            watchdog.touch()
+            on_progress(status)
+        
+        def postprocessor_hook(status):
+            watchdog.touch()
+            if status.get('status') != 'started':
+                watchdog.postprocessing = False
+                return
+            watchdog.postprocessing = True
+            info = status.get('info_dict') or {}
+            requested = info.get('requested_formats') or [info]
+            tracker.set_formats(
+                format_id=info.get('format_id'),
+                vcodec=next((f.get('vcodec') for f in requested if f.get('vcodec') not in (None, 'none')), None),
+                acodec=next((f.get('acodec') for f in requested if f.get('acodec') not in (None, 'none')), None),
+                container=info.get('ext')
+            )
+            if POSTPROCESSOR_LINE.match(f"[{status.get('postprocessor')}]"):
+                waited = time.monotonic()
+                tracker.enter(status.get('postprocessor'))
+                watchdog.extend(time.monotonic() - waited)
+        
+        info_key = self.info_key(extract_video_id(url))
+        watchdog.start()
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                ydl.add_progress_hook(progress_hook)
+                ydl.add_postprocessor_hook(postprocessor_hook)
+                # 🔧 优先复用缓存的信息字典，跳过网页和格式列表的重新提取
+                info = info_cache.get(info_key) if info_key else None
+                if info is None:
+                    info = ydl.sanitize_info(ydl.extract_info(url, download=False, process=False))
+                    if info_key:
+                        cache_video_info(info_key, info)
+                ydl.process_ie_result(info, download=True)
+                returncode = getattr(ydl, '_download_retcode', 0)
+        except DownloadTimeoutError:
+            returncode = None
+        except yt_dlp.utils.DownloadError as e:
+            collector.error(str(e))
+            returncode = 1
+        finally:
+            watchdog.stop()
+        
+        if watchdog.interrupted:
+            if watchdog.reason == "stall":
+                self.log_message(f"⏰ {config.DOWNLOAD_STALL_TIMEOUT} 秒无任何输出，已中断下载")
+            returncode = None
+        return returncode, collector.stdout_text(), collector.stderr_text()
+    
+    def _assign_lanes(self, jobs):
+        """🔧 入队前按估算大小 / 时长分配调度通道，返回需要探测的任务
+        
+        命中信息缓存的视频直接按探测结果分配；其余先按画质暂定通道，不阻塞请求线程。
+        """
+        pending = []
+        for job in jobs:
+            info_key = self.info_key(extract_video_id(job.url))
+            info = info_cache.get(info_key) if info_key else None
+            if info is not None:
+                self._apply_probe(job, info)
+            elif info_key:
+                pending.append(job)
+            job.lane = job_lane(job.quality, job.estimated_bytes, job.duration)
+        return pending
+    
+    @staticmethod
+    def _apply_probe(job, info):
+        estimate = estimate_quality(info, job.quality)
+        job.estimated_bytes = estimate["bytes"] if estimate and estimate["bytes"] else None
+        job.duration = info.get('duration')
+    
+    def _probe_lanes(self, jobs):
+        """后台探测暂定通道的任务，完成后若仍在排队则移到正确的通道
+        
+        探测结果进入信息缓存，下载时直接复用，不会重复提取。
+        """
+        if not jobs or not config.LANE_PROBE:
             return
+        cookies_file = self.cookies_manager.cookies_file if self.cookies_manager.check_cookies_exist() else None
+        for job in jobs:
+            probe_video(job.url, cookies_file).add_done_callback(
+                lambda future, job=job: self._reclassify(job, future))
+    
+    def _reclassify(self, job, future):
+        try:
+            info = future.result()
+            if info is None or job.state != "queued":
+                return
+            self._apply_probe(job, info)
+            lane = job_lane(job.quality, job.estimated_bytes, job.duration)
+            if download_scheduler.reclassify(job, lane):
+                self.save_job(job)
+        except Exception as e:
+            app.logger.error(f"Lane reclassification failed for {job.job_id[:8]}: {str(e)}")
+    
+    def _new_batch(self, total, quality, expanding=0):
+        self.is_downloading = True
+        self.start_time = time.time()
+        self.batch = {"total": total, "started": 0, "done": 0, "success": 0,
+                      "quality": quality, "expanding": expanding, "finalized": False}
+    
+    def submit_batch(self, urls, quality='1080p', playlist_options=None, output=None):
+        """🔧 将批量下载拆分为任务并提交到全局调度器
+        
+        播放列表 / 频道链接在后台逐条展开，条目边发现边排队。
+        返回 (是否成功, 消息, 建议重试秒数)
+        """
+        if self.is_downloading:
+            return False, "正在下载中，请等待完成", 0
         
         # 验证URLs
         is_valid, result = self.validate_urls(urls)
         if not is_valid:
-            self.log_message(f"❌ URL验证失败: {result}")
-            return
+            return False, result, 0
         
-        urls = result
-        self.is_downloading = True
-        self.start_time = time.time()
-        session = user_sessions[self.session_id]
-        download_dir = session.get_download_dir()
+        collections_urls = [url for url in result if is_collection_url(url)]
+        video_urls = [url for url in result if not is_collection_url(url)]
+        jobs = [DownloadJob(self, url, quality, index=i, output=output) for i, url in enumerate(video_urls, 1)]
+        pending = self._assign_lanes(jobs)
+        
+        # 检查与占用在同一把锁内完成，并发的提交请求只有一个能开始批次
+        with self._batch_lock:
+            if self.is_downloading:
+                return False, "正在下载中，请等待完成", 0
+            self._new_batch(len(jobs), quality, expanding=len(collections_urls))
+            self.batch["output"] = output
+        
+        accepted, retry_after = download_scheduler.submit(jobs)
+        if not accepted:
+            with self._batch_lock:
+                self.is_downloading = False
+                self.batch = None
+            return False, "服务器繁忙，下载队列已满，请稍后重试", retry_after
+        
+        for job in jobs:
+            self.save_job(job)
+        self._probe_lanes(pending)
+        
+        for url in collections_urls:
+            threading.Thread(
+                target=self._expand_collection,
+                args=(url, quality, playlist_options or parse_playlist_options({})[1]),
+                daemon=True
+            ).start()
         
         quality_name = QUALITY_OPTIONS.get(quality, {}).get('name', quality)
-        self.log_message(f"🚀 开始批量下载，共 {len(urls)} 个视频，画质: {quality_name}")
-        self.update_progress(0, len(urls), "starting")
+        if collections_urls:
+            message = f"开始下载 {len(video_urls)} 个视频和 {len(collections_urls)} 个播放列表/频道 (画质: {quality_name})"
+        else:
+            message = f"开始下载 {len(video_urls)} 个视频 (画质: {quality_name})"
+        self.log_message(f"🚀 {message}")
+        return True, message, 0
+    
+    def submit_sync(self, url, quality='1080p', playlist_options=None, output=None):
+        """🔧 增量同步频道：只下载订阅存档中没有的视频
+        
+        返回 (是否成功, 消息或订阅ID, 建议重试秒数)
+        """
+        if self.is_downloading:
+            return False, "正在下载中，请等待完成", 0
+        if not validate_url(url) or not is_collection_url(url):
+            return False, "同步仅支持频道或播放列表链接", 0
+        
+        url = url.rstrip('/')
+        subscription_id = hashlib.sha1(f"{self.session_id}:{url}".encode('utf-8')).hexdigest()[:16]
+        with self._batch_lock:
+            if self.is_downloading:
+                return False, "正在下载中，请等待完成", 0
+            self._new_batch(0, quality, expanding=1)
+            self.batch["output"] = output
+            self.batch["sync"] = {
+                "subscription_id": subscription_id, "started_at": time.time(),
+                "examined": 0, "known": 0, "stopped_early": False, "incomplete": False,
+                "new": [], "downloaded": [], "failed": []
+            }
+        
+        subscription = session_repo.get_subscription(subscription_id) or {
+            "subscription_id": subscription_id,
+            "session_id": self.session_id,
+            "url": url,
+            "created_at": time.time(),
+            "last_sync_at": None,
+            "last_diff": None
+        }
+        session_repo.save_subscription(subscription)
+        threading.Thread(
+            target=self._expand_collection,
+            args=(url, quality, playlist_options or parse_playlist_options({})[1], subscription_id),
+            daemon=True
+        ).start()
+        
+        self.log_message(f"🔄 开始同步: {url[:50]}")
+        return True, subscription_id, 0
+    
+    def _expand_collection(self, url, quality, playlist_options, subscription_id=None):
+        """🔧 惰性展开播放列表 / 频道，每发现一个条目立即提交调度器
         
-        success_count = 0
-        for i, url in enumerate(urls, 1):
-            self.update_progress(i-1, len(urls), "downloading")
-            self.log_message(f"📋 [{i}/{len(urls)}] 处理: {url[:50]}...")
+        指定 subscription_id 时跳过已归档的视频；频道按时间倒序，
+        同一标签页连续遇到 SYNC_KNOWN_STOP 个已归档视频即跳过该标签页的剩余部分。
+        上次同步未枚举完（超时或出错）时本次完整枚举，避免较旧的新视频被提前停止跳过。
+        """
+        count = 0
+        known_streak = {}  # 标签页 -> 连续已归档数
+        skip_tabs = set()
+        entries = None
+        full_scan = False
+        if subscription_id:
+            previous = (session_repo.get_subscription(subscription_id) or {}).get("last_diff") or {}
+            full_scan = bool(previous.get("incomplete"))
+        try:
+            self.log_message(f"📃 正在展开: {url[:50]}...")
+            cookies_file = self.cookies_manager.cookies_file if self.cookies_manager.check_cookies_exist() else None
+            entries = iter_collection_entries(url, playlist_options, cookies_file, skip_tabs)
+            for entry in entries:
+                if subscription_id:
+                    sync = self.batch["sync"]
+                    sync["examined"] += 1
+                    tab = entry["tab"]
+                    if session_repo.archived_ids(subscription_id, [entry["id"]]):
+                        sync["known"] += 1
+                        known_streak[tab] = known_streak.get(tab, 0) + 1
+                        if not full_scan and newest_first(tab) and known_streak[tab] >= config.SYNC_KNOWN_STOP:
+                            sync["stopped_early"] = True
+                            skip_tabs.add(tab)
+                        continue
+                    known_streak[tab] = 0
+                    sync["new"].append({"id": entry["id"], "title": entry.get("title")})
+                
+                # 背压：本会话已排队足够多的条目时暂停枚举；长时间没有空位或会话已清理时停止展开
+                if not download_scheduler.wait_for_capacity(
+                        self.session_id, config.PLAYLIST_QUEUE_AHEAD, config.PLAYLIST_QUEUE_TIMEOUT,
+                        cancelled=lambda: self.session_id not in user_sessions):
+                    self.log_message(f"⏰ 等待排队空位超时，停止展开（已加入 {count} 个）: {url[:50]}")
+                    if subscription_id:
+                        self.batch["sync"]["incomplete"] = True
+                    break
+                with self._batch_lock:
+                    self.batch["total"] += 1
+                    index = self.batch["total"]
+                job = DownloadJob(self, entry["url"], quality, index=index, priority=1,
+                                  subscription_id=subscription_id, output=self.batch.get("output"), lane='bulk')
+                job.duration = entry.get("duration")
+                self.save_job(job)
+                download_scheduler.submit([job], force=True)
+                count += 1
+            self.log_message(f"📃 展开完成，共 {count} 个视频: {url[:50]}")
+        except Exception as e:
+            self.log_message(f"❌ 播放列表展开失败: {str(e)[:80]}")
+            if subscription_id:
+                self.batch["sync"]["incomplete"] = True
+        finally:
+            try:
+                if entries is not None:
+                    entries.close()  # 提前停止时结束枚举子进程
+            finally:
+                with self._batch_lock:
+                    self.batch["expanding"] -= 1
+                self._maybe_finish_batch()
+    
+    def _report_sync(self, sync):
+        """保存并推送本次同步的增量结果"""
+        subscription_id = sync["subscription_id"]
+        try:
+            diff = dict(sync, finished_at=time.time(),
+                        archive_size=session_repo.archive_size(subscription_id))
+            subscription = session_repo.get_subscription(subscription_id)
+            if subscription:
+                subscription.update(last_sync_at=diff["finished_at"], last_diff=diff)
+                session_repo.save_subscription(subscription)
+            socket_outbox.event(self.room, 'sync_result', diff)
+            self.log_message(
+                f"🔄 同步完成：新增 {len(diff['new'])} 个，已下载 {len(diff['downloaded'])} 个，"
+                f"失败 {len(diff['failed'])} 个，跳过已存档 {diff['known']} 个"
+            )
+        except Exception as e:
+            app.logger.error(f"Failed to report sync {subscription_id}: {str(e)}")
+    
+    def resume_jobs(self, records):
+        """🔧 重新排队崩溃前未完成的任务，沿用原临时目录以便续传"""
+        jobs = [
+            DownloadJob(self, record['url'], record['quality'], index=i,
+                        job_id=record['job_id'], resume_attempts=record['resume_attempts'],
+                        subscription_id=record.get('subscription_id'), output=record.get('output'),
+                        lane=record.get('lane'))
+            for i, record in enumerate(records, 1)
+        ]
+        with self._batch_lock:
+            if self.batch:
+                self.batch["total"] += len(jobs)
+            else:
+                self._new_batch(len(jobs), jobs[0].quality)
+        for job in jobs:
+            self.save_job(job)
+        download_scheduler.submit(jobs, force=True)
+        self.log_message(f"♻️ 服务重启，已恢复 {len(jobs)} 个未完成的下载任务")
+    
+    def save_job(self, job):
+        """持久化任务状态，失败不影响下载本身"""
+        try:
+            session_repo.save_job(job.to_record())
+        except Exception as e:
+            app.logger.error(f"Failed to persist job {job.job_id[:8]}: {str(e)}")
+    
+    def run_job(self, job):
+        """由调度器工作线程调用，执行单个下载任务"""
+        success = False
+        staging_dir = None
+        store_key = None   # 作为首个下载者持有的共享存储键
+        detached = False   # 挂靠到其他会话正在进行的相同下载
+        try:
+            with self._batch_lock:
+                self.batch["started"] += 1
+                done, total = self.batch["done"], self.batch["total"]
+            self.save_job(job)
+            self.update_progress(done, total, "downloading")
+            self.log_message(f"📋 [{job.index}/{total}] 处理: {job.url[:50]}...")
             
-            if self.download_video(url, download_dir, quality):
-                success_count += 1
-                self.download_count += 1
+            download_dir = user_sessions[self.session_id].get_download_dir()
+            video_id = extract_video_id(job.url)
+            
+            # 🔧 磁盘配额：空间不足时先淘汰旧文件，仍不足则放弃本任务
+            # 先于共享存储准入，避免成为 leader 后被拒绝导致挂靠的任务一起失败
+            admitted, reason = storage_manager.admit(self.session_id, job.quality, self.info_key(video_id),
+                                                     job_id=job.job_id)
+            if not admitted:
+                self.log_message(f"💾 {reason}")
+                return
+            
+            # 🔧 共享存储：相同视频 + 相同格式只下载一次
+            if video_id:
+                key = shared_store.key_for(video_id, self.get_download_options(job.quality, verbose=False,
+                                                                               output=job.output))
+                state, files = shared_store.begin(
+                    key, lambda files: self._attach_shared_result(job, files, download_dir)
+                )
+                if state == "hit":
+                    file_catalog.register(self.session_id, shared_store.link_into(files, download_dir), stored=files)
+                    self.log_message(f"♻️ 已从共享存储获取: {files[0].name[:40]}")
+                    success = True
+                    return
+                if state == "follower":
+                    detached = True
+                    self.log_message("🔗 相同视频正在下载中，完成后自动共享")
+                    return
+                store_key = key
+            
+            # 每个任务使用独立的临时目录，避免并行下载互相干扰文件检测
+            staging_dir = job.staging_dir
+            staging_dir.mkdir(parents=True, exist_ok=True)
             
-            # 添加延迟，避免被反爬虫
-            time.sleep(2)
+            # 添加限速，避免被反爬虫；已缓存信息（探测过）的视频下载时不再提取网页，无需再取令牌
+            if not video_id or info_cache.get(self.info_key(video_id)) is None:
+                host_rate_limiter.acquire(upstream_host(job.url))
+            
+            downloaded = self.download_video(job.url, staging_dir, job.quality, job)
+            # 🔧 以实际登记的成品文件为准：没有成品文件的任务不算成功，也不写入下载存档
+            if store_key:
+                files = shared_store.complete(store_key, staging_dir if downloaded else None)
+                store_key = None
+                if files:
+                    file_catalog.register(self.session_id, shared_store.link_into(files, download_dir), stored=files)
+                    self._record_bytes(job, files)
+                success = bool(files)
+            elif downloaded:
+                targets = self.collect_files(staging_dir, download_dir)
+                file_catalog.register(self.session_id, targets)
+                self._record_bytes(job, targets)
+                success = bool(targets)
+            if downloaded and not success:
+                self.log_message(f"⚠️ 未找到已完成的文件，按失败处理: {job.url[:50]}...")
+        finally:
+            storage_manager.release(job.job_id)
+            if store_key:
+                shared_store.complete(store_key, None)
+            if staging_dir is not None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+            if not detached:
+                self.finish_job(job, success)
+    
+    @staticmethod
+    def _record_bytes(job, paths):
+        try:
+            metric_download_bytes.observe(sum(path.stat().st_size for path in paths), quality=job.quality)
+        except OSError:
+            pass
+    
+    def _attach_shared_result(self, job, files, download_dir):
+        """挂靠的任务在首个下载者完成后调用"""
+        if files:
+            file_catalog.register(self.session_id, shared_store.link_into(files, download_dir), stored=files)
+            self.log_message(f"♻️ 已共享下载结果: {files[0].name[:40]}")
+        else:
+            self.log_message(f"❌ 共享下载失败: {job.url[:50]}...")
+        self.finish_job(job, bool(files))
+    
+    def collect_files(self, staging_dir, download_dir):
+        """将临时目录中的成品文件移动到会话目录"""
+        targets = []
+        for file_path in finished_files(staging_dir):
+            target = download_dir / file_path.name
+            os.replace(file_path, target)
+            targets.append(target)
+        return targets
+    
+    def finish_job(self, job, success):
+        """记录任务结果，整批结束时汇报"""
+        job.state = "completed" if success else "failed"
+        job.finished_at = time.time()
+        self.save_job(job)
+        if job.started_at:
+            metric_download_duration.observe(job.finished_at - job.started_at, quality=job.quality,
+                                             result="success" if success else "failure")
+        video_id = extract_video_id(job.url)
+        if success and job.subscription_id and video_id:
+            try:
+                session_repo.add_to_archive(job.subscription_id, video_id, job.finished_at)
+            except Exception as e:
+                app.logger.error(f"Failed to archive {video_id}: {str(e)}")
         
-        elapsed_time = int(time.time() - self.start_time)
-        self.update_progress(len(urls), len(urls), "completed")
-        self.log_message(f"🎉 批量下载完成！成功: {success_count}/{len(urls)} 用时: {elapsed_time}秒")
-        self.is_downloading = False
+        with self._batch_lock:
+            self.item_progress.pop(job.job_id, None)
+            batch = self.batch
+            batch["done"] += 1
+            if success:
+                batch["success"] += 1
+                self.download_count += 1
+            sync = batch.get("sync")
+            if sync and job.subscription_id == sync["subscription_id"]:
+                sync["downloaded" if success else "failed"].append(video_id)
+            done, total = batch["done"], batch["total"]
+        
+        session = user_sessions.get(self.session_id)
+        if success and session:
+            session.save()
+        
+        if not self._maybe_finish_batch():
+            self.update_progress(done, total, "downloading")
+    
+    def _maybe_finish_batch(self):
+        """所有任务完成且没有正在展开的播放列表时结束批次，返回是否已结束"""
+        with self._batch_lock:
+            batch = self.batch
+            if not batch or batch["finalized"] or batch["expanding"] or batch["done"] < batch["total"]:
+                return False
+            batch["finalized"] = True
+            total, success_count = batch["total"], batch["success"]
+        
+        try:
+            elapsed_time = int(time.time() - self.start_time)
+            self.update_progress(total, total, "completed")
+            self.log_message(f"🎉 批量下载完成！成功: {success_count}/{total} 用时: {elapsed_time}秒")
+            if batch.get("sync"):
+                self._report_sync(batch["sync"])
+        finally:
+            # 汇报失败也要结束批次，否则会话无法再提交下载
+            self.batch = None
+            self.is_downloading = False
+        return True
+
+# 🔧 全局调度器与限速器实例，所有会话共享
+host_rate_limiter = HostRateLimiter(config.HOST_RATE_LIMIT, config.HOST_RATE_BURST)
+download_scheduler = DownloadScheduler(
+    config.MAX_CONCURRENT_DOWNLOADS,
+    config.MAX_QUEUE_SIZE,
+    config.SESSION_MAX_ACTIVE
+)
+
+metrics.register(MetricGauge('ytdl_queue_depth', '等待执行的下载任务数',
+                             lambda: download_scheduler.stats()["queued"]))
+metrics.register(MetricGauge('ytdl_active_downloads', '正在执行的下载任务数',
+                             lambda: download_scheduler.stats()["active"]))
+metrics.register(MetricGauge('ytdl_workers', '下载工作线程数 (MAX_CONCURRENT_DOWNLOADS)',
+                             lambda: download_scheduler.max_workers))
 
 # Flask 路由
 @app.route('/')
@@ -679,16 +4471,29 @@ def api_download():
         if session.download_manager.download_count > 20:  # 每日限制
             return jsonify({"error": "今日下载次数已达上限"}), 429
         
-        threading.Thread(
-            target=session.download_manager.batch_download,
-            args=(valid_urls, quality),  # 🔧 传递画质参数
-            daemon=True
-        ).start()
+        # 🔧 播放列表 / 频道参数
+        playlist_ok, playlist_options = parse_playlist_options(data.get('playlist'))
+        if not playlist_ok:
+            return jsonify({"error": playlist_options}), 400
+        
+        # 🔧 输出封装偏好（默认只做无损重新封装）
+        output_ok, output_options = parse_output_options(data.get('output'))
+        if not output_ok:
+            return jsonify({"error": output_options}), 400
+        
+        # 🔧 提交到全局调度器，队列满时返回 429 和重试建议
+        accepted, message, retry_after = session.download_manager.submit_batch(
+            valid_urls, quality, playlist_options, output_options)
+        if not accepted:
+            if retry_after:
+                return jsonify({"error": message, "retry_after": retry_after}), 429, {"Retry-After": str(retry_after)}
+            return jsonify({"error": message}), 409
         
-        app.logger.info(f"Download started for session {session_id[:8]}: {len(valid_urls)} URLs, quality: {quality}")
+        app.logger.info(f"Download queued for session {session_id[:8]}: {len(valid_urls)} URLs, quality: {quality}")
         return jsonify({
-            "message": f"开始下载 {len(valid_urls)} 个视频 (画质: {QUALITY_OPTIONS[quality]['name']})",
-            "session_id": session_id
+            "message": message,
+            "session_id": session_id,
+            "queue": download_scheduler.stats()
         })
         
     except Exception as e:
@@ -705,10 +4510,13 @@ def api_status():
             session.download_manager = DownloadManager(session_id)
         
         should_update, message = session.download_manager.cookies_manager.should_update_cookies()
+        # 其他 worker 处理中的任务同样视为下载中（本进程已在下载时无需查询）
+        is_downloading = session.download_manager.is_downloading or bool(
+            session_repo.list_jobs(session_id, states=("queued", "running"), limit=1))
         
         return jsonify({
             "session_id": session_id,
-            "is_downloading": session.download_manager.is_downloading,
+            "is_downloading": is_downloading,
             "progress": session.download_manager.current_progress,
             "cookies": {
                 "exists": session.download_manager.cookies_manager.check_cookies_exist(),
@@ -716,7 +4524,19 @@ def api_status():
                 "status_message": message
             },
             "ffmpeg_available": session.download_manager.check_ffmpeg(),
+            "ffmpeg": ffmpeg_caps.to_dict(),
+            "info_cache": info_cache.stats(),
+            "storage": storage_manager.stats(session_id),
             "download_count": session.download_manager.download_count,
+            "queue": download_scheduler.stats(),
+            "download_engine": "inprocess" if session.download_manager.use_inprocess_engine() else "subprocess",
+            "async_mode": ASYNC_MODE,
+            "download_profiles": download_profiles_status(),
+            "postprocess_workers": config.POSTPROCESS_WORKERS,
+            "job_limits": {
+                "default": JobResourceLimits.for_quality('720p').to_dict(),
+                "heavy": JobResourceLimits.for_quality(HEAVY_QUALITIES[0]).to_dict()
+            },
             "quality_options": QUALITY_OPTIONS  # 🔧 返回画质选项
         })
         
@@ -724,82 +4544,258 @@ def api_status():
         app.logger.error(f"Status API error: {str(e)}")
         return jsonify({"error": "服务器内部错误"}), 500
 
+@app.route('/api/jobs')
+def api_jobs():
+    """🔧 查询当前会话的任务记录（跨 worker、跨重启）"""
+    try:
+        session, session_id = get_or_create_session()
+        jobs = session_repo.list_jobs(session_id, limit=50)
+        return jsonify({"session_id": session_id, "jobs": jobs})
+    except Exception as e:
+        app.logger.error(f"Jobs API error: {str(e)}")
+        return jsonify({"error": "服务器内部错误"}), 500
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """🔧 Prometheus 抓取端点"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/sync', methods=['GET', 'POST'])
+def api_sync():
+    """🔧 频道增量同步：POST 启动同步，GET 查看订阅及上次同步结果"""
+    try:
+        session, session_id = get_or_create_session()
+        
+        if request.method == 'GET':
+            subscriptions = session_repo.list_subscriptions(session_id)
+            for subscription in subscriptions:
+                subscription["archive_size"] = session_repo.archive_size(subscription["subscription_id"])
+            return jsonify({"session_id": session_id, "subscriptions": subscriptions})
+        
+        if not session.download_manager:
+            session.download_manager = DownloadManager(session_id)
+        
+        data = request.get_json()
+        if not data or not data.get('url'):
+            return jsonify({"error": "请提供频道链接"}), 400
+        
+        quality = data.get('quality', '1080p')
+        if quality not in QUALITY_OPTIONS:
+            quality = '1080p'
+        
+        playlist_ok, playlist_options = parse_playlist_options(data.get('playlist'))
+        if not playlist_ok:
+            return jsonify({"error": playlist_options}), 400
+        
+        output_ok, output_options = parse_output_options(data.get('output'))
+        if not output_ok:
+            return jsonify({"error": output_options}), 400
+        
+        accepted, result, _ = session.download_manager.submit_sync(
+            data['url'].strip(), quality, playlist_options, output_options
+        )
+        if not accepted:
+            return jsonify({"error": result}), 409 if session.download_manager.is_downloading else 400
+        
+        app.logger.info(f"Sync started for session {session_id[:8]}: {result}")
+        return jsonify({
+            "message": "同步已开始",
+            "session_id": session_id,
+            "subscription_id": result,
+            "queue": download_scheduler.stats()
+        })
+    except Exception as e:
+        app.logger.error(f"Sync API error: {str(e)}")
+        return jsonify({"error": "服务器内部错误"}), 500
+
+@app.route('/api/formats')
+def api_formats():
+    """🔧 查询视频可用格式（复用信息缓存）"""
+    try:
+        session, session_id = get_or_create_session()
+        url = request.args.get('url', '').strip()
+        if not validate_url(url) or not extract_video_id(url):
+            return jsonify({"error": "请提供有效的 YouTube 视频链接"}), 400
+        
+        cookies_manager = CookiesManager(session_id)
+        cookies_file = cookies_manager.cookies_file if cookies_manager.check_cookies_exist() else None
+        info = fetch_video_info(url, cookies_file)
+        if info is None:
+            return jsonify({"error": "无法获取视频信息"}), 502
+        
+        return jsonify({
+            "session_id": session_id,
+            "video": summarize_formats(info),
+            "info_cache": info_cache.stats()
+        })
+        
+    except Exception as e:
+        app.logger.error(f"Formats API error: {str(e)}")
+        return jsonify({"error": "服务器内部错误"}), 500
+
+@app.route('/api/probe', methods=['POST'])
+def api_probe():
+    """🔧 批量探测多个链接的可用格式、时长和各画质预计大小"""
+    try:
+        session, session_id = get_or_create_session()
+        data = request.get_json()
+        urls = [str(url).strip() for url in (data or {}).get('urls', [])]
+        if not urls:
+            return jsonify({"error": "没有提供有效的 URL"}), 400
+        if len(urls) > config.PROBE_MAX_URLS:
+            return jsonify({"error": f"单次最多探测 {config.PROBE_MAX_URLS} 个链接"}), 400
+        
+        cookies_manager = CookiesManager(session_id)
+        cookies_file = cookies_manager.cookies_file if cookies_manager.check_cookies_exist() else None
+        
+        results = [None] * len(urls)
+        futures = {}
+        for i, url in enumerate(urls):
+            if not validate_url(url) or not extract_video_id(url):
+                results[i] = {"url": url, "ok": False, "error": "不是有效的 YouTube 视频链接"}
+                continue
+            cached = info_cache.get(info_cache_key(extract_video_id(url), cookies_file))
+            if cached is not None:
+                results[i] = {"url": url, "ok": True, "cached": True, **probe_summary(cached)}
+            else:
+                futures[i] = probe_video(url, cookies_file)
+        
+        if futures:
+            wait_futures(futures.values(), timeout=config.PROBE_TIMEOUT)
+        for i, future in futures.items():
+            if not future.done():
+                results[i] = {"url": urls[i], "ok": False, "error": "探测超时，请稍后重试"}
+                continue
+            info = future.result()
+            if info is None:
+                results[i] = {"url": urls[i], "ok": False, "error": "无法获取视频信息"}
+            else:
+                results[i] = {"url": urls[i], "ok": True, "cached": False, **probe_summary(info)}
+        
+        return jsonify({"session_id": session_id, "results": results, "info_cache": info_cache.stats()})
+    
+    except Exception as e:
+        app.logger.error(f"Probe API error: {str(e)}")
+        return jsonify({"error": "服务器内部错误"}), 500
+
+@app.route('/api/ffmpeg/refresh', methods=['POST'])
+def api_ffmpeg_refresh():
+    """🔧 显式刷新 FFmpeg 能力缓存（例如安装 FFmpeg 之后）
+    
+    运维接口：nginx 只允许内网访问，应用内再限制刷新频率。
+    """
+    try:
+        retry_after = ffmpeg_caps.refresh_retry_after()
+        if retry_after:
+            return jsonify({"error": "刷新过于频繁，请稍后重试", "retry_after": retry_after}), 429, \
+                {"Retry-After": str(retry_after)}
+        return jsonify({"ffmpeg": ffmpeg_caps.refresh()})
+    except Exception as e:
+        app.logger.error(f"FFmpeg refresh error: {str(e)}")
+        return jsonify({"error": "服务器内部错误"}), 500
+
 @app.route('/downloads/<session_id>')
 def download_files(session_id):
     """🔧 安全的文件列表"""
     try:
-        # 验证会话ID
-        if not validate_session_id(session_id) or session_id not in user_sessions:
+        # 验证会话ID（持久化存储中的会话在任意 worker 上都可访问）
+        session = load_session(session_id)
+        if not session:
             return jsonify({"error": "会话不存在"}), 404
         
-        session = user_sessions[session_id]
         download_dir = session.get_download_dir()
         
+        # 🔧 读取文件目录索引，版本号作为 ETag
+        version, records = file_catalog.listing(session_id, download_dir)
+        etag = f"{session_id[:8]}-{version}"
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        
         files = []
-        try:
-            for file_path in download_dir.iterdir():
-                if file_path.is_file() and file_path.stat().st_size > 0:
-                    # 对于长文件名，在前端显示时添加省略号
-                    name = file_path.name
-                    display_name = name
-                    if len(name) > 40:
-                        display_name = name[:37] + "..."
-                    
-                    files.append({
-                        "name": display_name,
-                        "full_name": name,  # 保存完整文件名用于下载
-                        "size": file_path.stat().st_size,
-                        "url": f"/download_file/{session_id}/{name}",
-                        "modified": file_path.stat().st_mtime
-                    })
+        for record in records:
+            # 对于长文件名，在前端显示时添加省略号
+            name = record["name"]
+            display_name = name
+            if len(name) > 40:
+                display_name = name[:37] + "..."
             
-            # 按修改时间排序
-            files.sort(key=lambda x: x['modified'], reverse=True)
-            
-        except PermissionError:
-            app.logger.error(f"Permission denied accessing download dir for session {session_id}")
-            return jsonify({"error": "访问权限不足"}), 403
+            files.append({
+                "id": record["file_id"],
+                "name": display_name,
+                "full_name": name,  # 保存完整文件名
+                "size": record["size"],
+                "url": f"/download_file/{session_id}/{record['file_id']}",
+                "modified": record["modified"]
+            })
         
-        return jsonify({"files": files})
+        # 按修改时间排序
+        files.sort(key=lambda x: x['modified'], reverse=True)
+        
+        response = jsonify({"files": files})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
         
     except Exception as e:
         app.logger.error(f"Download files error: {str(e)}")
         return jsonify({"error": "服务器内部错误"}), 500
 
+def serve_download(download_dir, file_path):
+    """🔧 发送下载文件
+    
+    accel 模式：Python 只做授权，由 nginx 通过 X-Accel-Redirect 内部跳转完成传输；
+    direct 模式：由 Flask 发送，支持 Range 续传、ETag 和条件请求。
+    """
+    if config.FILE_SERVE_MODE != 'accel':
+        return send_file(file_path, as_attachment=True, conditional=True, etag=True, max_age=0)
+    
+    response = app.response_class(status=200)
+    response.headers['X-Accel-Redirect'] = (
+        f"{config.ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quote(download_dir.name)}/{quote(file_path.name)}"
+    )
+    response.headers['Content-Type'] = mimetypes.guess_type(file_path.name)[0] or 'application/octet-stream'
+    try:
+        file_path.name.encode('latin-1')
+        response.headers['Content-Disposition'] = f'attachment; filename="{file_path.name}"'
+    except UnicodeEncodeError:
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(file_path.name)}"
+    return response
+
 @app.route('/download_file/<session_id>/<filename>')
 def download_file(session_id, filename):
     """🔧 安全的文件下载"""
     try:
-        # 验证会话ID
-        if not validate_session_id(session_id) or session_id not in user_sessions:
+        # 验证会话ID（持久化存储中的会话在任意 worker 上都可访问）
+        session = load_session(session_id)
+        if not session:
             return jsonify({"error": "会话不存在"}), 404
         
-        session = user_sessions[session_id]
         download_dir = session.get_download_dir()
         
-        # 查找与请求文件名匹配的文件
+        # 🔧 只通过文件目录索引解析：按稳定文件ID，兼容直接使用完整文件名的旧链接，不扫描目录
+        file_catalog.ensure(session_id, download_dir)
+        record = (file_catalog.resolve(session_id, filename)
+                  or file_catalog.resolve(session_id, file_catalog.file_id_for(session_id, filename)))
+        if not record:
+            return jsonify({"error": "文件不存在"}), 404
+        
         requested_file = None
-        for file_path in download_dir.iterdir():
-            if file_path.is_file() and file_path.name == filename:
-                requested_file = file_path
-                break
-                
-        # 如果没有找到完全匹配的文件，尝试匹配文件名前缀
-        if not requested_file and '...' in filename:
-            prefix = filename.split('...')[0]
-            for file_path in download_dir.iterdir():
-                if file_path.is_file() and file_path.name.startswith(prefix):
-                    requested_file = file_path
-                    break
+        candidate = safe_join(str(download_dir), record["name"])
+        if candidate and os.path.isfile(candidate):
+            requested_file = Path(candidate)
         
         if not requested_file:
+            file_catalog.remove(session_id, [record["name"]])
             return jsonify({"error": "文件不存在"}), 404
         
         # 确保文件在正确目录中
-        if not str(requested_file).startswith(str(download_dir)):
+        if requested_file.parent != download_dir:
             return jsonify({"error": "文件不存在"}), 404
         
-        return send_from_directory(download_dir, requested_file.name, as_attachment=True)
+        storage_manager.touch(session_id, file_catalog.file_id_for(session_id, requested_file.name))
+        return serve_download(download_dir, requested_file)
         
     except Exception as e:
         app.logger.error(f"Download file error: {str(e)}")
@@ -809,8 +4805,14 @@ def download_file(session_id, filename):
 def handle_connect():
     try:
         session, session_id = get_or_create_session()
-        join_room(f"session_{session_id}")
+        room = f"session_{session_id}"
+        join_room(room)
         emit('connected', {'session_id': session_id})
+        # 重连只需一条快照即可恢复界面，无需重放历史事件
+        snapshot = socket_outbox.snapshot(room)
+        if session.download_manager:
+            snapshot['is_downloading'] = session.download_manager.is_downloading
+        emit('snapshot', snapshot)
         app.logger.info(f"Client connected: session {session_id[:8]}")
     except Exception as e:
         app.logger.error(f"Socket connect error: {str(e)}")
@@ -827,44 +4829,79 @@ def handle_disconnect():
 # 🔧 清理任务
 def cleanup_old_sessions():
     """清理旧会话和文件"""
+    cleanup_started = time.monotonic()
     try:
         cutoff_time = datetime.datetime.now() - datetime.timedelta(hours=24)
+        # 🔧 以持久化存储为准，同时覆盖其他 worker 创建的会话
+        expired = set(session_repo.expired_sessions(cutoff_time.timestamp()))
+        expired.update(sid for sid, session in user_sessions.items() if session.last_activity < cutoff_time)
         to_remove = []
         
-        for sid, session in user_sessions.items():
-            if session.last_activity < cutoff_time:
-                to_remove.append(sid)
+        for sid in expired:
+            session = user_sessions.get(sid) or UserSession(sid, session_repo.get_session(sid))
+            if session.last_activity >= cutoff_time:
+                continue
+            if session.download_manager and session.download_manager.is_downloading:
+                continue
+            to_remove.append(sid)
+            
+            # 清理文件
+            try:
+                cookies_file = session.get_cookies_path()
+                if cookies_file.exists():
+                    cookies_file.unlink()
                 
-                # 清理文件
-                try:
-                    cookies_file = session.get_cookies_path()
-                    if cookies_file.exists():
-                        cookies_file.unlink()
+                download_dir = config.DOWNLOAD_DIR / f"session_{sid}"
+                if download_dir.exists():
+                    # 🔧 按文件目录删除旧文件，不再遍历目录
+                    file_catalog.ensure(sid, download_dir)
+                    removed = []
+                    for record in session_repo.list_files(sid):
+                        if time.time() - record.get('modified', 0) > 86400:  # 1天
+                            (download_dir / record['name']).unlink(missing_ok=True)
+                            removed.append(record['name'])
+                    if removed:
+                        file_catalog.remove(sid, removed)
                     
-                    download_dir = session.get_download_dir()
-                    if download_dir.exists():
-                        # 删除旧文件
-                        for file_path in download_dir.iterdir():
-                            if file_path.is_file():
-                                file_age = time.time() - file_path.stat().st_mtime
-                                if file_age > 86400:  # 1天
-                                    file_path.unlink()
+                    # 如果目录为空则删除
+                    try:
+                        download_dir.rmdir()
+                    except OSError:
+                        pass
                         
-                        # 如果目录为空则删除
-                        if not list(download_dir.iterdir()):
-                            download_dir.rmdir()
-                            
-                except Exception as e:
-                    app.logger.error(f"Error cleaning session {sid}: {str(e)}")
+            except Exception as e:
+                app.logger.error(f"Error cleaning session {sid}: {str(e)}")
         
         for session_id in to_remove:
-            del user_sessions[session_id]
+            user_sessions.pop(session_id, None)
+            session_repo.delete_session(session_id)
+            session_repo.delete_jobs(session_id)
+            session_repo.delete_subscriptions(session_id)
+            file_catalog.drop(session_id)
+            socket_outbox.drop_room(f"session_{session_id}")
+        
+        # 🔧 清理不再被任何会话引用的共享存储文件
+        shared_store.prune(86400)
+        prune_staging_dirs(86400)
         
         if to_remove:
             app.logger.info(f"清理了 {len(to_remove)} 个过期会话")
             
     except Exception as e:
         app.logger.error(f"Cleanup error: {str(e)}")
+    finally:
+        metric_cleanup_duration.observe(time.monotonic() - cleanup_started)
+
+def prune_staging_dirs(max_age):
+    """删除不属于任何未完成任务的过期临时目录"""
+    staging_root = config.DOWNLOAD_DIR / '.staging'
+    if not staging_root.exists():
+        return
+    active = {record['job_id'] for record in session_repo.list_jobs(states=("queued", "running"), limit=10000)}
+    now = time.time()
+    for staging_dir in staging_root.iterdir():
+        if staging_dir.name not in active and now - staging_dir.stat().st_mtime > max_age:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
 def start_cleanup_task():
     def cleanup_loop():
@@ -874,6 +4911,117 @@ def start_cleanup_task():
     
     threading.Thread(target=cleanup_loop, daemon=True).start()
 
+def start_storage_task():
+    """🔧 高频检查磁盘水位，突发的大文件下载不必等到每小时清理"""
+    def storage_loop():
+        while True:
+            time.sleep(config.STORAGE_CHECK_INTERVAL)
+            try:
+                storage_manager.enforce()
+            except Exception as e:
+                app.logger.error(f"Storage check error: {str(e)}")
+    
+    threading.Thread(target=storage_loop, daemon=True).start()
+
+# 🔧 崩溃恢复
+def worker_alive(owner, heartbeats, stale_before):
+    """任务归属的 worker 是否存活：心跳未超时，且若在本机，进程仍在运行、PID 未被新 worker 复用"""
+    last_seen = heartbeats.get(owner, 0)
+    if not owner or last_seen <= stale_before:
+        return False
+    host, _, rest = owner.partition(':')
+    pid = rest.split(':', 1)[0]
+    if host != socket.gethostname() or not pid.isdigit():
+        return True  # 其他主机只能依据心跳判断
+    if int(pid) == os.getpid():
+        return False  # 本进程的旧身份（容器重启后 PID 常被复用）
+    prefix = f"{host}:{pid}:"
+    if any(worker_id != owner and worker_id.startswith(prefix) and timestamp > last_seen
+           for worker_id, timestamp in heartbeats.items()):
+        return False  # 同一 PID 上已有更新的 worker
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OverflowError):
+        pass
+    return True
+
+def recover_jobs():
+    """将已退出的 worker 遗留的未完成任务重新排队
+    
+    启动时执行一次，之后随心跳周期执行：重启时旧 worker 的心跳可能尚未超时，
+    存活的 worker 也需要接管其他已退出 worker 的任务。
+    """
+    try:
+        heartbeats = session_repo.worker_heartbeats()
+        stale_before = time.time() - config.WORKER_HEARTBEAT_TIMEOUT
+        by_session = {}
+        
+        for record in session_repo.list_jobs(states=("queued", "running"), limit=10000):
+            owner = record.get('owner')
+            if owner == WORKER_ID or worker_alive(owner, heartbeats, stale_before):
+                continue  # 归属的 worker 仍然存活
+            if not session_repo.claim_job(record['job_id'], owner, WORKER_ID):
+                continue  # 已被其他 worker 接管
+            
+            record['resume_attempts'] = record.get('resume_attempts', 0) + 1
+            session = load_session(record['session_id'])
+            if record['resume_attempts'] > config.MAX_RESUME_ATTEMPTS or not session:
+                record.update(state="failed", owner=WORKER_ID, updated_at=time.time())
+                session_repo.save_job(record)
+                shutil.rmtree(record.get('staging_dir') or '', ignore_errors=True)
+                app.logger.warning(f"Job {record['job_id'][:8]} abandoned after {record['resume_attempts'] - 1} resumes")
+                continue
+            by_session.setdefault(session.session_id, []).append(record)
+        
+        for session_id, records in by_session.items():
+            session = load_session(session_id)
+            if not session.download_manager:
+                session.download_manager = DownloadManager(session_id)
+            records.sort(key=lambda record: record.get('index', 0))
+            session.download_manager.resume_jobs(records)
+        
+        if by_session:
+            count = sum(len(records) for records in by_session.values())
+            app.logger.info(f"恢复了 {count} 个未完成的下载任务")
+    except Exception as e:
+        app.logger.error(f"Job recovery error: {str(e)}")
+
+def start_heartbeat_task():
+    def heartbeat_loop():
+        while True:
+            time.sleep(config.WORKER_HEARTBEAT_INTERVAL)
+            try:
+                session_repo.save_worker_heartbeat(WORKER_ID, time.time())
+            except Exception as e:
+                app.logger.error(f"Heartbeat error: {str(e)}")
+            recover_jobs()
+    
+    threading.Thread(target=heartbeat_loop, daemon=True).start()
+
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_services():
+    """启动心跳、崩溃恢复和清理任务（每个进程一次）"""
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    session_repo.save_worker_heartbeat(WORKER_ID, time.time())
+    start_heartbeat_task()
+    recover_jobs()
+    start_cleanup_task()
+    start_storage_task()
+
+@app.before_request
+def ensure_background_services():
+    # gunicorn 不执行 __main__，在首个请求时启动后台任务
+    if not _background_started:
+        start_background_services()
+
 # 🔧 错误处理
 @app.errorhandler(413)
 def request_entity_too_large(error):
@@ -889,6 +5037,7 @@ def not_found(error):
     return jsonify({"error": "页面不存在"}), 404
 
 if __name__ == '__main__':
-    start_cleanup_task()
+    ffmpeg_caps.refresh()
+    start_background_services()
     app.logger.info(f"🚀 启动 YouTube 下载器 - {config.DOMAIN}")
     socketio.run(app, debug=config.DEBUG, host=config.HOST, port=config.PORT)
\ No newline at end of file
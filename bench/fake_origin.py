@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+本地 YouTube 替身源站：合成观看页、格式清单和媒体分片，带可配置的带宽和延迟
+
+    GET /watch?v=<id>                 观看页，内嵌 ytInitialPlayerResponse
+    GET /manifest/<id>                格式清单（JSON），含每个格式的分片数
+    GET /media/<id>/<itag>?frag=<n>   媒体分片，按 --bandwidth 限速
+
+同一视频 ID 的时长和格式大小是确定的，便于多次压测之间比较。
+可独立运行，也可在压测脚本中以线程方式启动（FakeOrigin.start()）。
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# (itag, 高度, 视频码率 kbps, 编码)；音频单独一档
+VIDEO_LADDER = (
+    ("160", 144, 100, "avc1.4d400c"),
+    ("134", 360, 700, "avc1.4d401e"),
+    ("135", 480, 1200, "avc1.4d401f"),
+    ("136", 720, 2500, "avc1.4d401f"),
+    ("137", 1080, 4500, "avc1.640028"),
+    ("400", 1440, 9000, "av01.0.12M.08"),
+    ("401", 2160, 18000, "av01.0.16M.08"),
+)
+AUDIO_FORMAT = ("140", 128, "mp4a.40.2")
+WRITE_CHUNK = 16 * 1024
+
+
+class OriginSettings:
+    def __init__(self, bandwidth=4 * 1024 * 1024, latency=0.05, duration=60, scale=0.05,
+                 fragment_size=1024 * 1024, page_size=200 * 1024):
+        self.bandwidth = bandwidth  # 每个连接的字节/秒，0 表示不限速
+        self.latency = latency  # 每个请求的首字节延迟（秒）
+        self.duration = duration  # 默认视频时长（秒），按视频 ID 在 ±50% 内浮动
+        self.scale = scale  # 文件大小缩放系数，压测时缩小真实码率对应的体积
+        self.fragment_size = fragment_size
+        self.page_size = page_size  # 观看页填充到的字节数，模拟真实页面的解析开销
+
+
+def video_duration(video_id, settings):
+    digest = int(hashlib.sha1(video_id.encode()).hexdigest()[:8], 16)
+    return max(1, int(settings.duration * (0.5 + (digest % 1000) / 1000)))
+
+
+def build_manifest(video_id, settings):
+    duration = video_duration(video_id, settings)
+
+    def entry(itag, kbps, **fields):
+        size = max(1, int(kbps * 1000 / 8 * duration * settings.scale))
+        return dict(fields, itag=itag, filesize=size, tbr=kbps,
+                    fragment_count=max(1, -(-size // settings.fragment_size)),
+                    url=f"/media/{video_id}/{itag}")
+
+    formats = [entry(itag, kbps, height=height, width=height * 16 // 9, vcodec=codec, acodec="none", ext="mp4")
+               for itag, height, kbps, codec in VIDEO_LADDER]
+    itag, kbps, codec = AUDIO_FORMAT
+    formats.append(entry(itag, kbps, vcodec="none", acodec=codec, ext="m4a", abr=kbps))
+    return {"id": video_id, "title": f"Synthetic video {video_id}", "duration": duration, "formats": formats}
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    server_version = "FakeOrigin/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def settings(self):
+        return self.server.settings
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        time.sleep(self.settings.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self._write_throttled(body)
+
+    def _write_throttled(self, body):
+        bandwidth = self.settings.bandwidth
+        started = time.monotonic()
+        for offset in range(0, len(body), WRITE_CHUNK):
+            self.wfile.write(body[offset:offset + WRITE_CHUNK])
+            if bandwidth:
+                ahead = (offset + WRITE_CHUNK) / bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        parts = [p for p in parsed.path.split('/') if p]
+        self.server.count(parts[0] if parts else 'root')
+        try:
+            if parts == ['watch'] and query.get('v'):
+                self._watch_page(query['v'][0])
+            elif len(parts) == 2 and parts[0] == 'manifest':
+                body = json.dumps(build_manifest(parts[1], self.settings)).encode()
+                self._send(200, body, "application/json")
+            elif len(parts) == 3 and parts[0] == 'media':
+                self._fragment(parts[1], parts[2], int(query.get('frag', ['0'])[0]))
+            else:
+                self._send(404, b"not found", "text/plain")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _watch_page(self, video_id):
+        manifest = build_manifest(video_id, self.settings)
+        player = {
+            "videoDetails": {"videoId": video_id, "title": manifest["title"],
+                             "lengthSeconds": str(manifest["duration"])},
+            "streamingData": {"manifestUrl": f"/manifest/{video_id}"},
+        }
+        page = (f"<html><head><title>{manifest['title']}</title></head><body>"
+                f"<script>var ytInitialPlayerResponse = {json.dumps(player)};</script>")
+        filler = "<!-- " + "x" * max(0, self.settings.page_size - len(page) - 30) + " -->"
+        self._send(200, (page + filler + "</body></html>").encode(), "text/html; charset=utf-8")
+
+    def _fragment(self, video_id, itag, index):
+        manifest = build_manifest(video_id, self.settings)
+        fmt = next((f for f in manifest["formats"] if f["itag"] == itag), None)
+        if fmt is None or not 0 <= index < fmt["fragment_count"]:
+            self._send(404, b"no such fragment", "text/plain")
+            return
+        start = index * self.settings.fragment_size
+        length = min(self.settings.fragment_size, fmt["filesize"] - start)
+        self._send(200, bytes(length), "application/octet-stream")
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        super().__init__(address, OriginHandler)
+        self.settings = settings
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+
+class FakeOrigin:
+    """在后台线程中运行的替身源站"""
+
+    def __init__(self, settings=None, host='127.0.0.1', port=0):
+        self.server = OriginServer((host, port), settings or OriginSettings())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--bandwidth', type=int, default=4 * 1024 * 1024, help='每个连接的字节/秒，0 不限速')
+    parser.add_argument('--latency', type=float, default=0.05, help='每个请求的首字节延迟（秒）')
+    parser.add_argument('--duration', type=int, default=60, help='默认视频时长（秒）')
+    parser.add_argument('--scale', type=float, default=0.05, help='文件大小缩放系数')
+    parser.add_argument('--fragment-size', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+    settings = OriginSettings(args.bandwidth, args.latency, args.duration, args.scale, args.fragment_size)
+    origin = FakeOrigin(settings, args.host, args.port)
+    print(f"替身源站运行于 {origin.url}")
+    try:
+        origin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
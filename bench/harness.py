@@ -0,0 +1,228 @@
+"""
+压测公共组件：HTTP 客户端、延迟统计、临时服务端启动、进程资源采样
+"""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+
+WORKER_CLASSES = {'eventlet': 'eventlet', 'gevent': 'gevent', 'threading': 'gthread'}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ApiClient:
+    """极简 HTTP 客户端，记录每次请求的耗时"""
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session_id = None
+        self.last_headers = {}
+
+    def request(self, method, path, payload=None, headers=None):
+        """返回 (状态码, JSON 响应, 耗时秒数)，网络错误时状态码为 0"""
+        data = json.dumps(payload).encode() if payload is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        req.add_header('Content-Type', 'application/json')
+        if self.session_id:
+            req.add_header('X-Session-ID', self.session_id)
+        for name, value in (headers or {}).items():
+            req.add_header(name, value)
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                body, status, self.last_headers = resp.read(), resp.status, resp.headers
+        except urllib.error.HTTPError as e:
+            body, status, self.last_headers = e.read(), e.code, e.headers
+        except OSError:
+            body, status, self.last_headers = b'', 0, {}
+        elapsed = time.perf_counter() - started
+        try:
+            return status, json.loads(body or b'{}'), elapsed
+        except ValueError:
+            return status, {}, elapsed
+
+
+class LatencyRecorder:
+    """按接口分组记录延迟和错误数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, elapsed, ok):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, duration=None):
+        with self.lock:
+            result = {}
+            for endpoint, values in sorted(self.latencies.items()):
+                result[endpoint] = {
+                    "requests": len(values),
+                    "errors": self.errors.get(endpoint, 0),
+                    "p50_ms": round(percentile(values, 50) * 1000, 1),
+                    "p99_ms": round(percentile(values, 99) * 1000, 1),
+                }
+                if duration:
+                    result[endpoint]["rps"] = round(len(values) / duration, 1)
+            return result
+
+
+def _descendants(pid):
+    """通过 /proc/<pid>/task/*/children 递归列出子进程（yt-dlp / ffmpeg）"""
+    found, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        task_dir = Path(f"/proc/{current}/task")
+        try:
+            tasks = list(task_dir.iterdir())
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                children = [int(c) for c in (task / 'children').read_text().split()]
+            except (OSError, ValueError):
+                continue
+            found.extend(children)
+            pending.extend(children)
+    return found
+
+
+def _rss_bytes(pid):
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def _fd_count(pid):
+    try:
+        return len(os.listdir(f"/proc/{pid}/fd"))
+    except OSError:
+        return 0
+
+
+class ResourceSampler:
+    """后台按间隔采样服务端进程（及其子进程）的 RSS 和打开的文件描述符数，记录峰值"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = {"server_rss_bytes": 0, "total_rss_bytes": 0, "server_fds": 0, "children": 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        children = _descendants(self.pid)
+        server_rss = _rss_bytes(self.pid)
+        values = {
+            "server_rss_bytes": server_rss,
+            "total_rss_bytes": server_rss + sum(_rss_bytes(child) for child in children),
+            "server_fds": _fd_count(self.pid),
+            "children": len(children),
+        }
+        for key, value in values.items():
+            self.peak[key] = max(self.peak[key], value)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        if sys.platform.startswith('linux'):
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def reset(self):
+        self.peak = dict.fromkeys(self.peak, 0)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+def worker_pid(process):
+    """gunicorn 时返回实际处理请求的 worker 进程，否则返回进程本身"""
+    children = _descendants(process.pid)
+    return children[0] if process.args[0] == 'gunicorn' and children else process.pid
+
+
+def spawn_server(workdir, async_mode='eventlet', extra_env=None):
+    """在临时目录启动一个使用 bench/stub 中 yt-dlp 替身的服务端，返回 (进程, base_url)"""
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "ASYNC_MODE": async_mode,
+        "DOWNLOAD_ENGINE": "subprocess",
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(BENCH_DIR / 'stub'), str(REPO_DIR), env.get('PYTHONPATH')])),
+        "DOWNLOAD_DIR": str(workdir / 'downloads'),
+        "UPLOAD_DIR": str(workdir / 'uploads'),
+        "LOG_DIR": str(workdir / 'logs'),
+        "DATA_DIR": str(workdir / 'data'),
+        "HOST_RATE_LIMIT": "1000",
+        "HOST_RATE_BURST": "1000",
+    })
+    env.update({key: str(value) for key, value in (extra_env or {}).items()})
+    worker_class = WORKER_CLASSES[async_mode]
+    if shutil.which('gunicorn'):
+        cmd = ["gunicorn", "--worker-class", worker_class, "-w", "1",
+               "--threads", "100" if worker_class == 'gthread' else "1",
+               "--bind", f"127.0.0.1:{port}", "--timeout", "120", "app:app"]
+    else:
+        cmd = [sys.executable, str(REPO_DIR / 'app.py')]
+        env.update({"HOST": "127.0.0.1", "PORT": str(port)})
+    log = open(workdir / 'server.log', 'w')
+    process = subprocess.Popen(cmd, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base_url + '/api/status', timeout=1).read()
+            return process, base_url
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit(f"服务端启动失败，日志见 {workdir / 'server.log'}")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+单 worker 负载压测：逐级增加并发会话数，找出一个 worker 能承受的会话数和活跃下载数
+
+每个虚拟会话：获取会话 ID -> 提交 M 个视频下载 -> 按间隔轮询 /api/status 直到完成。
+某一级的 /api/status p99 延迟超过 --slo-ms 或出现错误即视为不可承受。
+
+示例（自动启动服务端，使用 bench/stub 中的 yt-dlp 替身）：
+    python bench/load_worker.py --spawn --async-mode eventlet --stages 5,10,25,50
+压测已有服务：
+    python bench/load_worker.py --base-url http://127.0.0.1:8000 --stages 10,20
+"""
+
+import argparse
+import json
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from harness import WORKER_CLASSES, ApiClient, percentile, spawn_server, stop_server
+
+
+class StageResult:
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = 0
+        self.downloads = 0
+        self.peak_active = 0
+        self.peak_queued = 0
+
+    def record(self, endpoint, elapsed, ok):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if not ok:
+                self.errors += 1
+
+    def summary(self, duration):
+        status = self.latencies.get('status', [])
+        return {
+            "sessions": self.sessions,
+            "duration_s": round(duration, 1),
+            "requests": sum(len(v) for v in self.latencies.values()),
+            "errors": self.errors,
+            "downloads": self.downloads,
+            "downloads_per_min": round(self.downloads / duration * 60, 1) if duration else 0,
+            "peak_active_downloads": self.peak_active,
+            "peak_queued": self.peak_queued,
+            "status_p50_ms": round(percentile(status, 50) * 1000, 1),
+            "status_p99_ms": round(percentile(status, 99) * 1000, 1),
+            "status_mean_ms": round(statistics.fmean(status) * 1000, 1) if status else 0,
+        }
+
+
+def run_session(args, result, deadline):
+    client = ApiClient(args.base_url)
+    status, body, elapsed = client.request('GET', '/api/status')
+    result.record('status', elapsed, status == 200)
+    client.session_id = body.get('session_id')
+    if not client.session_id:
+        return
+
+    urls = [f"https://www.youtube.com/watch?v={uuid.uuid4().hex[:11]}" for _ in range(args.urls)]
+    status, body, elapsed = client.request('POST', '/api/download', {"urls": urls, "quality": args.quality})
+    result.record('download', elapsed, status == 200)
+    if status != 200:
+        return
+
+    seen_running = False
+    while time.monotonic() < deadline:
+        time.sleep(args.poll_interval)
+        status, body, elapsed = client.request('GET', '/api/status')
+        result.record('status', elapsed, status == 200)
+        if status != 200:
+            continue
+        queue = body.get('queue') or {}
+        with result.lock:
+            result.peak_active = max(result.peak_active, queue.get('active', 0))
+            result.peak_queued = max(result.peak_queued, queue.get('queued', 0))
+        if body.get('is_downloading'):
+            seen_running = True
+        elif seen_running or (body.get('progress') or {}).get('status') == 'completed':
+            progress = body.get('progress') or {}
+            with result.lock:
+                result.downloads += progress.get('current', 0) if progress.get('status') == 'completed' else 0
+            return
+
+
+def run_stage(args, sessions):
+    result = StageResult(sessions)
+    started = time.monotonic()
+    deadline = started + args.stage_timeout
+    threads = [threading.Thread(target=run_session, args=(args, result, deadline), daemon=True)
+               for _ in range(sessions)]
+    for index, thread in enumerate(threads):
+        thread.start()
+        if args.ramp_up:
+            time.sleep(args.ramp_up / sessions)
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()) + 5)
+    return result.summary(time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--spawn', action='store_true', help='在临时目录启动一个使用 yt-dlp 替身的服务端')
+    parser.add_argument('--async-mode', choices=sorted(WORKER_CLASSES), default='eventlet')
+    parser.add_argument('--workers', type=int, default=8, help='服务端 MAX_CONCURRENT_DOWNLOADS')
+    parser.add_argument('--stages', default='5,10,25,50', help='逐级并发会话数，逗号分隔')
+    parser.add_argument('--urls', type=int, default=2, help='每个会话提交的视频数（最多 5）')
+    parser.add_argument('--quality', default='720p')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--ramp-up', type=float, default=2.0, help='每级内会话启动的摊开时间（秒）')
+    parser.add_argument('--stage-timeout', type=float, default=120.0)
+    parser.add_argument('--slo-ms', type=float, default=500.0, help='/api/status p99 延迟上限')
+    parser.add_argument('--file-size', type=int, default=4 * 1024 * 1024, help='替身产出的文件大小（字节）')
+    parser.add_argument('--rate', type=int, default=2 * 1024 * 1024, help='替身传输速率（字节/秒）')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    args = parser.parse_args()
+    args.urls = max(1, min(5, args.urls))
+    stages = [int(s) for s in args.stages.split(',') if s.strip()]
+    args.max_sessions = max(stages)
+
+    process = workdir = None
+    if args.spawn:
+        workdir = Path(tempfile.mkdtemp(prefix='ytdl-bench-'))
+        process, args.base_url = spawn_server(workdir, args.async_mode, {
+            "MAX_CONCURRENT_DOWNLOADS": args.workers,
+            "MAX_QUEUE_SIZE": max(50, args.max_sessions * args.urls),
+            "YTDLP_STUB_SIZE": args.file_size,
+            "YTDLP_STUB_RATE": args.rate,
+        })
+
+    results = []
+    try:
+        for sessions in stages:
+            summary = run_stage(args, sessions)
+            summary["within_slo"] = summary["errors"] == 0 and summary["status_p99_ms"] <= args.slo_ms
+            results.append(summary)
+            if not args.json:
+                print(f"会话 {sessions:>4}: p50 {summary['status_p50_ms']:>7} ms  p99 {summary['status_p99_ms']:>7} ms  "
+                      f"错误 {summary['errors']:>3}  峰值活跃下载 {summary['peak_active_downloads']:>3}  "
+                      f"完成 {summary['downloads']:>4} ({summary['downloads_per_min']}/min)")
+            if not summary["within_slo"]:
+                break
+    finally:
+        if process:
+            stop_server(process)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    sustained = [r for r in results if r["within_slo"]]
+    report = {
+        "async_mode": args.async_mode if args.spawn else None,
+        "slo_ms": args.slo_ms,
+        "stages": results,
+        "max_sustained_sessions": sustained[-1]["sessions"] if sustained else 0,
+        "max_sustained_active_downloads": max((r["peak_active_downloads"] for r in sustained), default=0),
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"单 worker 可承受: {report['max_sustained_sessions']} 个并发会话, "
+              f"{report['max_sustained_active_downloads']} 个活跃下载 (p99 <= {args.slo_ms} ms)")
+
+
+if __name__ == '__main__':
+    main()
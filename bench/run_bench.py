@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+压测套件：本地替身源站 + yt-dlp 替身 + 脚本化场景，不访问真实 YouTube
+
+场景：
+    downloads    N 个会话 × 每会话 M 个视频，画质在 QUALITY_OPTIONS 各档之间轮换
+    status_storm C 个并发客户端在 T 秒内持续轮询 /api/status
+    files_flood  C 个并发客户端在 T 秒内持续请求文件列表（一半带 If-None-Match）
+
+输出各接口 p50/p99 延迟、每分钟完成下载数，以及服务端进程的峰值 RSS / 文件描述符数。
+
+示例：
+    python bench/run_bench.py --sessions 10 --urls 3 --bandwidth 8388608 --latency 0.02
+    python bench/run_bench.py --scenarios status_storm,files_flood --clients 50 --seconds 20 --json
+"""
+
+import argparse
+import json
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from fake_origin import FakeOrigin, OriginSettings
+from harness import (WORKER_CLASSES, ApiClient, LatencyRecorder, ResourceSampler,
+                     spawn_server, stop_server, worker_pid)
+
+SCENARIOS = ('downloads', 'status_storm', 'files_flood')
+MAX_URLS_PER_REQUEST = 5
+
+
+class BenchContext:
+    def __init__(self, args, base_url, tiers):
+        self.args = args
+        self.base_url = base_url
+        self.tiers = tiers
+        self.sessions = []  # 已有下载文件的会话 ID，供文件列表场景复用
+        self.lock = threading.Lock()
+
+    def client(self, session_id=None):
+        client = ApiClient(self.base_url)
+        client.session_id = session_id
+        return client
+
+
+def new_session(ctx, recorder):
+    client = ctx.client()
+    status, body, elapsed = client.request('GET', '/api/status')
+    recorder.record('GET /api/status', elapsed, status == 200)
+    client.session_id = body.get('session_id')
+    return client
+
+
+def wait_for_jobs(ctx, client, recorder, deadline):
+    """轮询 /api/jobs 直到本会话没有排队或运行中的任务，返回任务列表"""
+    jobs = []
+    while time.monotonic() < deadline:
+        time.sleep(ctx.args.poll_interval)
+        status, body, elapsed = client.request('GET', '/api/jobs')
+        recorder.record('GET /api/jobs', elapsed, status == 200)
+        jobs = body.get('jobs') or []
+        if status == 200 and not any(job.get('state') in ('queued', 'running') for job in jobs):
+            break
+    return jobs
+
+
+def scenario_downloads(ctx, recorder, sessions=None, urls=None):
+    args = ctx.args
+    sessions = sessions or args.sessions
+    urls_per_session = urls or args.urls
+    tally = {}
+    deadline = time.monotonic() + args.timeout
+
+    def run(index):
+        tier = ctx.tiers[index % len(ctx.tiers)]
+        client = new_session(ctx, recorder)
+        if not client.session_id:
+            return
+        urls = [f"https://www.youtube.com/watch?v={uuid.uuid4().hex[:11]}" for _ in range(urls_per_session)]
+        jobs = []
+        for start in range(0, len(urls), MAX_URLS_PER_REQUEST):
+            status, _, elapsed = client.request('POST', '/api/download', {
+                "urls": urls[start:start + MAX_URLS_PER_REQUEST], "quality": tier})
+            recorder.record('POST /api/download', elapsed, status == 200)
+            if status != 200:
+                break
+            jobs = wait_for_jobs(ctx, client, recorder, deadline)
+        with ctx.lock:
+            counts = tally.setdefault(tier, {"completed": 0, "failed": 0})
+            for job in jobs:
+                if job.get('state') in counts:
+                    counts[job['state']] += 1
+            if any(job.get('state') == 'completed' for job in jobs):
+                ctx.sessions.append(client.session_id)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()) + 5)
+    duration = time.monotonic() - started
+    completed = sum(counts["completed"] for counts in tally.values())
+    return duration, {
+        "tiers": tally,
+        "downloads_completed": completed,
+        "downloads_failed": sum(counts["failed"] for counts in tally.values()),
+        "downloads_per_min": round(completed / duration * 60, 1) if duration else 0,
+    }
+
+
+def hammer(ctx, recorder, make_request):
+    """C 个客户端在 T 秒内循环发请求"""
+    stop_at = time.monotonic() + ctx.args.seconds
+
+    def loop(index):
+        state = {}
+        while time.monotonic() < stop_at:
+            make_request(index, state)
+
+    threads = [threading.Thread(target=loop, args=(i,), daemon=True) for i in range(ctx.args.clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - started
+
+
+def scenario_status_storm(ctx, recorder):
+    clients = [new_session(ctx, LatencyRecorder()) for _ in range(ctx.args.clients)]
+
+    def poll(index, state):
+        status, _, elapsed = clients[index].request('GET', '/api/status')
+        recorder.record('GET /api/status', elapsed, status == 200)
+
+    return hammer(ctx, recorder, poll), {}
+
+
+def scenario_files_flood(ctx, recorder):
+    if not ctx.sessions:
+        # 没有跑过下载场景时先做一轮小规模下载，保证列表非空
+        scenario_downloads(ctx, LatencyRecorder(), sessions=3, urls=2)
+    sessions = ctx.sessions or [new_session(ctx, recorder).session_id]
+
+    def listing(index, state):
+        session_id = sessions[index % len(sessions)]
+        client = state.setdefault('client', ctx.client(session_id))
+        conditional = index % 2 == 1 and state.get('etag')
+        headers = {'If-None-Match': state['etag']} if conditional else None
+        status, _, elapsed = client.request('GET', f'/downloads/{session_id}', headers=headers)
+        recorder.record('GET /downloads (304)' if conditional else 'GET /downloads', elapsed, status in (200, 304))
+        etag = client.last_headers.get('ETag') if client.last_headers else None
+        if etag:
+            state['etag'] = etag
+
+    return hammer(ctx, recorder, listing), {"listed_sessions": len(sessions)}
+
+
+RUNNERS = {
+    'downloads': scenario_downloads,
+    'status_storm': scenario_status_storm,
+    'files_flood': scenario_files_flood,
+}
+
+
+def format_report(report):
+    lines = [f"替身源站: {report['origin']}  并发模型: {report['async_mode']}  画质档位: {', '.join(report['tiers'])}"]
+    for name, result in report['scenarios'].items():
+        peak = result['peak']
+        lines.append(f"\n== {name} ({result['duration_s']} s) ==")
+        for endpoint, stats in result['latency'].items():
+            lines.append(f"  {endpoint:<24} 请求 {stats['requests']:>6}  错误 {stats['errors']:>4}  "
+                         f"p50 {stats['p50_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms  {stats.get('rps', 0):>7} req/s")
+        if 'downloads_per_min' in result:
+            lines.append(f"  完成下载 {result['downloads_completed']}，失败 {result['downloads_failed']}，"
+                         f"{result['downloads_per_min']} 个/分钟")
+            for tier, counts in sorted(result['tiers'].items()):
+                lines.append(f"    {tier:<14} 完成 {counts['completed']:>3}  失败 {counts['failed']:>3}")
+        lines.append(f"  峰值 RSS: worker {peak['server_rss_bytes'] / 1048576:.1f} MB，"
+                     f"含子进程 {peak['total_rss_bytes'] / 1048576:.1f} MB；"
+                     f"峰值 FD {peak['server_fds']}；峰值子进程 {peak['children']}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--async-mode', choices=sorted(WORKER_CLASSES), default='eventlet')
+    parser.add_argument('--workers', type=int, default=8, help='服务端 MAX_CONCURRENT_DOWNLOADS')
+    parser.add_argument('--sessions', type=int, default=10, help='downloads 场景的会话数 N')
+    parser.add_argument('--urls', type=int, default=3, help='每个会话的视频数 M')
+    parser.add_argument('--tiers', default='', help='参与轮换的画质，逗号分隔，默认全部 QUALITY_OPTIONS')
+    parser.add_argument('--clients', type=int, default=20, help='轮询/列表场景的并发客户端数 C')
+    parser.add_argument('--seconds', type=float, default=15, help='轮询/列表场景的持续时间 T')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=300, help='downloads 场景的最长等待时间')
+    parser.add_argument('--bandwidth', type=int, default=4 * 1024 * 1024, help='源站每连接字节/秒，0 不限速')
+    parser.add_argument('--latency', type=float, default=0.05, help='源站每请求延迟（秒）')
+    parser.add_argument('--duration', type=int, default=60, help='合成视频的平均时长（秒）')
+    parser.add_argument('--scale', type=float, default=0.05, help='合成文件大小缩放系数')
+    parser.add_argument('--keep', action='store_true', help='保留临时目录（含服务端日志）')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    args = parser.parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+
+    origin = FakeOrigin(OriginSettings(args.bandwidth, args.latency, args.duration, args.scale)).start()
+    workdir = Path(tempfile.mkdtemp(prefix='ytdl-bench-'))
+    process, base_url = spawn_server(workdir, args.async_mode, {
+        "YTDLP_STUB_ORIGIN": origin.url,
+        "MAX_CONCURRENT_DOWNLOADS": args.workers,
+        "MAX_QUEUE_SIZE": max(50, args.sessions * args.urls),
+    })
+    sampler = ResourceSampler(worker_pid(process)).start()
+    try:
+        _, status, _ = ApiClient(base_url).request('GET', '/api/status')
+        tiers = [t.strip() for t in args.tiers.split(',') if t.strip()] or list(status.get('quality_options') or {})
+        ctx = BenchContext(args, base_url, tiers or ['720p'])
+        report = {"origin": origin.url, "async_mode": status.get('async_mode'), "tiers": ctx.tiers, "scenarios": {}}
+        for name in scenarios:
+            recorder = LatencyRecorder()
+            sampler.reset()
+            duration, extra = RUNNERS[name](ctx, recorder)
+            sampler.sample()
+            report["scenarios"][name] = dict(extra, duration_s=round(duration, 1),
+                                             latency=recorder.summary(duration), peak=dict(sampler.peak))
+        report["origin_requests"] = dict(origin.server.requests)
+    finally:
+        sampler.stop()
+        stop_server(process)
+        origin.stop()
+        if args.keep:
+            print(f"临时目录: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2) if args.json else format_report(report))
+
+
+if __name__ == '__main__':
+    main()
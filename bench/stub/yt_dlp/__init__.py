@@ -0,0 +1,7 @@
+"""
+压测用的 yt-dlp 替身
+
+只实现 app.py 子进程引擎用到的命令行行为（python -m yt_dlp），
+不访问任何外部网络。把 bench/stub 加入 PYTHONPATH 并设置
+DOWNLOAD_ENGINE=subprocess 即可让服务端调用它。
+"""
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+yt-dlp 命令行替身
+
+设置 YTDLP_STUB_ORIGIN（bench/fake_origin.py 的地址）时，从替身源站抓取观看页、
+格式清单和媒体分片，按 -f 中的高度上限选择格式，-N 控制并发分片数；
+未设置时按以下环境变量本地合成：
+
+YTDLP_STUB_LATENCY  提取阶段耗时（秒，默认 0.5）
+YTDLP_STUB_SIZE     视频格式大小（字节，默认 5MB）
+YTDLP_STUB_RATE     传输速率（字节/秒，默认 2MB/s）
+"""
+
+import json
+import os
+import re
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+PROGRESS_PREFIX = "[progress-json]"
+CHUNK_INTERVAL = 0.25
+ORIGIN = os.getenv('YTDLP_STUB_ORIGIN', '').rstrip('/')
+
+
+def option_value(args, name, default=None):
+    if name in args:
+        index = args.index(name)
+        if index + 1 < len(args):
+            return args[index + 1]
+    return default
+
+
+def video_id_of(url):
+    match = re.search(r'(?:v=|youtu\.be/|shorts/)([\w-]+)', url or '')
+    return match.group(1) if match else 'stub'
+
+
+def emit(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def fetch(path):
+    with urllib.request.urlopen(ORIGIN + path, timeout=30) as resp:
+        return resp.read()
+
+
+def synthetic_info(video_id):
+    size = int(os.getenv('YTDLP_STUB_SIZE', 5 * 1024 * 1024))
+    return {
+        "id": video_id,
+        "title": f"Stub video {video_id}",
+        "duration": 120,
+        "formats": [
+            {"format_id": "18", "ext": "mp4", "height": 360, "vcodec": "avc1", "acodec": "mp4a", "filesize": size // 4},
+            {"format_id": "137", "ext": "mp4", "height": 1080, "vcodec": "avc1", "acodec": "none", "filesize": size},
+            {"format_id": "140", "ext": "m4a", "vcodec": "none", "acodec": "mp4a", "filesize": size // 10},
+        ],
+    }
+
+
+def extract(video_id):
+    """提取阶段：源站模式下解析观看页中的 ytInitialPlayerResponse，再拉取格式清单"""
+    if not ORIGIN:
+        time.sleep(float(os.getenv('YTDLP_STUB_LATENCY', 0.5)))
+        return synthetic_info(video_id)
+    page = fetch(f"/watch?v={video_id}").decode()
+    match = re.search(r'ytInitialPlayerResponse = (\{.*?\});</script>', page)
+    player = json.loads(match.group(1))
+    manifest = json.loads(fetch(player["streamingData"]["manifestUrl"]))
+    formats = [dict(fmt, format_id=fmt["itag"]) for fmt in manifest["formats"]]
+    return {
+        "id": video_id,
+        "title": manifest["title"],
+        "duration": manifest["duration"],
+        "extractor": "youtube",
+        "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+        "formats": formats,
+    }
+
+
+def select_formats(info, args):
+    """按 -f 的高度上限选视频格式；含 '+' 时再选音频并合并，-x 或 ba 开头时只要音频"""
+    selector = option_value(args, "-f", "bv*+ba/b")
+    formats = info["formats"]
+    audio = max((f for f in formats if f.get("vcodec") == "none"), key=lambda f: f.get("filesize", 0))
+    if "-x" in args or selector.startswith("ba"):
+        return [audio]
+    cap = re.search(r'height<=(\d+)', selector)
+    videos = [f for f in formats if f.get("height") and (not cap or f["height"] <= int(cap.group(1)))]
+    video = max(videos or formats, key=lambda f: (f.get("height") or 0))
+    return [video, audio] if "+" in selector.split("/")[0] else [video]
+
+
+def report(status, downloaded, total, speed=None, fragment=None, fragments=None):
+    emit(PROGRESS_PREFIX + json.dumps({
+        "status": status, "downloaded_bytes": downloaded, "total_bytes": total, "speed": speed,
+        "eta": (total - downloaded) / speed if speed else None,
+        "fragment_index": fragment, "fragment_count": fragments,
+    }))
+
+
+def download_format(fmt, target, concurrency):
+    total = fmt["filesize"]
+    started = time.monotonic()
+    written = 0
+    with open(target, "wb") as handle:
+        if ORIGIN:
+            count = fmt["fragment_count"]
+            paths = [f"{fmt['url']}?frag={index}" for index in range(count)]
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+                for index, chunk in enumerate(pool.map(fetch, paths), 1):
+                    handle.write(chunk)
+                    written += len(chunk)
+                    speed = written / max(1e-6, time.monotonic() - started)
+                    report("downloading", written, total, speed, index, count)
+        else:
+            rate = max(1, int(os.getenv('YTDLP_STUB_RATE', 2 * 1024 * 1024)))
+            while written < total:
+                chunk = min(total - written, max(1, int(rate * CHUNK_INTERVAL)))
+                handle.write(b"\0" * chunk)
+                written += chunk
+                time.sleep(CHUNK_INTERVAL)
+                report("downloading", written, total, rate)
+    report("finished", total, total)
+
+
+def download(args, url):
+    info_file = option_value(args, "--load-info-json")
+    if info_file:
+        info = json.loads(Path(info_file).read_text(encoding='utf-8'))
+        video_id = info.get("id", "stub")
+    else:
+        video_id = video_id_of(url)
+        emit(f"[youtube] Extracting URL: {url}")
+        info = extract(video_id)
+
+    target_dir = Path(option_value(args, "-P", "."))
+    target_dir.mkdir(parents=True, exist_ok=True)
+    if "--write-info-json" in args:
+        meta_dir = target_dir / ".meta"
+        meta_dir.mkdir(exist_ok=True)
+        (meta_dir / f"{video_id}.info.json").write_text(json.dumps(info), encoding='utf-8')
+
+    chosen = select_formats(info, args)
+    emit(f"[info] {video_id}: Downloading 1 format(s): {'+'.join(f['format_id'] for f in chosen)}")
+    concurrency = int(option_value(args, "-N", 1))
+    parts = []
+    for fmt in chosen:
+        part = target_dir / f"{video_id}.f{fmt['format_id']}.{fmt.get('ext', 'mp4')}"
+        download_format(fmt, part, concurrency)
+        parts.append(part)
+
+    final = target_dir / f"{video_id}.{'m4a' if chosen[0].get('vcodec') == 'none' else 'mp4'}"
+    if len(parts) > 1:
+        emit(f'[Merger] Merging formats into "{final}"')
+        with open(final, "wb") as merged:
+            for part in parts:
+                merged.write(part.read_bytes())
+                part.unlink()
+    else:
+        parts[0].rename(final)
+    audio_format = option_value(args, "--audio-format")
+    if "-x" in args and audio_format and audio_format != final.suffix.lstrip('.'):
+        converted = final.with_suffix(f".{audio_format}")
+        emit(f"[ExtractAudio] Destination: {converted}")
+        final.rename(converted)
+    emit(f"[download] 100% of {sum(f['filesize'] for f in chosen)} bytes")
+    return 0
+
+
+def main():
+    args = sys.argv[1:]
+    urls = [arg for arg in args if arg.startswith("http")]
+    url = urls[-1] if urls else None
+
+    if "-J" in args or "--dump-single-json" in args:
+        emit(json.dumps(extract(video_id_of(url))))
+        return 0
+    if "--flat-playlist" in args:
+        for index in range(int(os.getenv('YTDLP_STUB_PLAYLIST_SIZE', 10))):
+            emit(json.dumps({"id": f"stub{index:07d}", "url": f"https://www.youtube.com/watch?v=stub{index:07d}",
+                             "title": f"Stub entry {index}"}))
+        return 0
+    return download(args, url)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
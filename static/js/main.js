@@ -6,6 +6,8 @@ class YouTubeDownloader {
         this.autoScroll = true;
         this.sessionId = null;
         this.qualityOptions = {};
+        this.progressState = {};
+        this.lastSeq = 0;  // 已处理的服务端批次序号
         
         this.initElements();
         this.initSocketConnection();
@@ -94,9 +96,15 @@ class YouTubeDownloader {
             '1080p': '全高清 (1080p)',
             '720p': '高清 (720p)',
             '480p': '标清 (480p)',
-            '360p': '流畅 (360p)'
+            '360p': '流畅 (360p)',
+            'compact_1080p': '省流 (1080p)',
+            'compact_720p': '省流 (720p)',
+            'audio': '仅音频 (原始编码)',
+            'audio_opus': '仅音频 (Opus)',
+            'audio_m4a': '仅音频 (M4A)',
+            'audio_mp3': '仅音频 (MP3)'
         };
-        return qualityMap[quality] || quality;
+        return qualityMap[quality] || (this.qualityOptions[quality] && this.qualityOptions[quality].name) || quality;
     }
     
     // 获取当前选中的画质
@@ -291,7 +299,41 @@ class YouTubeDownloader {
         this.socket.on('progress_update', (data) => {
             this.updateProgress(data);
         });
-        
+
+        // 服务端按间隔合并推送：日志批量 + 进度增量 + 其他事件
+        this.socket.on('batch', (batch) => {
+            // 快照已包含的批次不再重复处理
+            if (batch.seq !== undefined) {
+                if (batch.seq <= this.lastSeq) {
+                    return;
+                }
+                this.lastSeq = batch.seq;
+            }
+            (batch.logs || []).forEach((message) => this.addServerLogEntry(message));
+            if (batch.progress || batch.removed) {
+                const state = Object.assign({}, this.progressState, batch.progress || {});
+                (batch.removed || []).forEach((key) => delete state[key]);
+                this.progressState = state;
+                this.updateProgress(state);
+            }
+            (batch.events || []).forEach(({ event, data }) => this.handleServerEvent(event, data));
+        });
+
+        // 重连快照：一次性恢复最近日志和当前进度，替换之前显示的服务端日志
+        this.socket.on('snapshot', (snapshot) => {
+            this.elements.logContainer.querySelectorAll('.log-entry[data-server]').forEach((entry) => entry.remove());
+            (snapshot.logs || []).forEach((message) => this.addServerLogEntry(message));
+            this.lastSeq = snapshot.seq || 0;
+            if (snapshot.progress) {
+                this.progressState = snapshot.progress;
+                this.updateProgress(snapshot.progress);
+            }
+            if (snapshot.is_downloading) {
+                this.setDownloadingState(true);
+                this.showProgressSection();
+            }
+        });
+
         // 连接确认
         this.socket.on('connected', (data) => {
             if (data.session_id) {
@@ -307,6 +349,7 @@ class YouTubeDownloader {
         // URL 输入框变化
         this.elements.urlInput.addEventListener('input', () => {
             this.updateURLCount();
+            this.scheduleProbe();
         });
         
         // 下载按钮
@@ -390,6 +433,52 @@ class YouTubeDownloader {
         }
     }
     
+    // 输入停止一段时间后探测链接的可用画质和预计大小
+    scheduleProbe() {
+        clearTimeout(this.probeTimer);
+        this.probeTimer = setTimeout(() => this.probeURLs(), 800);
+    }
+    
+    async probeURLs() {
+        const urls = this.extractURLs(this.elements.urlInput.value)
+            .filter(url => !this.probedURLs || !this.probedURLs.has(url))
+            .filter(url => /[?&]v=|youtu\.be\/|\/shorts\//.test(url));
+        if (urls.length === 0) {
+            return;
+        }
+        this.probedURLs = this.probedURLs || new Set();
+        urls.forEach(url => this.probedURLs.add(url));
+        
+        try {
+            const headers = { 'Content-Type': 'application/json' };
+            if (this.sessionId) {
+                headers['X-Session-ID'] = this.sessionId;
+            }
+            const response = await fetch('/api/probe', {
+                method: 'POST',
+                headers: headers,
+                body: JSON.stringify({ urls: urls })
+            });
+            if (!response.ok) {
+                return;
+            }
+            const result = await response.json();
+            const selected = this.getSelectedQuality();
+            result.results.forEach(item => {
+                if (!item.ok) {
+                    this.addLogEntry(`🔍 ${item.url.substring(0, 40)}: ${item.error}`, 'warning');
+                    return;
+                }
+                const estimate = item.estimates[selected];
+                const size = estimate && estimate.bytes ? `，${this.getQualityName(selected)} 预计 ${this.formatFileSize(estimate.bytes)}` : '';
+                const maxHeight = item.heights.length ? `${item.heights[0]}p` : '无视频流';
+                this.addLogEntry(`🔍 ${(item.title || item.id).substring(0, 30)}: 最高 ${maxHeight}，推荐 ${this.getQualityName(item.recommended_quality)}${size}`, 'info');
+            });
+        } catch (error) {
+            // 探测失败不影响下载
+        }
+    }
+    
     // 提取有效的 YouTube URLs
     extractURLs(text) {
         const lines = text.split('\n');
@@ -445,7 +534,11 @@ class YouTubeDownloader {
             
             if (!response.ok) {
                 const error = await response.json();
-                this.addLogEntry(`❌ 请求失败: ${error.error}`, 'error');
+                if (response.status === 429 && error.retry_after) {
+                    this.addLogEntry(`⏳ ${error.error}，约 ${error.retry_after} 秒后重试`, 'warning');
+                } else {
+                    this.addLogEntry(`❌ 请求失败: ${error.error}`, 'error');
+                }
                 this.setDownloadingState(false);
                 return;
             }
@@ -480,6 +573,16 @@ class YouTubeDownloader {
         }
     }
     
+    // 处理随批次送达的低频事件
+    handleServerEvent(event, data) {
+        if (event === 'sync_result') {
+            console.log('同步结果:', data);
+            this.refreshFilesList();
+        } else {
+            console.log('未处理的服务端事件:', event, data);
+        }
+    }
+    
     // 显示进度区域
     showProgressSection() {
         this.elements.progressSection.style.display = 'block';
@@ -500,12 +603,20 @@ class YouTubeDownloader {
         // 更新状态
         const statusMap = {
             'idle': '准备中',
+            'queued': '排队中',
             'starting': '启动中',
             'downloading': '下载中',
             'completed': '已完成'
         };
         
-        this.elements.downloadStatus.textContent = statusMap[status] || status;
+        let statusText = statusMap[status] || status;
+        if (status === 'queued' && data.queue_position) {
+            statusText += ` (第 ${data.queue_position} 位)`;
+        }
+        if (status === 'downloading' && data.speed) {
+            statusText += ` · ${(data.speed / 1024 / 1024).toFixed(2)} MB/s`;
+        }
+        this.elements.downloadStatus.textContent = statusText;
         
         // 如果下载完成，重置状态并刷新文件列表
         if (status === 'completed') {
@@ -594,6 +705,12 @@ class YouTubeDownloader {
         if (entries.length > maxEntries) {
             entries[0].remove();
         }
+        return logEntry;
+    }
+    
+    // 添加服务端推送的日志条目（重连快照到达时整体替换）
+    addServerLogEntry(message) {
+        this.addLogEntry(message).dataset.server = 'true';
     }
     
     // 滚动日志到底部
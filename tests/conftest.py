@@ -0,0 +1,34 @@
+"""
+测试环境：在导入 app 之前把下载 / 上传 / 日志 / 数据目录指向临时目录
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+_TEST_ROOT = Path(tempfile.mkdtemp(prefix='ytdl-test-'))
+for _name in ('DOWNLOAD_DIR', 'UPLOAD_DIR', 'LOG_DIR', 'DATA_DIR'):
+    os.environ[_name] = str(_TEST_ROOT / _name.split('_')[0].lower())
+os.environ['ASYNC_MODE'] = 'threading'
+os.environ.pop('SESSION_STORE_URL', None)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def repo(request, tmp_path):
+    """同一套契约测试分别跑在 SQLite（临时文件）和 fakeredis 上"""
+    if request.param == 'sqlite':
+        return app_module.SQLiteSessionRepository(tmp_path / 'repo.db')
+    fakeredis = pytest.importorskip('fakeredis')
+    return app_module.RedisSessionRepository(fakeredis.FakeRedis())
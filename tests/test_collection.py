@@ -0,0 +1,136 @@
+"""
+播放列表 / 频道枚举：频道首页的各标签页都要展开，日期截止只影响当前标签页
+"""
+
+import time
+
+import pytest
+
+CHANNEL = 'https://www.youtube.com/@example'
+
+
+def video(video_id, upload_date=None):
+    return {"_type": "url", "ie_key": "Youtube", "id": video_id, "title": video_id, "upload_date": upload_date}
+
+
+def tab(name):
+    return {"_type": "url", "ie_key": "YoutubeTab", "url": f"{CHANNEL}/{name}", "title": name}
+
+
+@pytest.fixture
+def channel(app, monkeypatch):
+    """频道首页只有标签页，各标签页按发布时间倒序"""
+    pages = {
+        CHANNEL: [tab('videos'), tab('shorts')],
+        f"{CHANNEL}/videos": [video('videos00001', '20240301'), video('videos00002', '20240201'),
+                              video('videos00003', '20230101')],
+        f"{CHANNEL}/shorts": [video('shorts00001', '20240215'), video('shorts00002', '20221201')],
+    }
+    fetched = []
+
+    def flat_entries(url, cookies_file=None):
+        for entry in pages[url]:
+            fetched.append(entry.get('id') or entry['url'])
+            yield entry
+
+    monkeypatch.setattr(app, '_flat_entries', flat_entries)
+    return fetched
+
+
+def options(**overrides):
+    return dict({"start": 1, "end": None, "max_entries": 100, "date_after": None, "date_before": None}, **overrides)
+
+
+def test_channel_tabs_are_expanded(app, channel):
+    entries = list(app.iter_collection_entries(CHANNEL, options()))
+
+    assert [entry["id"] for entry in entries] == ['videos00001', 'videos00002', 'videos00003',
+                                                  'shorts00001', 'shorts00002']
+    assert entries[-1]["tab"] == f"{CHANNEL}/shorts"
+
+
+def test_date_cutoff_skips_only_current_tab(app, channel):
+    entries = list(app.iter_collection_entries(CHANNEL, options(date_after='20240101')))
+
+    assert [entry["id"] for entry in entries] == ['videos00001', 'videos00002', 'shorts00001']
+
+
+def test_start_and_end_slice_across_tabs(app, channel):
+    entries = list(app.iter_collection_entries(CHANNEL, options(start=2, end=4)))
+
+    assert [entry["id"] for entry in entries] == ['videos00002', 'videos00003', 'shorts00001']
+    assert 'shorts00002' not in channel  # 到达结尾后不再拉取
+
+
+def test_skip_tabs_stops_current_tab(app, channel):
+    skip_tabs = set()
+    seen = []
+    for entry in app.iter_collection_entries(CHANNEL, options(), skip_tabs=skip_tabs):
+        seen.append(entry["id"])
+        skip_tabs.add(entry["tab"])
+
+    assert seen == ['videos00001', 'shorts00001']
+    assert 'videos00002' not in channel
+
+
+@pytest.fixture
+def fake_ytdlp(app, monkeypatch, tmp_path):
+    """子进程枚举：用 PYTHONPATH 上的假 yt_dlp 模块代替真实的 yt-dlp"""
+    monkeypatch.setattr(app.config, 'DOWNLOAD_ENGINE', 'subprocess')
+    monkeypatch.setattr(app.config, 'PROCESS_KILL_GRACE', 1)
+    monkeypatch.setenv('PYTHONPATH', str(tmp_path))
+    (tmp_path / 'yt_dlp').mkdir()
+    (tmp_path / 'yt_dlp' / '__init__.py').write_text('')
+
+    def script(body):
+        (tmp_path / 'yt_dlp' / '__main__.py').write_text(
+            'import json, os, sys, time\n'
+            f'open({str(tmp_path / "pid")!r}, "w").write(str(os.getpid()))\n' + body)
+        return tmp_path / 'pid'
+    return script
+
+
+def test_subprocess_entries_are_streamed(app, fake_ytdlp):
+    fake_ytdlp('for i in range(3):\n    print(json.dumps({"id": f"video{i}"}), flush=True)\n')
+
+    assert [entry["id"] for entry in app._flat_entries(CHANNEL)] == ['video0', 'video1', 'video2']
+
+
+def test_subprocess_failure_reports_stderr(app, fake_ytdlp):
+    fake_ytdlp('print("ERROR: playlist does not exist", file=sys.stderr)\nsys.exit(1)\n')
+
+    with pytest.raises(RuntimeError, match='playlist does not exist'):
+        list(app._flat_entries(CHANNEL))
+
+
+def test_subprocess_stall_is_terminated(app, monkeypatch, fake_ytdlp):
+    monkeypatch.setattr(app.config, 'DOWNLOAD_STALL_TIMEOUT', 1)
+    fake_ytdlp('print(json.dumps({"id": "video0"}), flush=True)\ntime.sleep(60)\n')
+
+    started = time.monotonic()
+    with pytest.raises(RuntimeError, match='stall'):
+        list(app._flat_entries(CHANNEL))
+    assert time.monotonic() - started < 10
+
+
+def test_closing_early_stops_subprocess(app, fake_ytdlp):
+    pid_file = fake_ytdlp('for i in range(1000):\n    print(json.dumps({"id": f"video{i}"}), flush=True)\n'
+                          '    time.sleep(0.05)\n')
+
+    entries = app._flat_entries(CHANNEL)
+    assert next(entries)["id"] == 'video0'
+    entries.close()
+
+    pid = int(pid_file.read_text())
+    deadline = time.monotonic() + 5
+    while alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not alive(pid)
+
+
+def alive(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            return stat.read().split()[2] != 'Z'
+    except FileNotFoundError:
+        return False
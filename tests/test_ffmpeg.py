@@ -0,0 +1,24 @@
+"""
+FFmpeg 能力缓存：显式刷新限制频率
+"""
+
+
+def test_refresh_is_rate_limited(app, monkeypatch):
+    caps = app.FFmpegCapabilities()
+    refreshed = []
+
+    def refresh():
+        refreshed.append(1)
+        caps.probed_at = app.time.time()
+        return caps.to_dict()
+
+    monkeypatch.setattr(caps, 'refresh', refresh)
+    monkeypatch.setattr(app, 'ffmpeg_caps', caps)
+    client = app.app.test_client()
+
+    assert client.post('/api/ffmpeg/refresh').status_code == 200
+    response = client.post('/api/ffmpeg/refresh')
+
+    assert response.status_code == 429
+    assert 0 < int(response.headers['Retry-After']) <= caps.REFRESH_INTERVAL
+    assert len(refreshed) == 1
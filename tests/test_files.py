@@ -0,0 +1,53 @@
+"""
+文件下载：只按文件目录索引解析，目录中未登记的文件返回 404
+"""
+
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def session(app, monkeypatch):
+    session_id = str(uuid.uuid4())
+    session = app.UserSession(session_id)
+    monkeypatch.setitem(app.user_sessions, session_id, session)
+    download_dir = session.get_download_dir()
+    download_dir.mkdir(parents=True, exist_ok=True)
+    app.file_catalog.ensure(session_id, download_dir)
+    return session
+
+
+def add_file(app, session, name, register=True):
+    path = session.get_download_dir() / name
+    path.write_bytes(b'video')
+    if register:
+        app.file_catalog.register(session.session_id, [path])
+    return app.file_catalog.file_id_for(session.session_id, name)
+
+
+def test_file_is_resolved_by_id_and_full_name(app, session):
+    file_id = add_file(app, session, 'A very long video title that gets shortened.mp4')
+    client = app.app.test_client()
+
+    assert client.get(f'/download_file/{session.session_id}/{file_id}').status_code == 200
+    response = client.get(f'/download_file/{session.session_id}/A very long video title that gets shortened.mp4')
+    assert response.status_code == 200
+
+
+def test_unregistered_or_truncated_names_are_not_found(app, session):
+    add_file(app, session, 'A very long video title that gets shortened.mp4')
+    add_file(app, session, 'untracked.mp4', register=False)
+    client = app.app.test_client()
+
+    assert client.get(f'/download_file/{session.session_id}/A very long video...').status_code == 404
+    assert client.get(f'/download_file/{session.session_id}/untracked.mp4').status_code == 404
+
+
+def test_missing_file_is_dropped_from_catalog(app, session):
+    file_id = add_file(app, session, 'gone.mp4')
+    (session.get_download_dir() / 'gone.mp4').unlink()
+    client = app.app.test_client()
+
+    assert client.get(f'/download_file/{session.session_id}/{file_id}').status_code == 404
+    assert app.file_catalog.resolve(session.session_id, file_id) is None
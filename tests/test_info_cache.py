@@ -0,0 +1,62 @@
+"""
+信息缓存：TTL 与签名URL过期、LRU 淘汰、带 cookies 的条目按 cookies 隔离
+"""
+
+import time
+
+
+def info(expire=None):
+    url = f"https://example.googlevideo.com/videoplayback?expire={expire}" if expire else "https://example.com/v"
+    return {"id": "dQw4w9WgXcQ", "formats": [{"format_id": "18", "url": url}]}
+
+
+def test_entries_expire_after_ttl(app, monkeypatch):
+    cache = app.InfoCache(10, ttl=60)
+    cache.put('a', info())
+    assert cache.get('a')["id"] == 'dQw4w9WgXcQ'
+
+    now = time.time()
+    monkeypatch.setattr(app.time, 'time', lambda: now + 61)
+    assert cache.get('a') is None
+
+
+def test_signed_url_expiry_shortens_ttl(app):
+    cache = app.InfoCache(10, ttl=3600)
+
+    cache.put('soon', info(expire=int(time.time()) + cache.EXPIRE_MARGIN - 1))
+    cache.put('later', info(expire=int(time.time()) + 1800))
+
+    assert cache.get('soon') is None
+    assert cache.get('later') is not None
+
+
+def test_least_recently_used_entry_is_evicted(app):
+    cache = app.InfoCache(2, ttl=60)
+    cache.put('a', info())
+    cache.put('b', info())
+    cache.get('a')
+    cache.put('c', info())
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+def test_disk_layer_survives_memory_eviction(app, tmp_path):
+    cache = app.InfoCache(1, ttl=60, db_path=tmp_path / 'info.db')
+    cache.put('a', info())
+    cache.put('b', info())
+
+    assert cache.get('a') is not None
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_cookies_identity_separates_keys(app, tmp_path):
+    alice, bob = tmp_path / 'alice.txt', tmp_path / 'bob.txt'
+    alice.write_text('# Netscape HTTP Cookie File\nalice')
+    bob.write_text('# Netscape HTTP Cookie File\nbob')
+
+    anonymous = app.info_cache_key('dQw4w9WgXcQ')
+    assert anonymous == 'dQw4w9WgXcQ'
+    assert app.info_cache_key('dQw4w9WgXcQ', alice) != app.info_cache_key('dQw4w9WgXcQ', bob)
+    assert app.info_cache_key('dQw4w9WgXcQ', alice) == app.info_cache_key('dQw4w9WgXcQ', alice)
+    assert app.info_cache_key('dQw4w9WgXcQ', tmp_path / 'missing.txt') == anonymous
@@ -0,0 +1,84 @@
+"""
+进程内引擎的看门狗：不经过 progress hook 的阶段卡住时也能按超时中断
+"""
+
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+def run_until_interrupted(app, watchdog, body, limit=10):
+    """在看门狗下执行 body，返回 (是否被中断, 耗时)"""
+    started = time.monotonic()
+    watchdog.start()
+    try:
+        body(started + limit)
+        interrupted = False
+    except app.DownloadTimeoutError:
+        interrupted = True
+    finally:
+        watchdog.stop()
+    return interrupted, time.monotonic() - started
+
+
+def busy(deadline, touch=None):
+    while time.monotonic() < deadline:
+        if touch:
+            touch()
+        time.sleep(0.05)
+
+
+def test_total_timeout_interrupts_code_without_hooks(app, tmp_path):
+    watchdog = app.InprocessWatchdog(1, 0, tmp_path)
+
+    interrupted, elapsed = run_until_interrupted(app, watchdog, busy)
+
+    assert interrupted and watchdog.reason == "timeout"
+    assert elapsed < 5
+
+
+def test_stall_interrupts_and_activity_keeps_alive(app, tmp_path):
+    watchdog = app.InprocessWatchdog(60, 1, tmp_path)
+    interrupted, _ = run_until_interrupted(app, watchdog, lambda deadline: busy(deadline, watchdog.touch), limit=3)
+    assert not interrupted and watchdog.reason is None
+
+    watchdog = app.InprocessWatchdog(60, 1, tmp_path)
+    interrupted, elapsed = run_until_interrupted(app, watchdog, busy)
+    assert interrupted and watchdog.reason == "stall"
+    assert elapsed < 5
+
+
+def test_postprocessing_pauses_stall_detection(app, tmp_path):
+    watchdog = app.InprocessWatchdog(60, 1, tmp_path)
+    watchdog.postprocessing = True
+
+    interrupted, _ = run_until_interrupted(app, watchdog, busy, limit=2.5)
+
+    assert not interrupted and watchdog.reason is None
+
+
+def test_no_interrupt_after_stop(app, tmp_path):
+    watchdog = app.InprocessWatchdog(1, 0, tmp_path)
+    watchdog.start()
+    watchdog.stop()
+
+    busy(time.monotonic() + 2.5)  # 停止后不会再收到中断
+    assert not watchdog.interrupted
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="按 /proc 查找子进程")
+def test_timeout_kills_job_children(app, tmp_path):
+    watchdog = app.InprocessWatchdog(1, 0, tmp_path)
+    child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)', str(tmp_path / 'out.mp4')])
+
+    def body(deadline):
+        child.wait()  # 看门狗先结束子进程，中断随后送达
+        busy(deadline)
+
+    interrupted, elapsed = run_until_interrupted(app, watchdog, body)
+
+    assert interrupted
+    assert child.poll() is not None
+    assert elapsed < 5
@@ -0,0 +1,23 @@
+"""
+Socket.IO 出站缓冲：重连快照与后续批次衔接，不重复也不遗漏
+"""
+
+
+def test_snapshot_excludes_logs_of_next_batch(app, monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, 'emit_event', lambda event, payload, room=None: sent.append(payload))
+    outbox = app.SocketOutbox(1, 100, 50)
+    outbox._started = True  # 由测试手动 flush
+
+    outbox.log('room', 'a')
+    outbox.log('room', 'b')
+    outbox.flush()
+    outbox.log('room', 'c')
+
+    snapshot = outbox.snapshot('room')
+    assert snapshot['logs'] == ['a', 'b']
+    assert snapshot['seq'] == 1
+
+    outbox.flush()
+    assert sent[-1]['seq'] == 2
+    assert sent[-1]['logs'] == ['c']
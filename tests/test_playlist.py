@@ -0,0 +1,108 @@
+"""
+播放列表端到端：默认配置下边展开边排队，全部条目下载完后批次结束
+"""
+
+import threading
+import time
+import uuid
+
+import pytest
+
+PLAYLIST = 'https://www.youtube.com/playlist?list=PLexample'
+
+
+@pytest.fixture
+def manager(app, monkeypatch):
+    """默认调度配置（2 个工作线程）+ 假下载：每个任务立即成功"""
+    monkeypatch.setattr(app, 'download_scheduler', app.DownloadScheduler(
+        2, app.config.MAX_QUEUE_SIZE, app.config.SESSION_MAX_ACTIVE, app.lane_budgets(2)))
+    monkeypatch.setattr(app.config, 'LANE_PROBE', False)
+    ran = []
+    lock = threading.Lock()
+
+    def run_job(self, job):
+        with lock:
+            ran.append(job.url)
+        time.sleep(0.01)
+        self.finish_job(job, True)
+
+    monkeypatch.setattr(app.DownloadManager, 'run_job', run_job)
+    session_id = str(uuid.uuid4())
+    session = app.UserSession(session_id)
+    monkeypatch.setitem(app.user_sessions, session_id, session)
+    session.download_manager = app.DownloadManager(session_id)
+    session.download_manager.ran = ran
+    return session.download_manager
+
+
+def playlist(app, monkeypatch, count):
+    def flat_entries(url, cookies_file=None):
+        for i in range(count):
+            yield {"_type": "url", "ie_key": "Youtube", "id": f"video{i:06d}", "title": str(i)}
+
+    monkeypatch.setattr(app, '_flat_entries', flat_entries)
+
+
+def wait_until_idle(manager, limit=20):
+    deadline = time.monotonic() + limit
+    while manager.is_downloading and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return not manager.is_downloading
+
+
+def test_playlist_expands_and_finishes(app, monkeypatch, manager):
+    playlist(app, monkeypatch, 12)
+
+    accepted, message, _ = manager.submit_batch([PLAYLIST])
+
+    assert accepted, message
+    assert wait_until_idle(manager)
+    assert len(manager.ran) == 12
+    assert manager.batch is None
+
+
+def test_failed_expansion_clears_batch(app, monkeypatch, manager):
+    def flat_entries(url, cookies_file=None):
+        raise RuntimeError("boom")
+        yield
+
+    monkeypatch.setattr(app, '_flat_entries', flat_entries)
+
+    accepted, message, _ = manager.submit_batch([PLAYLIST])
+
+    assert accepted, message
+    assert wait_until_idle(manager, 5)
+
+
+def sync(app, manager):
+    accepted, subscription_id, _ = manager.submit_sync(PLAYLIST)
+    assert accepted, subscription_id
+    assert wait_until_idle(manager)
+    return app.session_repo.get_subscription(subscription_id)["last_diff"]
+
+
+def test_sync_completes_and_reports_result(app, monkeypatch, manager):
+    playlist(app, monkeypatch, 4)
+    diff = sync(app, manager)
+
+    assert len(diff["new"]) == 4
+    assert sorted(diff["downloaded"]) == [f"video{i:06d}" for i in range(4)]
+    assert not diff["incomplete"]
+
+    playlist(app, monkeypatch, 6)
+    diff = sync(app, manager)
+
+    assert diff["known"] == 4
+    assert sorted(diff["downloaded"]) == ['video000004', 'video000005']
+
+
+def test_interrupted_sync_is_marked_incomplete(app, monkeypatch, manager):
+    def flat_entries(url, cookies_file=None):
+        yield {"_type": "url", "ie_key": "Youtube", "id": "video000000", "title": "0"}
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(app, '_flat_entries', flat_entries)
+    diff = sync(app, manager)
+
+    assert diff["downloaded"] == ['video000000']
+    assert diff["incomplete"]
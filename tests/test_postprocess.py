@@ -0,0 +1,84 @@
+"""
+FFmpeg 后处理槽位：同时进行的后处理不超过 POSTPROCESS_WORKERS，且在 ffmpeg 启动前获得
+"""
+
+import sys
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def one_slot(app, monkeypatch):
+    monkeypatch.setattr(app, 'postprocess_slots', threading.BoundedSemaphore(1))
+
+
+def test_metadata_does_not_take_a_slot(app):
+    assert app.POSTPROCESSOR_LINE.match('[Merger] Merging formats into "a.mp4"')
+    assert app.POSTPROCESSOR_LINE.match('[FFmpegFixupM3u8]')
+    assert not app.POSTPROCESSOR_LINE.match('[Metadata] Adding metadata to "a.mp4"')
+    assert not app.POSTPROCESSOR_LINE.match('[FFmpegMetadata]')
+
+
+def test_trackers_are_bounded_by_slots(app, one_slot):
+    first, second = app.PostprocessTracker(), app.PostprocessTracker()
+    first.enter('Merger')
+    blocked = threading.Event()
+    entered = threading.Event()
+
+    def enter_second():
+        second.enter('Merger', on_block=blocked.set)
+        entered.set()
+
+    thread = threading.Thread(target=enter_second)
+    thread.start()
+    assert blocked.wait(2)
+    assert not entered.wait(0.3)
+    first.release()
+    assert entered.wait(2)
+    thread.join()
+    second.release()
+    assert second.decision["wait_seconds"] > 0
+
+
+def test_gate_starts_ffmpeg_only_after_slot(app, one_slot, tmp_path):
+    marker = tmp_path / 'ran.txt'
+    real = tmp_path / 'ffmpeg'
+    real.write_text(f'#!/bin/sh\necho "$@" >> {marker}\n')
+    real.chmod(0o755)
+    cmd = ['yt-dlp', '--ffmpeg-location', str(real)]
+    gate = app.FFmpegGate.install(cmd)
+    assert gate is not None and cmd[2] == str(gate.directory)
+
+    holder, tracker = app.PostprocessTracker(), app.PostprocessTracker()
+    holder.enter('Merger')
+
+    def on_line(line):
+        tracker.record('Merger')
+        return True
+
+    def on_request(pid):
+        tracker.acquire()
+        gate.grant(pid)
+
+    gate.on_request = on_request
+    child = [sys.executable, '-c',
+             'import subprocess, sys\n'
+             'print("[Merger] Merging formats", flush=True)\n'
+             f'subprocess.run([{str(gate.directory / "ffmpeg")!r}, "-i", "in.mp4", "out.mkv"])\n']
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(
+        run=app.run_supervised(child, 30, 5, on_line, gate=gate)))
+    try:
+        thread.start()
+        time.sleep(1.5)
+        assert not marker.exists()
+        holder.release()
+        thread.join(10)
+    finally:
+        gate.close()
+        tracker.release()
+    assert result["run"][0] == 0
+    assert marker.read_text().strip() == '-i in.mp4 out.mkv'
+    assert tracker.decision["wait_seconds"] >= 1
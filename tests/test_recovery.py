@@ -0,0 +1,82 @@
+"""
+崩溃恢复：已退出的 worker 遗留的任务由存活的 worker 接管
+"""
+
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def submitted(app, monkeypatch):
+    """拦截调度器，只记录被重新排队的任务"""
+    jobs = []
+    monkeypatch.setattr(app.download_scheduler, 'submit', lambda batch, force=False: jobs.extend(batch))
+    return jobs
+
+
+def dead_pid():
+    """一个已经退出的本机进程 PID"""
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def orphan_job(app, owner, heartbeat):
+    session_id = str(uuid.uuid4())
+    now = time.time()
+    app.session_repo.save_session({"session_id": session_id, "created_at": now,
+                                   "last_activity": now, "download_count": 0})
+    job_id = uuid.uuid4().hex
+    app.session_repo.save_job({
+        "job_id": job_id, "session_id": session_id, "state": "running", "owner": owner,
+        "url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ", "quality": "best", "index": 1,
+        "resume_attempts": 0, "updated_at": now
+    })
+    app.session_repo.save_worker_heartbeat(owner, heartbeat)
+    return job_id
+
+
+def test_restarted_worker_requeues_job_of_exited_process(app, submitted):
+    # 旧进程已退出，但心跳还没超时（例如刚刚重启）
+    job_id = orphan_job(app, f"{socket.gethostname()}:{dead_pid()}:old", time.time())
+
+    app.recover_jobs()
+
+    assert job_id in [job.job_id for job in submitted]
+    record = app.session_repo.get_job(job_id)
+    assert record["owner"] == app.WORKER_ID
+    assert record["state"] == "queued"
+    assert record["resume_attempts"] == 1
+
+
+def test_reused_pid_counts_as_new_worker(app, submitted):
+    # 容器重启后新 worker 拿到了同一个 PID
+    pid = app.WORKER_ID.split(':')[1]
+    job_id = orphan_job(app, f"{socket.gethostname()}:{pid}:old", time.time() - 1)
+
+    app.recover_jobs()
+
+    assert job_id in [job.job_id for job in submitted]
+
+
+def test_live_worker_keeps_job_until_heartbeat_expires(app, submitted):
+    process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    try:
+        owner = f"{socket.gethostname()}:{process.pid}:live"
+        job_id = orphan_job(app, owner, time.time())
+
+        app.recover_jobs()
+        assert job_id not in [job.job_id for job in submitted]
+
+        # 周期性恢复：心跳超时后被接管
+        app.session_repo.save_worker_heartbeat(owner, time.time() - app.config.WORKER_HEARTBEAT_TIMEOUT - 1)
+        app.recover_jobs()
+        assert job_id in [job.job_id for job in submitted]
+    finally:
+        process.kill()
+        process.wait()
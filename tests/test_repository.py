@@ -0,0 +1,136 @@
+"""
+SessionRepository 契约测试：SQLite 与 Redis 实现的行为必须一致
+"""
+
+
+def job_record(job_id, session_id='s1', state='queued', updated_at=1.0, owner='w1', **extra):
+    return dict(extra, job_id=job_id, session_id=session_id, state=state,
+                updated_at=updated_at, owner=owner, url=f"https://www.youtube.com/watch?v={job_id}")
+
+
+def file_record(file_id, size, modified):
+    return {"file_id": file_id, "name": f"{file_id}.mp4", "size": size, "modified": modified}
+
+
+def test_session_roundtrip_and_expiry(repo):
+    assert repo.get_session('s1') is None
+    repo.save_session({"session_id": 's1', "created_at": 1.0, "last_activity": 10.0, "download_count": 2})
+    repo.save_session({"session_id": 's2', "created_at": 1.0, "last_activity": 50.0, "download_count": 0})
+
+    assert repo.get_session('s1')["download_count"] == 2
+    assert repo.expired_sessions(20.0) == ['s1']
+
+    repo.save_session({"session_id": 's1', "created_at": 1.0, "last_activity": 60.0, "download_count": 3})
+    assert repo.expired_sessions(20.0) == []
+    assert repo.get_session('s1')["download_count"] == 3
+
+    repo.delete_session('s1')
+    assert repo.get_session('s1') is None
+    assert repo.expired_sessions(100.0) == ['s2']
+
+
+def test_jobs_listed_by_session_and_state_newest_first(repo):
+    repo.save_job(job_record('a', updated_at=1.0))
+    repo.save_job(job_record('b', updated_at=3.0, state='running'))
+    repo.save_job(job_record('c', session_id='s2', updated_at=2.0))
+
+    assert [job["job_id"] for job in repo.list_jobs('s1')] == ['b', 'a']
+    assert [job["job_id"] for job in repo.list_jobs('s1', states=('running',))] == ['b']
+    assert [job["job_id"] for job in repo.list_jobs(states=('queued', 'running'))] == ['b', 'c', 'a']
+    assert [job["job_id"] for job in repo.list_jobs(states=('queued', 'running'), limit=1)] == ['b']
+    assert repo.get_job('a')["url"].endswith('=a')
+
+
+def test_job_state_change_leaves_old_state(repo):
+    repo.save_job(job_record('a', state='running'))
+    repo.save_job(job_record('a', state='completed', updated_at=2.0))
+
+    assert repo.list_jobs(states=('running',)) == []
+    assert [job["job_id"] for job in repo.list_jobs(states=('completed',))] == ['a']
+    assert repo.get_job('a')["state"] == 'completed'
+
+
+def test_delete_jobs_only_touches_session(repo):
+    repo.save_job(job_record('a'))
+    repo.save_job(job_record('b', session_id='s2'))
+
+    repo.delete_jobs('s1')
+
+    assert repo.get_job('a') is None
+    assert [job["job_id"] for job in repo.list_jobs(states=('queued',))] == ['b']
+
+
+def test_claim_job_succeeds_once_per_owner(repo):
+    repo.save_job(job_record('a', owner='dead-worker'))
+
+    assert repo.claim_job('a', 'dead-worker', 'w2') is True
+    assert repo.claim_job('a', 'dead-worker', 'w3') is False
+
+
+def test_file_catalog_versions_and_usage(repo):
+    assert repo.catalog_version('s1') is None
+    repo.save_files('s1', [])
+    assert repo.catalog_version('s1') == 1
+
+    repo.save_files('s1', [file_record('f1', 100, 1.0), file_record('f2', 50, 2.0)])
+    repo.save_files('s2', [file_record('f3', 7, 3.0)])
+    assert repo.catalog_version('s1') == 2
+    assert sorted(record["file_id"] for record in repo.list_files('s1')) == ['f1', 'f2']
+    assert repo.get_file('s1', 'f2')["size"] == 50
+    assert repo.storage_usage('s1') == 150
+    assert repo.storage_usage() == 157
+
+    # 覆盖同一文件只计算大小差值
+    repo.save_files('s1', [file_record('f1', 120, 1.0)])
+    assert repo.storage_usage('s1') == 170
+
+    repo.delete_files('s1', ['f2'])
+    assert repo.catalog_version('s1') == 4
+    assert repo.get_file('s1', 'f2') is None
+    assert repo.storage_usage('s1') == 120
+
+    repo.delete_files('s1')
+    assert repo.catalog_version('s1') is None
+    assert repo.list_files('s1') == []
+    assert repo.storage_usage('s1') == 0
+    assert repo.storage_usage() == 7
+
+
+def test_lru_order_follows_access_time(repo):
+    repo.save_files('s1', [file_record('old', 1, 1.0), file_record('new', 1, 5.0)])
+    repo.save_files('s2', [file_record('mid', 1, 3.0)])
+
+    assert [record["file_id"] for _, record in repo.lru_files(10)] == ['old', 'mid', 'new']
+    assert [owner for owner, _ in repo.lru_files(10)] == ['s1', 's2', 's1']
+
+    repo.touch_file('s1', 'old', 9.0)
+    assert [record["file_id"] for _, record in repo.lru_files(2)] == ['mid', 'new']
+    assert [record["file_id"] for _, record in repo.lru_files(10, 's1')] == ['new', 'old']
+    # 版本号只随文件增删变化，访问不会让列表缓存失效
+    assert repo.catalog_version('s1') == 1
+
+
+def test_subscriptions_and_archive(repo):
+    repo.save_subscription({"subscription_id": 'sub1', "session_id": 's1', "url": 'https://www.youtube.com/@a',
+                            "created_at": 1.0, "last_sync_at": None, "last_diff": None})
+    repo.add_to_archive('sub1', 'v1', 1.0)
+    repo.add_to_archive('sub1', 'v2', 2.0)
+    repo.add_to_archive('sub1', 'v2', 3.0)
+
+    assert [record["subscription_id"] for record in repo.list_subscriptions('s1')] == ['sub1']
+    assert repo.archived_ids('sub1', ['v1', 'v3']) == {'v1'}
+    assert repo.archived_ids('sub1', []) == set()
+    assert repo.archive_size('sub1') == 2
+
+    repo.delete_subscriptions('s1')
+    assert repo.get_subscription('sub1') is None
+    assert repo.list_subscriptions('s1') == []
+    assert repo.archive_size('sub1') == 0
+
+
+def test_worker_heartbeats(repo):
+    repo.save_worker_heartbeat('w1', 10.0)
+    repo.save_worker_heartbeat('w2', 20.0)
+    repo.save_worker_heartbeat('w1', 30.0)
+
+    assert repo.worker_heartbeats() == {'w1': 30.0, 'w2': 20.0}
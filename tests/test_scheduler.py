@@ -0,0 +1,133 @@
+"""
+下载调度器：通道保底并发只在该通道有排队任务时生效，空闲的保底线程可被其他通道借用
+"""
+
+import types
+
+import pytest
+
+DEFAULT_LANES = (('LANE_SMALL_RESERVED', 1), ('LANE_HEAVY_RESERVED', 1), ('LANE_BULK_RESERVED', 1),
+                 ('LANE_SMALL_WORKERS', 0), ('LANE_HEAVY_WORKERS', 0), ('LANE_BULK_WORKERS', 0))
+
+
+class FakeManager:
+    def update_queue_position(self, position):
+        pass
+
+
+@pytest.fixture
+def make_scheduler(app, monkeypatch):
+    """按默认通道配置创建调度器；不启动工作线程，由测试手动取出可运行的任务"""
+    for name, value in DEFAULT_LANES:
+        monkeypatch.setattr(app.config, name, value)
+
+    def make(workers=2, lanes=None):
+        scheduler = app.DownloadScheduler(workers, 50, 3, lanes)
+        monkeypatch.setattr(scheduler, 'start', lambda: None)
+        return scheduler
+    return make
+
+
+def job(lane, session_id='s1', name=None):
+    return types.SimpleNamespace(job_id=name or lane, session_id=session_id, lane=lane, quality='720p',
+                                 priority=0, seq=0, manager=FakeManager())
+
+
+def start_next(scheduler):
+    """返回下一个可以立即开始的任务，没有则返回 None"""
+    lane, sid = scheduler._select(scheduler._queues, scheduler._active, scheduler._lane_active,
+                                  scheduler._last_served)
+    return scheduler._next_job() if sid is not None else None
+
+
+def start_all(scheduler):
+    started = []
+    while (next_job := start_next(scheduler)) is not None:
+        started.append(next_job)
+    return started
+
+
+def test_lane_budgets_leave_a_shared_worker(app, make_scheduler):
+    assert make_scheduler(2).lanes == {'small': (1, 2), 'heavy': (0, 1), 'bulk': (0, 1)}
+    assert make_scheduler(4).lanes == {'small': (1, 4), 'heavy': (1, 2), 'bulk': (1, 2)}
+    for workers in (1, 2, 3, 8):
+        assert sum(reserved for reserved, _ in app.lane_budgets(workers).values()) < workers
+
+
+def test_bulk_only_queue_starts_at_default_config(make_scheduler):
+    scheduler = make_scheduler()
+    scheduler.submit([job('bulk', 's1', f"b{i}") for i in range(3)])
+
+    assert [started.lane for started in start_all(scheduler)] == ['bulk']  # bulk 上限为工作线程的一半
+
+
+def test_small_only_batch_uses_every_worker(make_scheduler):
+    scheduler = make_scheduler()
+    scheduler.submit([job('small', 's1', f"s{i}") for i in range(3)])
+
+    assert len(start_all(scheduler)) == 2
+
+
+def test_idle_reservations_are_borrowed(make_scheduler):
+    scheduler = make_scheduler(3, lanes={'small': (1, 3), 'heavy': (1, 3), 'bulk': (0, 3)})
+    scheduler.submit([job('bulk', f"s{i}", f"b{i}") for i in range(4)])
+
+    assert len(start_all(scheduler)) == 3
+
+
+def test_queued_lane_keeps_its_reservation(make_scheduler):
+    scheduler = make_scheduler(3, lanes={'small': (1, 3), 'heavy': (1, 3), 'bulk': (0, 3)})
+    scheduler.submit([job('bulk', f"s{i}", f"b{i}") for i in range(4)])
+    scheduler.submit([job('heavy', 's9')])
+
+    started = start_all(scheduler)
+    assert [started_job.lane for started_job in started].count('heavy') == 1
+    assert len(started) == 3
+
+
+def test_reclassify_moves_only_queued_jobs(make_scheduler):
+    scheduler = make_scheduler()
+    running, queued = job('small', 's1', 'running'), job('small', 's2', 'queued')
+    scheduler.submit([running, queued])
+    assert start_next(scheduler) is running
+
+    assert scheduler.reclassify(running, 'heavy') is False
+    assert scheduler.reclassify(queued, 'heavy') is True
+    assert queued.lane == 'heavy'
+    assert scheduler.stats()["lanes"]["heavy"]["queued"] == 1
+    assert start_next(scheduler) is queued
+
+
+def test_wait_for_capacity_gives_up(make_scheduler):
+    scheduler = make_scheduler()
+    scheduler.submit([job('bulk', 's1', f"b{i}") for i in range(3)])
+
+    assert scheduler.wait_for_capacity('s2', 3, timeout=0.1)
+    assert not scheduler.wait_for_capacity('s1', 3, timeout=0.3)
+    assert not scheduler.wait_for_capacity('s1', 3, cancelled=lambda: True)
+
+
+def test_sessions_share_workers_fairly(make_scheduler):
+    scheduler = make_scheduler(4)
+    scheduler.submit([job('small', 's1', f"a{i}") for i in range(3)])
+    scheduler.submit([job('small', 's2', 'b0')])
+
+    started = [started.session_id for started in start_all(scheduler)]
+
+    assert started[:2] == ['s1', 's2']
+    assert started.count('s1') == 3
+
+
+def test_full_queue_returns_retry_after(app, make_scheduler, monkeypatch):
+    scheduler = app.DownloadScheduler(2, 1, 3)
+    monkeypatch.setattr(scheduler, 'start', lambda: None)
+    monkeypatch.setattr(app, 'download_scheduler', scheduler)
+    monkeypatch.setattr(app.config, 'LANE_PROBE', False)
+    scheduler.submit([job('small', 'other')])
+
+    response = app.app.test_client().post(
+        '/api/download', json={"urls": ["https://www.youtube.com/watch?v=dQw4w9WgXcQ"], "quality": "720p"})
+
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 5
+    assert response.get_json()["retry_after"] == int(response.headers['Retry-After'])
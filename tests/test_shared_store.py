@@ -0,0 +1,84 @@
+"""
+共享存储：并发的相同下载只执行一次，结果以硬链接交给各会话；不同 cookies 的下载不共享
+"""
+
+import threading
+import time
+import uuid
+
+import pytest
+
+URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+
+@pytest.fixture
+def store(app, tmp_path, monkeypatch):
+    store = app.SharedStore(tmp_path / '.store')
+    monkeypatch.setattr(app, 'shared_store', store)
+    return store
+
+
+@pytest.fixture
+def fetches(app, monkeypatch):
+    """假下载：记录调用次数，稍作等待让并发请求挂靠，然后写出成品文件"""
+    calls = []
+
+    def download_video(self, url, staging_dir, quality, job=None):
+        calls.append(self.session_id)
+        time.sleep(0.5)
+        (staging_dir / 'video.mp4').write_bytes(b'video')
+        return True
+
+    monkeypatch.setattr(app.DownloadManager, 'download_video', download_video)
+    monkeypatch.setattr(app.config, 'LANE_PROBE', False)
+    return calls
+
+
+def make_manager(app, monkeypatch):
+    session_id = str(uuid.uuid4())
+    session = app.UserSession(session_id)
+    monkeypatch.setitem(app.user_sessions, session_id, session)
+    manager = session.download_manager = app.DownloadManager(session_id)
+    manager._new_batch(1, '720p')
+    return manager
+
+
+def test_concurrent_requests_fetch_once(app, monkeypatch, store, fetches):
+    managers = [make_manager(app, monkeypatch) for _ in range(3)]
+    threads = [threading.Thread(target=manager.run_job, args=(app.DownloadJob(manager, URL, '720p'),))
+               for manager in managers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(fetches) == 1
+    stored = next(store.root.iterdir()) / 'video.mp4'
+    assert stored.stat().st_nlink == 4  # 存储副本 + 三个会话
+    for manager in managers:
+        linked = app.user_sessions[manager.session_id].get_download_dir() / 'video.mp4'
+        assert linked.samefile(stored)
+
+
+def test_later_request_is_served_from_store(app, monkeypatch, store, fetches):
+    first, second = make_manager(app, monkeypatch), make_manager(app, monkeypatch)
+    first.run_job(app.DownloadJob(first, URL, '720p'))
+    second.run_job(app.DownloadJob(second, URL, '720p'))
+
+    assert fetches == [first.session_id]
+    assert (app.user_sessions[second.session_id].get_download_dir() / 'video.mp4').is_file()
+
+
+def test_cookies_split_store_keys(app, tmp_path):
+    alice, bob = tmp_path / 'alice.txt', tmp_path / 'bob.txt'
+    alice.write_text('alice')
+    bob.write_text('bob')
+    options = ["-f", "bv*+ba"]
+
+    anonymous = app.SharedStore.key_for('dQw4w9WgXcQ', options)
+    with_alice = app.SharedStore.key_for('dQw4w9WgXcQ', options + ["--cookies", str(alice)])
+    with_bob = app.SharedStore.key_for('dQw4w9WgXcQ', options + ["--cookies", str(bob)])
+
+    assert len({anonymous, with_alice, with_bob}) == 3
+    assert with_alice == app.SharedStore.key_for('dQw4w9WgXcQ', options + ["--cookies", str(alice)])
+    assert anonymous == app.SharedStore.key_for('dQw4w9WgXcQ', options + ["-N", "4"])
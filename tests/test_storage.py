@@ -0,0 +1,118 @@
+"""
+存储准入与淘汰：并发准入的任务共享预留额度，淘汰只计算真正能回收的空间
+"""
+
+import os
+
+import pytest
+
+
+@pytest.fixture
+def storage(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app.config, 'DOWNLOAD_DIR', tmp_path)
+    monkeypatch.setattr(app.config, 'STORAGE_MIN_AGE', 0)
+    monkeypatch.setattr(app.config, 'STORAGE_QUOTA_BYTES', 0)
+    repo = app.SQLiteSessionRepository(tmp_path / 'repo.db')
+    return app.StorageManager(tmp_path, repo, None)
+
+
+def add_file(storage, session_id, name, size, link_from=None):
+    session_dir = storage.root / f"session_{session_id}"
+    session_dir.mkdir(exist_ok=True)
+    path = session_dir / name
+    if link_from:
+        os.link(link_from, path)
+    else:
+        path.write_bytes(b'x' * size)
+    storage.repo.save_files(session_id, [{"file_id": name, "name": name, "size": size, "modified": 1.0}])
+    return path
+
+
+def test_reservation_counts_against_session_quota(app, storage, monkeypatch):
+    monkeypatch.setattr(app.config, 'SESSION_QUOTA_BYTES', 150)
+    monkeypatch.setitem(app.QUALITY_SIZE_ESTIMATES, '360p', 100)
+
+    assert storage.admit('s1', '360p', job_id='j1') == (True, "")
+    assert storage.stats()["reserved_bytes"] == 100
+    assert storage.admit('s1', '360p', job_id='j2')[0] is False
+    assert storage.admit('s2', '360p', job_id='j3')[0] is True
+
+    storage.release('j1')
+    assert storage.admit('s1', '360p', job_id='j2')[0] is True
+
+
+def test_disk_eviction_skips_files_shared_with_other_sessions(storage):
+    shared = add_file(storage, 's1', 'shared.mp4', 10)
+    add_file(storage, 's2', 'shared.mp4', 10, link_from=shared)
+    add_file(storage, 's3', 'shared.mp4', 10, link_from=shared)
+    storage.repo.touch_file('s1', 'shared.mp4', 0.5)  # 最久未访问
+    own = add_file(storage, 's1', 'own.mp4', 10)
+
+    assert storage.evict(10, reason="high_water") == 10
+    assert shared.exists()
+    assert not own.exists()
+
+
+def test_session_quota_eviction_counts_shared_files(storage):
+    shared = add_file(storage, 's1', 'shared.mp4', 10)
+    add_file(storage, 's2', 'shared.mp4', 10, link_from=shared)
+    add_file(storage, 's3', 'shared.mp4', 10, link_from=shared)
+
+    assert storage.evict(10, session_id='s1', reason="session_quota") == 10
+    assert not shared.exists()
+
+
+@pytest.fixture
+def store(app, tmp_path, monkeypatch):
+    store = app.SharedStore(tmp_path / '.store')
+    monkeypatch.setattr(app, 'shared_store', store)
+    return store
+
+
+def stored_file(store, key, name, size):
+    path = store.root / key / name
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b'x' * size)
+    return path
+
+
+def test_disk_eviction_reclaims_store_copy(storage, store):
+    source = stored_file(store, 'abc_123', 'video.mp4', 10)
+    linked = add_file(storage, 's1', 'video.mp4', 10, link_from=source)
+    record = storage.repo.get_file('s1', 'video.mp4')
+    storage.repo.save_files('s1', [dict(record, stored='abc_123/video.mp4')])
+
+    assert storage.evict(10, reason="high_water") == 10
+    assert not linked.exists()
+    assert not source.exists() and not source.parent.exists()
+
+
+def test_disk_eviction_skips_store_links_without_location(storage, store):
+    source = stored_file(store, 'abc_123', 'video.mp4', 10)
+    linked = add_file(storage, 's1', 'video.mp4', 10, link_from=source)
+
+    assert storage.evict(10, reason="high_water") == 0
+    assert linked.exists() and source.exists()
+
+
+def test_prune_skips_inflight_and_vanished_files(store, monkeypatch):
+    old = stored_file(store, 'old_1', 'a.mp4', 1)
+    busy = stored_file(store, 'busy_1', 'b.mp4', 1)
+    os.utime(old, (0, 0))
+    os.utime(busy, (0, 0))
+    store._inflight['busy_1'] = []
+    ghost = store.root / 'old_1' / 'ghost.mp4'
+    ghost.write_bytes(b'x')
+    real_iterdir = type(ghost).iterdir
+
+    def iterdir(path):
+        for child in real_iterdir(path):
+            if child == ghost:
+                child.unlink()  # 遍历期间被其他清理删除
+            yield child
+
+    monkeypatch.setattr(type(ghost), 'iterdir', iterdir)
+    store.prune(60)
+
+    assert not old.parent.exists()
+    assert busy.exists()
@@ -0,0 +1,83 @@
+"""
+子进程监督：墙钟超时、无输出超时、TERM 无响应时升级为 KILL，并记录资源用量
+"""
+
+import sys
+import time
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def short_grace(app, monkeypatch):
+    monkeypatch.setattr(app.config, 'PROCESS_KILL_GRACE', 1)
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+def test_completed_process_reports_stderr_and_lines(app):
+    lines = []
+    returncode, stderr, reason = app.run_supervised(
+        python('import sys\nprint("one")\nprint("two")\nprint("oops", file=sys.stderr)\nsys.exit(3)'),
+        10, 5, lines.append)
+
+    assert (returncode, stderr, reason) == (3, 'oops', None)
+    assert lines == ['one', 'two']
+
+
+def test_wall_clock_timeout(app):
+    started = time.monotonic()
+    returncode, _, reason = app.run_supervised(
+        python('import time\nwhile True:\n    print("tick", flush=True)\n    time.sleep(0.1)'),
+        1.5, 10, lambda line: None)
+
+    assert (returncode, reason) == (None, "timeout")
+    assert time.monotonic() - started < 5
+
+
+def test_stall_timeout(app):
+    started = time.monotonic()
+    returncode, _, reason = app.run_supervised(
+        python('import time\nprint("start", flush=True)\ntime.sleep(30)'), 30, 1, lambda line: None)
+
+    assert (returncode, reason) == (None, "stall")
+    assert time.monotonic() - started < 5
+
+
+def test_postprocessing_pauses_stall_detection(app):
+    returncode, _, reason = app.run_supervised(
+        python('import time\nprint("[Merger] Merging", flush=True)\ntime.sleep(2)\nprint("done")'),
+        30, 1, lambda line: True if line.startswith('[Merger]') else None)
+
+    assert (returncode, reason) == (0, None)
+
+
+def test_term_is_escalated_to_kill(app, tmp_path):
+    marker = tmp_path / 'ignored'
+    code = ('import signal, time\n'
+            'signal.signal(signal.SIGTERM, lambda *_: open(%r, "w").close())\n'
+            'print("ready", flush=True)\n'
+            'time.sleep(60)' % str(marker))
+    processes = []
+    started = time.monotonic()
+    returncode, _, reason = app.run_supervised(python(code), 1, 10, lambda line: None,
+                                               on_start=processes.append)
+
+    assert (returncode, reason) == (None, "timeout")
+    assert marker.exists()  # 收到过 TERM 但没有退出
+    assert processes[0].returncode == -9
+    assert time.monotonic() - started < 6
+
+
+def test_resource_usage_is_recorded(app):
+    usage = app.JobResourceUsage()
+    returncode, _, _ = app.run_supervised(
+        python('import time\nend = time.process_time() + 0.3\nwhile time.process_time() < end:\n    pass\n'
+               'data = bytearray(64 * 1024 * 1024)'),
+        30, 10, lambda line: None, usage=usage)
+
+    assert returncode == 0
+    assert usage.cpu_seconds >= 0.2
+    assert usage.peak_rss_bytes >= 64 * 1024 * 1024